@@ -26,6 +26,7 @@ class ActivityResults(namedtuple('ActivityResults', [
     'total',
     'aggregations',
     'timeframes',
+    'next',
 ])):
     pass
 
@@ -108,7 +109,8 @@ def execute(request, query, page_size):
 
     result = ActivityResults(total=search_result.total,
                              aggregations=search_result.aggregations,
-                             timeframes=[])
+                             timeframes=[],
+                             next=search_result.next)
 
     if result.total == 0:
         return result
@@ -182,7 +184,25 @@ def _execute_search(request, query, page_size):
     query['limit'] = page_size
     query['offset'] = (page - 1) * page_size
 
+    # If we were given a cursor for this page, use it rather than the offset
+    # so that deep pages are as cheap as the first. Beyond the first page,
+    # pass an empty cursor otherwise, so that the search returns a cursor for
+    # the next page. The first page, which most requests are for, isn't
+    # sorted for paging with a cursor.
+    search_after = request.params.get('search_after')
+    if search_after or page > 1:
+        query['search_after'] = search_after or ''
+
     search_result = search.run(query)
+
+    # The search only counts the results from the cursor on, so count all of
+    # them separately.
+    if search_after:
+        uncursored = query.copy()
+        del uncursored['search_after']
+        total, = search.count_all([uncursored])
+        search_result = search_result._replace(total=total)
+
     return search_result
 
 
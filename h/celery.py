@@ -70,6 +70,7 @@ celery.conf.update(
     ),
     CELERY_ROUTES={
         'h.tasks.indexer.add_annotation': 'indexer',
+        'h.tasks.indexer.add_annotations': 'indexer-batch',
         'h.tasks.indexer.delete_annotation': 'indexer',
         'h.tasks.indexer.reindex_user_annotations': 'indexer',
     },
@@ -83,11 +84,19 @@ celery.conf.update(
               durable=True,
               routing_key='indexer',
               exchange=Exchange('indexer', type='direct', durable=True)),
+        Queue('indexer-batch',
+              durable=True,
+              routing_key='indexer-batch',
+              exchange=Exchange('indexer-batch', type='direct', durable=True)),
     ],
     # Only accept one task at a time. This also probably isn't what we want
     # (especially not for, say, a search indexer task) but it makes the
-    # behaviour consistent with the previous NSQ-based worker:
-    CELERYD_PREFETCH_MULTIPLIER=1,
+    # behaviour consistent with the previous NSQ-based worker.
+    #
+    # Batched tasks can only buffer as many requests as the worker prefetches,
+    # so workers consuming the indexer-batch queue should be run with
+    # CELERYD_PREFETCH_MULTIPLIER=0 (no limit).
+    CELERYD_PREFETCH_MULTIPLIER=int(os.environ.get('CELERYD_PREFETCH_MULTIPLIER', 1)),
 )
 
 
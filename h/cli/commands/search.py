@@ -1,11 +1,17 @@
 # -*- coding: utf-8 -*-
 
+from datetime import datetime, timedelta
 import os
+import time
 
 import click
 
 from h import indexer
+from h import models
+from h.indexer.consistency import MAX_WINDOW_SIZE
+from h.search import Search
 from h.search import config
+from h.search import index
 
 
 @click.group()
@@ -14,21 +20,146 @@ def search():
 
 
 @search.command()
+@click.option('--workers', type=int, default=1,
+              help='The number of processes to index with.')
+@click.option('--chunk-size', type=int, default=index.ES_CHUNK_SIZE,
+              help='The number of annotations to send in each bulk request.')
+@click.option('--window-size', type=int, default=index.PG_WINDOW_SIZE,
+              help='The number of annotations to load from the database at a time.')
+@click.option('--resume', is_flag=True,
+              help='Resume an interrupted reindex from its last checkpoint.')
+@click.option('--abort', is_flag=True,
+              help='Abandon an interrupted reindex.')
 @click.pass_context
-def reindex(ctx):
+def reindex(ctx, workers, chunk_size, window_size, resume, abort):
     """
     Reindex all annotations.
 
     Creates a new search index from the data in PostgreSQL and atomically
     updates the index alias. This requires that the index is aliased already,
     and will raise an error if it is not.
+
+    If a reindex is interrupted, running it again with --resume continues
+    into the same new index from the last checkpoint. Until then, realtime
+    updates are written to both the current and the new index. Running it
+    with --abort instead stops that, and abandons the new index.
     """
 
+    if resume and abort:
+        raise click.BadParameter('--resume and --abort are mutually exclusive',
+                                 param_hint='--abort')
+
     os.environ['ELASTICSEARCH_CLIENT_TIMEOUT'] = '30'
 
     request = ctx.obj['bootstrap']()
 
-    indexer.reindex(request.db, request.es, request)
+    if abort:
+        try:
+            new_index = indexer.abort_reindex(request)
+        except RuntimeError as e:
+            raise click.ClickException(e.message)
+        click.echo('Abandoned the reindex into {}, which can be deleted once '
+                   'in-flight updates have been written'.format(new_index))
+        return
+
+    try:
+        indexer.reindex(request.db, request.es, request,
+                        workers=workers,
+                        chunk_size=chunk_size,
+                        window_size=window_size,
+                        resume=resume)
+    except RuntimeError as e:
+        raise click.ClickException(e.message)
+
+
+@search.command()
+@click.option('--since', required=True,
+              help='Sync annotations updated at or after this UTC time, as '
+                   'YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS.')
+@click.option('--follow', is_flag=True,
+              help='Keep syncing newly updated annotations until interrupted.')
+@click.option('--interval', type=float, default=10,
+              help='With --follow, the number of seconds between syncs.')
+@click.option('--overlap', type=float, default=60,
+              help='With --follow, the number of seconds by which each sync '
+                   'overlaps the previous one, to catch slow transactions.')
+@click.pass_context
+def sync(ctx, since, follow, interval, overlap):
+    """
+    Catch the search index up with the database.
+
+    Indexes the annotations updated since the given time, and marks those
+    deleted since then as deleted, without a full reindex. With --follow, it
+    keeps tailing the annotations table, as a safety net for the indexer.
+    """
+
+    since = _parse_timestamp(since)
+
+    request = ctx.obj['bootstrap']()
+
+    while True:
+        started = datetime.utcnow()
+        count, errored = indexer.sync(request.db, request.es, request, since)
+        # End the transaction, so that the next sync sees new changes.
+        request.tm.commit()
+
+        click.echo('Synced {} annotations updated since {}'.format(
+            count, since.isoformat()))
+        if errored:
+            click.echo('Failed to index {} annotations: {}'.format(
+                len(errored), ', '.join(sorted(errored))), err=True)
+
+        if not follow:
+            break
+        since = started - timedelta(seconds=overlap)
+        time.sleep(interval)
+
+    if errored:
+        raise click.ClickException(
+            'failed to index {} annotations'.format(len(errored)))
+
+
+@search.command('check')
+@click.option('--window-size', type=click.IntRange(1, MAX_WINDOW_SIZE),
+              default=index.PG_WINDOW_SIZE,
+              help='The number of annotations to compare at a time.')
+@click.option('--repair', is_flag=True,
+              help='Reindex the annotations which differ.')
+@click.pass_context
+def check_index(ctx, window_size, repair):
+    """
+    Check the search index against the database.
+
+    Compares the annotations in PostgreSQL with those in the search index, a
+    window of annotations at a time, and lists the annotations which are
+    missing from or out of date in the index. With --repair, reindexes them.
+    Otherwise, exits with an error if any differ.
+    """
+
+    request = ctx.obj['bootstrap']()
+
+    drifts = list(indexer.find_drift(request.db, request.es, windowsize=window_size))
+    if not drifts:
+        click.echo('The search index matches the database')
+        return
+
+    for drift in drifts:
+        click.echo('{} to {}: {} stale, {} deleted: {}'.format(
+            drift.window.start.isoformat(),
+            drift.window.end.isoformat() if drift.window.end else 'now',
+            len(drift.stale),
+            len(drift.deleted),
+            ', '.join(sorted(drift.stale | drift.deleted))))
+
+    if not repair:
+        raise click.ClickException(
+            '{} windows of annotations differ from the search index'.format(len(drifts)))
+
+    errored = indexer.repair_drift(request.db, request.es, request, drifts)
+    if errored:
+        raise click.ClickException('failed to reindex {} annotations: {}'.format(
+            len(errored), ', '.join(sorted(errored))))
+    click.echo('Repaired {} windows'.format(len(drifts)))
 
 
 @search.command('update-settings')
@@ -48,3 +179,83 @@ def update_settings(ctx):
         config.update_index_settings(request.es)
     except RuntimeError as e:
         raise click.ClickException(e.message)
+
+
+@search.group('badge-counts')
+def badge_counts():
+    """Manage the public annotation counts shown by the badge."""
+
+
+@badge_counts.command('rebuild')
+@click.pass_context
+def rebuild_badge_counts(ctx):
+    """
+    Rebuild the badge counts.
+
+    Recounts the public annotations on every page from the data in
+    PostgreSQL, replacing the counts maintained by the indexer.
+    """
+
+    request = ctx.obj['bootstrap']()
+
+    svc = request.find_service(name='badge_count')
+    pages = svc.rebuild()
+    request.tm.commit()
+
+    click.echo('Counted public annotations on {} pages'.format(pages))
+
+
+@badge_counts.command('check')
+@click.option('--limit', type=int, default=1000,
+              help='The maximum number of pages to check.')
+@click.pass_context
+def check_badge_counts(ctx, limit):
+    """
+    Check the badge counts against the search index.
+
+    Compares the stored counts of the most recently updated pages, and of
+    the pages of the most recently updated annotations, with the number of
+    annotations an anonymous search for each page finds, and exits with an
+    error if any of them differ. Pages which have no stored count are
+    checked against a count of zero.
+    """
+
+    request = ctx.obj['bootstrap']()
+
+    pages = dict(request.db.query(models.BadgeCount.uri, models.BadgeCount.count)
+                           .order_by(models.BadgeCount.updated.desc())
+                           .limit(limit))
+
+    annotated = set(uri for uri, in
+                    request.db.query(models.Annotation.target_uri_normalized)
+                              .filter_by(deleted=False, shared=True)
+                              .order_by(models.Annotation.updated.desc())
+                              .limit(limit))
+    unchecked = annotated - set(pages)
+    if unchecked:
+        pages.update((uri, 0) for uri in unchecked)
+        pages.update(request.db.query(models.BadgeCount.uri, models.BadgeCount.count)
+                               .filter(models.BadgeCount.uri.in_(unchecked)))
+
+    mismatched = 0
+    for uri, count in sorted(pages.items()):
+        result = Search(request).run({'uri': uri, 'limit': 0})
+        if result.total != count:
+            mismatched += 1
+            click.echo('{}: stored {}, search index {}'.format(uri,
+                                                               count,
+                                                               result.total))
+
+    if mismatched:
+        raise click.ClickException(
+            '{} badge counts differ from the search index'.format(mismatched))
+
+
+def _parse_timestamp(value):
+    for format_ in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value, format_)
+        except ValueError:
+            pass
+    raise click.BadParameter('{} is not a valid timestamp'.format(value),
+                             param_hint='--since')
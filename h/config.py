@@ -101,6 +101,75 @@ SETTINGS = [
     EnvSetting('h.sentry_dsn_frontend', 'SENTRY_DSN_FRONTEND'),
     EnvSetting('h.websocket_url', 'WEBSOCKET_URL'),
 
+    # In-memory caching of search responses: the maximum number of responses
+    # to cache (0 disables the cache) and how many seconds to keep them.
+    EnvSetting('h.search.cache_size', 'SEARCH_CACHE_SIZE', type=int),
+    EnvSetting('h.search.cache_ttl', 'SEARCH_CACHE_TTL', type=float),
+
+    # In-memory caching of search aggregations (the activity pages' facets):
+    # the maximum number of results to cache (0 disables the cache), how many
+    # seconds to serve them for, and after how many seconds to refresh them in
+    # the background.
+    EnvSetting('h.search.facets_cache_size', 'SEARCH_FACETS_CACHE_SIZE', type=int),
+    EnvSetting('h.search.facets_ttl', 'SEARCH_FACETS_TTL', type=float),
+    EnvSetting('h.search.facets_refresh', 'SEARCH_FACETS_REFRESH', type=float),
+
+    # In-memory caching of the pubids of the groups each user can read or
+    # created: the maximum number of users' pubids to cache (0 disables the
+    # cache) and how many seconds to keep them. Enabling the listener starts a
+    # thread in each process which consumes the realtime user topic, to drop
+    # the cached pubids of users who join or leave a group in another process
+    # before the TTL is up.
+    EnvSetting('h.groups.cache_size', 'GROUPS_CACHE_SIZE', type=int),
+    EnvSetting('h.groups.cache_ttl', 'GROUPS_CACHE_TTL', type=float),
+    EnvSetting('h.groups.cache_listen', 'GROUPS_CACHE_LISTEN', type=asbool),
+
+    # Profiling of searches: log searches which took at least this many
+    # milliseconds, and log this fraction (0 to 1) of the other searches.
+    # Setting either also records a timer per combination of filters, matchers
+    # and aggregations (see h.search.profile).
+    EnvSetting('h.search.slow_query_ms', 'SEARCH_SLOW_QUERY_MS', type=float),
+    EnvSetting('h.search.profile_sample_rate', 'SEARCH_PROFILE_SAMPLE_RATE',
+               type=float),
+
+    # Store annotations' extra fields in the search index. Existing indexes
+    # need the mapping which doesn't index them first, so only enable this
+    # after running `hypothesis search update-settings`.
+    EnvSetting('h.search.index_extra', 'SEARCH_INDEX_EXTRA', type=asbool),
+
+    # Render API search results from the documents in the search index rather
+    # than loading them from the database. Annotations indexed without their
+    # extra fields (see h.search.index_extra) are still loaded from the
+    # database.
+    EnvSetting('h.search.render_from_index', 'SEARCH_RENDER_FROM_INDEX',
+               type=asbool),
+
+    # Index added and updated annotations in coalesced batches, rather than one
+    # task per annotation. This needs a worker consuming the indexer-batch
+    # queue (see h.celery).
+    EnvSetting('h.indexer.coalesce', 'INDEXER_COALESCE', type=asbool),
+
+    # Answer the badge from the counts maintained by the indexer, rather than
+    # by searching. Run `hypothesis search badge-counts rebuild` first.
+    EnvSetting('h.badge.use_counts', 'BADGE_USE_COUNTS', type=asbool),
+
+    # Embed the presented annotation in realtime annotation messages, so that
+    # the streamer doesn't have to load it from the database.
+    EnvSetting('h.realtime.embed_annotations', 'REALTIME_EMBED_ANNOTATIONS',
+               type=asbool),
+
+    # Streamer work queue batching: the maximum number of messages to handle in
+    # one database transaction, and how long to wait for a batch to fill.
+    EnvSetting('h.streamer.batch_size', 'STREAMER_BATCH_SIZE', type=int),
+    EnvSetting('h.streamer.batch_latency_ms', 'STREAMER_BATCH_LATENCY_MS',
+               type=int),
+    # Streamer outbound buffering: the number of bytes which may be buffered for
+    # a client, and what to do when that is exceeded ("drop_oldest" or
+    # "close").
+    EnvSetting('h.streamer.outbox_max_bytes', 'STREAMER_OUTBOX_MAX_BYTES',
+               type=int),
+    EnvSetting('h.streamer.outbox_overflow', 'STREAMER_OUTBOX_OVERFLOW'),
+
     # Debug/development settings
     EnvSetting('debug_query', 'DEBUG_QUERY'),
 ]
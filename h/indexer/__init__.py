@@ -1,9 +1,16 @@
 # -*- coding: utf-8 -*-
 
+from h.indexer.consistency import find_drift, repair_drift
+from h.indexer.reindexer import abort as abort_reindex
 from h.indexer.reindexer import reindex
+from h.indexer.sync import sync
 
 __all__ = (
+    'abort_reindex',
+    'find_drift',
     'reindex',
+    'repair_drift',
+    'sync',
 )
 
 
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+"""
+Checking the search index against the database, and repairing any drift.
+
+The annotations are compared window by window, in windows of their `updated`
+times. For each window, the number of undeleted annotations and the sum of
+their `updated` times (in milliseconds, as Elasticsearch stores them) are
+compared with the same figures aggregated from the search index. If those
+match, a checksum of the annotations' ids is compared too, which catches an
+annotation missing from the index while another with the same `updated`
+time is indexed in its place. Elasticsearch can't aggregate the ids, so
+they are fetched, without their documents, to compute it. Only the windows
+whose figures differ are compared annotation by annotation.
+"""
+
+from __future__ import unicode_literals
+
+from collections import namedtuple
+import hashlib
+
+from elasticsearch import helpers as es_helpers
+import sqlalchemy as sa
+
+from h import models
+from h.indexer.reindexer import SETTING_NEW_INDEX
+from h.search import index
+from h.search.index import BatchIndexer
+from h.search.query import DeletedFilter
+from h.util.datetime import utc_iso8601
+from h.util.query import column_window
+
+# The windows' checksums are sums of millisecond timestamps, which
+# Elasticsearch adds up as doubles. Windows much larger than this could lose
+# precision, and with it mismatches.
+MAX_WINDOW_SIZE = 4000
+
+
+class Drift(namedtuple('Drift', ['window', 'stale', 'deleted'])):
+    """
+    The differences between the database and the search index in a window.
+
+    ``stale`` is the set of ids of the annotations which are missing from the
+    search index or out of date in it, and ``deleted`` is the set of ids of
+    annotations which are in the search index but have been deleted.
+    """
+
+
+def find_drift(session, es, windowsize=index.PG_WINDOW_SIZE):
+    """
+    Compare the annotations in the database with those in the search index.
+
+    :param windowsize: the number of annotations to compare at a time, up to
+        `MAX_WINDOW_SIZE`
+
+    :returns: the differences in each window of annotations which differ
+    :rtype: iterator of Drift
+    """
+    for window in index.windows(session, windowsize=windowsize):
+        if _matches(session, es, window):
+            continue
+
+        drift = _compare(session, es, window)
+        if drift.stale or drift.deleted:
+            yield drift
+
+
+def repair_drift(session, es, request, drifts):
+    """
+    Repair the differences found by :py:func:`find_drift`.
+
+    Stale annotations are reindexed, and deleted ones marked as deleted. If a
+    reindex is running, the new index is repaired as well.
+
+    :returns: a set of the ids which failed to reindex
+    :rtype: set
+    """
+    stale = set()
+    deleted = set()
+    for drift in drifts:
+        stale.update(drift.stale)
+        deleted.update(drift.deleted)
+
+    target_indexes = [None]
+    new_index = request.find_service(name='settings').get(SETTING_NEW_INDEX)
+    if new_index is not None:
+        target_indexes.append(new_index)
+
+    errored = set()
+    for target_index in target_indexes:
+        if stale:
+            indexer = BatchIndexer(session, es, request, target_index=target_index)
+            errored.update(indexer.index(stale))
+        for id_ in deleted:
+            index.delete(es, id_, target_index=target_index)
+    return errored
+
+
+def _matches(session, es, window):
+    ids, summary = _db_summary(session, window)
+    if summary != _index_summary(es, window):
+        return False
+    return _ids_checksum(ids) == _ids_checksum(_indexed_ids(es, window))
+
+
+def _db_summary(session, window):
+    updated_ms = sa.func.round(
+        sa.extract('epoch', sa.func.date_trunc('milliseconds', models.Annotation.updated)) * 1000)
+    rows = (session.query(models.Annotation.id, updated_ms)
+                   .filter(_db_window(window))
+                   .all())
+    checksum = sum(int(ms) for _, ms in rows)
+    return ([id_ for id_, _ in rows], (len(rows), checksum))
+
+
+def _index_summary(es, window):
+    body = {
+        'query': {'filtered': {'filter': _index_window(window)}},
+        'size': 0,
+        'aggs': {'checksum': {'sum': {'field': 'updated'}}},
+    }
+    response = es.conn.search(index=es.index, doc_type=es.t.annotation, body=body)
+    checksum = response['aggregations']['checksum']['value'] or 0
+    return (response['hits']['total'], int(round(checksum)))
+
+
+def _indexed_ids(es, window):
+    body = {'query': {'filtered': {'filter': _index_window(window)}}, '_source': False}
+    hits = es_helpers.scan(es.conn, query=body, index=es.index, doc_type=es.t.annotation)
+    return [hit['_id'] for hit in hits]
+
+
+def _ids_checksum(ids):
+    # An order-independent digest of a collection of unique ids.
+    checksum = 0
+    for id_ in ids:
+        checksum ^= int(hashlib.md5(id_.encode('utf-8')).hexdigest()[:16], 16)
+    return checksum
+
+
+def _compare(session, es, window):
+    annotations = dict(
+        (id_, utc_iso8601(updated)) for id_, updated in
+        session.query(models.Annotation.id, models.Annotation.updated)
+               .filter(_db_window(window)))
+
+    indexed = _indexed_updated(es, {'ids': {'values': list(annotations)}})
+    stale = set(id_ for id_, updated in annotations.items()
+                if indexed.get(id_) != updated)
+
+    # Annotations which are in this window in the search index but not in the
+    # database have either been deleted, or updated since they were indexed,
+    # in which case they're in a later window in the database, and are stale
+    # there.
+    unexpected = set(_indexed_updated(es, _index_window(window))) - set(annotations)
+    if unexpected:
+        updated = set(id_ for id_, in
+                      session.query(models.Annotation.id)
+                             .filter(models.Annotation.id.in_(list(unexpected)),
+                                     models.Annotation.deleted.is_(False)))
+        unexpected -= updated
+
+    return Drift(window, stale, unexpected)
+
+
+def _indexed_updated(es, filter_):
+    """Return the `updated` times of the indexed annotations matching `filter_`."""
+    body = {'query': {'filtered': {'filter': filter_}}, '_source': ['updated']}
+    hits = es_helpers.scan(es.conn, query=body, index=es.index, doc_type=es.t.annotation)
+    return dict((hit['_id'], hit.get('_source', {}).get('updated')) for hit in hits)
+
+
+def _db_window(window):
+    return sa.and_(models.Annotation.deleted.is_(False),
+                   column_window(models.Annotation.updated, window.start, window.end))
+
+
+def _index_window(window):
+    updated = {'gte': utc_iso8601(window.start)}
+    if window.end is not None:
+        updated['lt'] = utc_iso8601(window.end)
+    return {'and': [DeletedFilter()({}), {'range': {'updated': updated}}]}
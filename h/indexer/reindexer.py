@@ -1,47 +1,211 @@
 # -*- coding: utf-8 -*-
 
+from __future__ import division
+
+from datetime import datetime
 import logging
+import multiprocessing
+import time
 
+from h import db
+from h.search.client import get_client
 from h.search.config import (
     configure_index,
     get_aliased_index,
     update_aliased_index,
 )
+from h.search import index
 from h.search.index import BatchIndexer
 
 log = logging.getLogger(__name__)
 
 SETTING_NEW_INDEX = u'reindex.new_index'
+SETTING_CHECKPOINT = u'reindex.checkpoint'
+
+CHECKPOINT_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+# The batch indexer of each worker process in a parallel reindex
+_worker_indexer = None
+
+
+def reindex(session, es, request, workers=1, chunk_size=index.ES_CHUNK_SIZE,
+            window_size=index.PG_WINDOW_SIZE, resume=False):
+    """
+    Reindex all annotations into a new index, and update the alias.
 
+    The annotations are indexed in windows of their `updated` times, and the
+    end of the last window to be completed is saved as a checkpoint. If the
+    reindex fails, the new index and the checkpoint are kept, so that it can
+    be resumed from the checkpoint with `resume`. Realtime updates keep being
+    written to the new index as well as the current one until the reindex is
+    resumed to completion or abandoned with :py:func:`abort`.
 
-def reindex(session, es, request):
-    """Reindex all annotations into a new index, and update the alias."""
+    :param workers: the number of processes to index with
+    :param chunk_size: the number of annotations to send to Elasticsearch in
+        each bulk request
+    :param window_size: the number of annotations to load from the database
+        at a time (and, in a parallel reindex, to hand to a worker at a time)
+    :param resume: whether to resume an interrupted reindex, rather than
+        starting a new one
+    """
 
     if get_aliased_index(es) is None:
         raise RuntimeError('cannot reindex if current index is not aliased')
 
     settings = request.find_service(name='settings')
 
-    new_index = configure_index(es)
-
-    try:
+    if resume:
+        new_index = settings.get(SETTING_NEW_INDEX)
+        if new_index is None:
+            raise RuntimeError('there is no interrupted reindex to resume')
+        since = settings.get(SETTING_CHECKPOINT)
+        if since is not None:
+            since = datetime.strptime(since, CHECKPOINT_FORMAT)
+        log.info('resuming reindex into {} from {}'.format(new_index, since))
+    else:
+        new_index = configure_index(es)
+        since = None
         settings.put(SETTING_NEW_INDEX, new_index)
+        settings.delete(SETTING_CHECKPOINT)
         request.tm.commit()
 
-        indexer = BatchIndexer(session, es, request, target_index=new_index, op_type='create')
+    try:
+        _reindex(session, es, request, settings, new_index, since, workers,
+                 chunk_size, window_size)
+    except:
+        log.exception('reindex into {} failed: realtime updates are still '
+                      'being written to it as well as the current index, '
+                      'until the reindex is resumed with --resume or '
+                      'abandoned with --abort'.format(new_index))
+        raise
+
+    settings.delete(SETTING_NEW_INDEX)
+    settings.delete(SETTING_CHECKPOINT)
+    request.tm.commit()
+
+
+def abort(request):
+    """
+    Abandon an interrupted reindex.
+
+    This deletes the settings which make realtime updates write to the new
+    index too, and the reindex's checkpoint. The new index itself is left in
+    place, as updates which were already in flight may still write to it,
+    and can be deleted once they have been.
+
+    :returns: the name of the abandoned index
+    :rtype: unicode
+    """
+    settings = request.find_service(name='settings')
+
+    new_index = settings.get(SETTING_NEW_INDEX)
+    if new_index is None:
+        raise RuntimeError('there is no interrupted reindex to abort')
+
+    settings.delete(SETTING_NEW_INDEX)
+    settings.delete(SETTING_CHECKPOINT)
+    request.tm.commit()
+
+    log.info('abandoned reindex into {}'.format(new_index))
+    return new_index
+
+
+def _reindex(session, es, request, settings, new_index, since, workers,
+             chunk_size, window_size):
+    indexer = BatchIndexer(session, es, request, target_index=new_index, op_type='create',
+                           chunk_size=chunk_size, window_size=window_size)
 
-        errored = indexer.index()
+    windows = index.windows(session, windowsize=window_size, since=since)
+    progress = _Progress(settings, request, windows)
+    if workers > 1:
+        _parallel_index(session, request, windows, new_index, workers,
+                        chunk_size, progress)
+    else:
+        for window in windows:
+            progress.record(window, *indexer.index_window(window))
+
+    errored = progress.errored
+    if errored:
+        log.debug('failed to index {} annotations, retrying...'.format(
+            len(errored)))
+        errored = indexer.index(errored)
         if errored:
-            log.debug('failed to index {} annotations, retrying...'.format(
-                len(errored)))
-            errored = indexer.index(errored)
-            if errored:
-                log.warn('failed to index {} annotations: {!r}'.format(
-                    len(errored),
-                    errored))
+            log.warn('failed to index {} annotations: {!r}'.format(
+                len(errored),
+                errored))
+
+    update_aliased_index(es, new_index)
+
+
+class _Progress(object):
+    """Checkpoints and logs the progress of a reindex as windows complete."""
+
+    def __init__(self, settings, request, windows):
+        self.settings = settings
+        self.request = request
+        self.windows = len(windows)
+        self.completed = 0
+        self.indexed = 0
+        self.errored = set()
+        self._then = time.time()
+
+    def record(self, window, count, errored):
+        self.completed += 1
+        self.indexed += count
+        self.errored.update(errored)
+
+        if window.end is not None:
+            self.settings.put(SETTING_CHECKPOINT,
+                              window.end.strftime(CHECKPOINT_FORMAT))
+            self.request.tm.commit()
+
+        rate = self.indexed / max(time.time() - self._then, 0.001)
+        log.info('indexed {:d} annotations ({:d}/{:d} windows), rate={:.0f}/s'
+                 .format(self.indexed, self.completed, self.windows, rate))
+
 
-        update_aliased_index(es, new_index)
+def _parallel_index(session, request, windows, target_index, workers, chunk_size,
+                    progress):
+    """
+    Index the given windows into `target_index` with a pool of processes.
 
+    The windows are handed out to the workers, and their results are passed
+    to `progress` in the order of the windows, so that the checkpoint is only
+    advanced past windows which have all been completed.
+    """
+    # The worker processes are forked, and mustn't share this process's
+    # database connections: close them, and let this process reconnect later.
+    session.close()
+    request.registry['sqlalchemy.engine'].dispose()
+
+    pool = multiprocessing.Pool(workers,
+                                initializer=_init_worker,
+                                initargs=(request, target_index, chunk_size))
+    try:
+        results = pool.imap(_index_window, windows)
+        for i, (count, errored) in enumerate(results):
+            progress.record(windows[i], count, errored)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
     finally:
-        settings.delete(SETTING_NEW_INDEX)
-        request.tm.commit()
+        pool.join()
+
+
+def _init_worker(request, target_index, chunk_size):
+    # Each worker gets its own database session and Elasticsearch connection.
+    global _worker_indexer
+    session = db.Session(bind=request.registry['sqlalchemy.engine'])
+    es = get_client(request.registry.settings)
+    _worker_indexer = BatchIndexer(session, es, request, target_index=target_index,
+                                   op_type='create', chunk_size=chunk_size)
+
+
+def _index_window(window):
+    try:
+        return _worker_indexer.index_window(window)
+    finally:
+        # Don't hold a transaction open, or the loaded annotations in memory,
+        # between windows.
+        _worker_indexer.session.close()
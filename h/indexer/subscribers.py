@@ -1,10 +1,16 @@
 # -*- coding: utf-8 -*-
 
-from h.tasks.indexer import add_annotation, delete_annotation
+from pyramid.settings import asbool
+
+from h.tasks.indexer import add_annotation, add_annotations, delete_annotation
 
 
 def subscribe_annotation_event(event):
     if event.action in ['create', 'update']:
-        add_annotation.delay(event.annotation_id)
+        settings = event.request.registry.settings
+        if asbool(settings.get('h.indexer.coalesce', False)):
+            add_annotations.delay(event.annotation_id)
+        else:
+            add_annotation.delay(event.annotation_id)
     elif event.action == 'delete':
         delete_annotation.delay(event.annotation_id)
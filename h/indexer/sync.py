@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+
+from h.indexer.reindexer import SETTING_NEW_INDEX
+from h.search.index import BatchIndexer
+
+
+def sync(session, es, request, since):
+    """
+    Catch the search index up with the annotations updated since a time.
+
+    This is for bringing the index back in line with the database after the
+    indexer has been down. If a reindex is running, the new index is caught
+    up as well.
+
+    :param since: the time to sync from
+    :type since: datetime.datetime
+
+    :returns: the number of annotations synced, and a set of errored ids
+    :rtype: tuple
+    """
+    target_indexes = [None]
+    new_index = request.find_service(name='settings').get(SETTING_NEW_INDEX)
+    if new_index is not None:
+        target_indexes.append(new_index)
+
+    count = 0
+    errored = set()
+    for target_index in target_indexes:
+        indexer = BatchIndexer(session, es, request, target_index=target_index)
+        synced, failed = indexer.sync(since)
+        count = max(count, synced)
+        errored.update(failed)
+
+    return (count, errored)
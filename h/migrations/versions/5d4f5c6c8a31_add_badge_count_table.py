@@ -0,0 +1,39 @@
+"""
+Add `badge_count` table
+
+Revision ID: 5d4f5c6c8a31
+Revises: 9bcc39244e82
+Create Date: 2026-10-16 21:30:12.518234
+"""
+
+from __future__ import unicode_literals
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = '5d4f5c6c8a31'
+down_revision = '9bcc39244e82'
+
+
+def upgrade():
+    op.create_table('badge_count',
+                    sa.Column('uri',
+                              sa.UnicodeText(),
+                              primary_key=True),
+                    sa.Column('count',
+                              sa.Integer,
+                              server_default='0',
+                              nullable=False),
+                    sa.Column('created',
+                              sa.DateTime,
+                              server_default=sa.func.now(),
+                              nullable=False),
+                    sa.Column('updated',
+                              sa.DateTime,
+                              server_default=sa.func.now(),
+                              nullable=False))
+
+
+def downgrade():
+    op.drop_table('badge_count')
@@ -0,0 +1,27 @@
+"""
+Add annotation.target_uri_normalized index
+
+Revision ID: a3b4c2e7d9f0
+Revises: 5d4f5c6c8a31
+Create Date: 2026-10-16 21:31:40.102933
+"""
+
+from __future__ import unicode_literals
+
+from alembic import op
+
+
+revision = 'a3b4c2e7d9f0'
+down_revision = '5d4f5c6c8a31'
+
+
+def upgrade():
+    op.execute('COMMIT')
+    op.create_index(op.f('ix__annotation_target_uri_normalized'),
+                    'annotation',
+                    ['target_uri_normalized'],
+                    postgresql_concurrently=True)
+
+
+def downgrade():
+    op.drop_index(op.f('ix__annotation_target_uri_normalized'), 'annotation')
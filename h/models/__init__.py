@@ -24,6 +24,7 @@ from h.models.annotation_moderation import AnnotationModeration
 from h.models.auth_client import AuthClient
 from h.models.auth_ticket import AuthTicket
 from h.models.authz_code import AuthzCode
+from h.models.badge_count import BadgeCount
 from h.models.blocklist import Blocklist
 from h.models.document import Document, DocumentMeta, DocumentURI
 from h.models.feature import Feature
@@ -42,6 +43,7 @@ __all__ = (
     'AuthClient',
     'AuthTicket',
     'AuthzCode',
+    'BadgeCount',
     'Blocklist',
     'Document',
     'DocumentMeta',
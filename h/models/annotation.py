@@ -33,6 +33,9 @@ class Annotation(Base):
         # references, pointing to the top-level annotation it refers to. We're
         # using 1 here because Postgres uses 1-based array indexing.
         sa.Index('ix__annotation_thread_root', sa.text('("references"[1])')),
+
+        # Used to count the annotations on a page for the badge.
+        sa.Index('ix__annotation_target_uri_normalized', 'target_uri_normalized'),
     )
 
     #: Annotation ID: these are stored as UUIDs in the database, and mapped
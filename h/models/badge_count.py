@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import sqlalchemy as sa
+
+from h.db import Base
+from h.db import mixins
+
+
+class BadgeCount(Base, mixins.Timestamps):
+
+    """
+    The number of public annotations on a page, as shown by the badge.
+
+    Counts are keyed by normalized URI and include the annotations on every
+    URI which refers to the same document. They are maintained by the indexer
+    as annotations change, and can be rebuilt with
+    ``hypothesis search badge-counts rebuild``. A URI with no row has no
+    public annotations.
+    """
+
+    __tablename__ = 'badge_count'
+
+    #: The normalized URI
+    uri = sa.Column(sa.UnicodeText(), primary_key=True)
+
+    #: The number of public annotations on the URI's document
+    count = sa.Column(sa.Integer, nullable=False, default=0, server_default='0')
+
+    def __repr__(self):
+        return '<BadgeCount uri=%s count=%d>' % (self.uri, self.count)
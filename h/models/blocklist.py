@@ -27,3 +27,16 @@ class Blocklist(Base):
         """Return True if the given URI is blocked."""
         uri_matches = expression.literal(uri).like(cls.uri)
         return session.query(cls).filter(uri_matches).count() > 0
+
+    @classmethod
+    def blocked(cls, session, uris):
+        """Return the set of the given URIs which are blocked."""
+        queries = []
+        for uri in set(uris):
+            uri = expression.literal(uri, sa.UnicodeText)
+            queries.append(session.query(uri.label('uri'))
+                                  .filter(uri.like(cls.uri)))
+        if not queries:
+            return set()
+        query = queries[0].union_all(*queries[1:])
+        return set(uri for uri, in query)
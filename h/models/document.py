@@ -13,10 +13,15 @@ from sqlalchemy.ext.hybrid import hybrid_property
 from h._compat import urlparse
 from h.db import Base, mixins
 from h.models.annotation import Annotation
+from h.util import uri_cache
 from h.util.uri import normalize as uri_normalize
 
 log = logging.getLogger(__name__)
 
+# The key in a session's `info` of the URIs whose cached expansions to drop
+# once the session's transaction commits
+_PENDING_URIS_KEY = 'h.models.document.pending_uris'
+
 
 class ConcurrentUpdateError(transaction.interfaces.TransientError):
     """Raised when concurrent updates to document data conflict."""
@@ -431,6 +436,8 @@ def merge_documents(session, documents, updated=None):
     except sa.exc.IntegrityError:
         raise ConcurrentUpdateError('concurrent document merges')
 
+    _invalidate_expanded_uris(session, master)
+
     return master
 
 
@@ -497,6 +504,7 @@ def update_document_metadata(session,
             **document_uri_dict)
 
     document.update_web_uri()
+    _invalidate_expanded_uris(session, document, target_uri)
 
     for document_meta_dict in document_meta_dicts:
         create_or_update_document_meta(
@@ -507,3 +515,32 @@ def update_document_metadata(session,
             **document_meta_dict)
 
     return document
+
+
+def _invalidate_expanded_uris(session, document, *uris):
+    """
+    Drop the cached expansions which the document's URIs may have changed.
+
+    They are dropped once the session's transaction commits, as until then
+    other requests would just cache the old expansions again. The URIs are
+    gathered now, as the session can't be used once it has committed.
+    """
+    pending = session.info.setdefault(_PENDING_URIS_KEY, set())
+    pending.update(uris)
+    pending.update(du.uri for du in document.document_uris)
+
+
+@sa.event.listens_for(sa.orm.Session, 'after_commit')
+def _invalidate_pending_uris(session):
+    # Committing a savepoint doesn't make the changes visible to others.
+    if session.transaction is not None and session.transaction.nested:
+        return
+    for uri in session.info.pop(_PENDING_URIS_KEY, ()):
+        uri_cache.EXPANDED_URIS.invalidate(uri)
+
+
+@sa.event.listens_for(sa.orm.Session, 'after_transaction_end')
+def _discard_pending_uris(session, transaction):
+    # Whatever is still pending when the transaction ends was rolled back.
+    if transaction.parent is None:
+        session.info.pop(_PENDING_URIS_KEY, None)
@@ -8,7 +8,14 @@ import math
 PAGE_SIZE = 20
 
 
-def paginate(request, total, page_size=PAGE_SIZE):
+def paginate(request, total, page_size=PAGE_SIZE, next_cursor=None):
+    """
+    Return page metadata for a paginated list of `total` results.
+
+    If `next_cursor` is given, the URL for the next page passes it as the
+    ``search_after`` parameter, so that the next page can be fetched without
+    skipping over the earlier ones.
+    """
     first = 1
     page_max = int(math.ceil(total / page_size))
     page_max = max(1, page_max)  # There's always at least one page.
@@ -72,7 +79,10 @@ def paginate(request, total, page_size=PAGE_SIZE):
 
     def url_for(page):
         query = request.params.dict_of_lists()
+        query.pop('search_after', None)
         query['page'] = page
+        if next_cursor is not None and page == next_:
+            query['search_after'] = next_cursor
         return request.current_route_path(_query=query)
 
     return {
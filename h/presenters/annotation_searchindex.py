@@ -8,9 +8,15 @@ from h.presenters.document_searchindex import DocumentSearchIndexPresenter
 
 class AnnotationSearchIndexPresenter(AnnotationBasePresenter):
 
-    """Present an annotation in the JSON format used in the search index."""
-    def __init__(self, annotation):
+    """
+    Present an annotation in the JSON format used in the search index.
+
+    The annotation's ``extra`` fields are only included if `include_extra` is
+    true, as indexes whose mapping predates them would map them dynamically.
+    """
+    def __init__(self, annotation, include_extra=False):
         self.annotation = annotation
+        self.include_extra = include_extra
 
     def asdict(self):
         docpresenter = DocumentSearchIndexPresenter(self.annotation.document)
@@ -29,9 +35,12 @@ class AnnotationSearchIndexPresenter(AnnotationBasePresenter):
             'shared': self.annotation.shared,
             'target': self.target,
             'document': docpresenter.asdict(),
-            'thread_ids': self.annotation.thread_ids
+            'thread_ids': self.annotation.thread_ids,
         }
 
+        if self.include_extra:
+            result['extra'] = self.annotation.extra or {}
+
         result['target'][0]['scope'] = [self.annotation.target_uri_normalized]
 
         if self.annotation.references:
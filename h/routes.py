@@ -104,6 +104,7 @@ def includeme(config):
     config.add_route('api.users', '/api/users')
     config.add_route('api.user', '/api/users/{username}')
     config.add_route('badge', '/api/badge')
+    config.add_route('badges', '/api/badges')
     config.add_route('token', '/api/token')
     config.add_route('oauth_authorize', '/oauth/authorize')
     config.add_route('oauth_revoke', '/oauth/revoke')
@@ -1,10 +1,16 @@
 # -*- coding: utf-8 -*-
 
+from h.search.cache import CACHE_KEY
+from h.search.cache import SearchCache
 from h.search.client import get_client
 from h.search.config import init
 from h.search.core import Search
 from h.search.core import FILTERS_KEY
 from h.search.core import MATCHERS_KEY
+from h.search.facets import FACETS_KEY
+from h.search.facets import FacetCache
+from h.search.profile import PROFILER_KEY
+from h.search.profile import QueryProfiler
 
 __all__ = (
     'Search',
@@ -39,3 +45,31 @@ def includeme(config):
         lambda r: r.registry['es.client'],
         name='es',
         reify=True)
+
+    # Optionally cache search responses in memory.
+    cache_size = int(settings.get('h.search.cache_size', 0))
+    if cache_size > 0:
+        cache_ttl = float(settings.get('h.search.cache_ttl', 30))
+        config.registry[CACHE_KEY] = SearchCache(maxsize=cache_size,
+                                                 ttl=cache_ttl)
+        config.add_subscriber('h.search.cache.subscribe_annotation_event',
+                              'h.events.AnnotationEvent')
+
+    # Optionally cache aggregation results in memory, refreshing them in the
+    # background.
+    facets_cache_size = int(settings.get('h.search.facets_cache_size', 0))
+    if facets_cache_size > 0:
+        facets_ttl = float(settings.get('h.search.facets_ttl', 600))
+        facets_refresh = float(settings.get('h.search.facets_refresh', 60))
+        config.registry[FACETS_KEY] = FacetCache(maxsize=facets_cache_size,
+                                                 ttl=facets_ttl,
+                                                 refresh=facets_refresh)
+
+    # Optionally log slow and sampled searches, and time their clauses.
+    slow_query_ms = settings.get('h.search.slow_query_ms')
+    sample_rate = float(settings.get('h.search.profile_sample_rate', 0))
+    if slow_query_ms is not None or sample_rate > 0:
+        if slow_query_ms is not None:
+            slow_query_ms = float(slow_query_ms)
+        config.registry[PROFILER_KEY] = QueryProfiler(slow_ms=slow_query_ms,
+                                                      sample_rate=sample_rate)
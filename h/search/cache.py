@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+
+"""
+An optional, process-wide cache of Elasticsearch search responses.
+
+Search traffic is heavily skewed towards a few popular URIs, mostly queried
+by anonymous users, so caching responses for even a short time saves many
+Elasticsearch round trips.
+
+Responses are cached against the built query body together with the caller's
+visibility context. An entry is dropped when an annotation on one of the URIs
+it searched is created, updated or deleted in this process, and in any case
+after a TTL, which also bounds how stale an entry can get from changes made in
+other processes.
+"""
+
+from collections import OrderedDict
+import json
+import threading
+import time
+
+from h import storage
+from h.util.lru import LRUCache
+
+# The registry key under which the cache is stored, if it is enabled
+CACHE_KEY = 'search.cache'
+
+
+class SearchCache(object):
+    """
+    A bounded, LRU cache of search responses with a TTL.
+
+    Each entry is stored with the set of normalized URIs (the "scopes") the
+    query was restricted to, or `None` if the query wasn't restricted by URI.
+    Invalidating a scope drops the entries for that scope and all the entries
+    without one.
+
+    Annotations are indexed asynchronously, so a query run just after an
+    annotation changed might not see the change yet. Responses for scopes
+    which changed less than `settle` seconds ago are therefore not cached.
+    """
+
+    def __init__(self, maxsize=1000, ttl=30, settle=5, clock=time.time):
+        self.ttl = ttl
+        self.settle = settle
+        self._clock = clock
+        self._lock = threading.Lock()
+        # Mapping of key to (expiry time, scopes, response)
+        self._entries = LRUCache(maxsize,
+                                 on_evict=lambda key, entry: self._unindex(key, entry[1]))
+        # Mapping of scope to the keys of the entries for that scope
+        self._keys_by_scope = {}
+        # Keys of the entries which aren't restricted by scope
+        self._unscoped = set()
+        # Mapping of recently changed scopes to when they changed, oldest first
+        self._changed = OrderedDict()
+        self._last_change = None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Return the cached response for `key`, or `None`."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > self._clock():
+                self.hits += 1
+                return entry[2]
+            if entry is not None:
+                self._entries.pop(key)
+                self._unindex(key, entry[1])
+            self.misses += 1
+            return None
+
+    def set(self, key, scopes, response):
+        """Cache `response` for `key`, unless its scopes recently changed."""
+        with self._lock:
+            now = self._clock()
+            if self._recently_changed(scopes, now):
+                return
+
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._unindex(key, old[1])
+
+            if scopes is None:
+                self._unscoped.add(key)
+            else:
+                for scope in scopes:
+                    self._keys_by_scope.setdefault(scope, set()).add(key)
+            # Index the entry first, so that it's unindexed if it's evicted.
+            self._entries[key] = (now + self.ttl, scopes, response)
+
+    def invalidate(self, scope):
+        """
+        Drop the entries which may be affected by a change to `scope`.
+
+        If `scope` is `None` all entries are dropped.
+        """
+        with self._lock:
+            now = self._clock()
+            self._last_change = now
+            if scope is None:
+                self._clear()
+                return
+
+            self._changed.pop(scope, None)
+            self._changed[scope] = now
+            while self._changed:
+                oldest, changed_at = next(iter(self._changed.items()))
+                if now - changed_at < self.settle:
+                    break
+                del self._changed[oldest]
+
+            keys = self._keys_by_scope.get(scope, set()) | self._unscoped
+            for key in list(keys):
+                entry = self._entries.pop(key, None)
+                if entry is not None:
+                    self._unindex(key, entry[1])
+
+    def clear(self):
+        with self._lock:
+            self._clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _clear(self):
+        self._entries.clear()
+        self._keys_by_scope.clear()
+        self._unscoped.clear()
+
+    def _recently_changed(self, scopes, now):
+        if scopes is None:
+            return (self._last_change is not None and
+                    now - self._last_change < self.settle)
+        for scope in scopes:
+            changed_at = self._changed.get(scope)
+            if changed_at is not None and now - changed_at < self.settle:
+                return True
+        return False
+
+    def _unindex(self, key, scopes):
+        if scopes is None:
+            self._unscoped.discard(key)
+            return
+        for scope in scopes:
+            keys = self._keys_by_scope.get(scope)
+            if keys is None:
+                continue
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_scope[scope]
+
+
+def cache_key(body, request):
+    """
+    Return the cache key for the query `body` made by `request`.
+
+    The key includes the caller's visibility context, so that responses are
+    never shared between callers who might be allowed to see different
+    annotations.
+    """
+    groups = sorted(p for p in request.effective_principals
+                    if p.startswith('group:'))
+    return json.dumps([body, request.authenticated_userid, groups],
+                      sort_keys=True)
+
+
+def query_scopes(body):
+    """
+    Return the normalized URIs the query `body` is restricted to.
+
+    Returns a frozenset, or `None` if the query isn't restricted by URI.
+    """
+    scopes = None
+    for clause in _walk(body):
+        terms = clause.get('terms')
+        if isinstance(terms, dict) and 'target.scope' in terms:
+            scopes = (scopes or frozenset()) | frozenset(terms['target.scope'])
+    return scopes
+
+
+def subscribe_annotation_event(event):
+    """Invalidate cached search responses affected by an annotation event."""
+    cache = event.request.registry.get(CACHE_KEY)
+    if cache is None:
+        return
+
+    with event.request.tm:
+        annotation = storage.fetch_annotation(event.request.db, event.annotation_id)
+        scope = None if annotation is None else annotation.target_uri_normalized
+
+    cache.invalidate(scope)
+
+
+def _walk(value):
+    if isinstance(value, dict):
+        yield value
+        for item in value.values():
+            for clause in _walk(item):
+                yield clause
+    elif isinstance(value, list):
+        for item in value:
+            for clause in _walk(item):
+                yield clause
@@ -105,6 +105,9 @@ ANNOTATION_MAPPING = {
         'document': {
             'enabled': False,  # not indexed
         },
+        'extra': {
+            'enabled': False,  # not indexed
+        },
         'group': {
             'type': 'string',
         },
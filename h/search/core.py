@@ -3,20 +3,50 @@ import logging
 from collections import namedtuple
 from contextlib import contextmanager
 
-from elasticsearch.exceptions import ConnectionTimeout
+from elasticsearch.exceptions import ConnectionTimeout, TransportError
+from webob.multidict import MultiDict
 
+from h.search import cache
+from h.search import facets
+from h.search import profile
 from h.search import query
 
 FILTERS_KEY = 'h.search.filters'
 MATCHERS_KEY = 'h.search.matchers'
 
+# The search parameters which apply to whole threads, and so to the replies
+# as well as to the top-level annotations.
+THREAD_PARAMS = ('uri', 'url', 'group')
+
 log = logging.getLogger(__name__)
 
-SearchResult = namedtuple('SearchResult', [
+
+class SearchResult(namedtuple('SearchResult', [
     'total',
     'annotation_ids',
     'reply_ids',
-    'aggregations'])
+    'aggregations',
+    'next',
+    'sources'])):
+    """
+    The results of a search.
+
+    ``next`` is an opaque cursor which can be passed as the ``search_after``
+    parameter to fetch the following page, or `None` if there are no more
+    results.
+
+    ``sources`` maps the IDs of the annotations and replies found to their
+    documents in the search index, if the search was asked to include them,
+    and is otherwise empty.
+    """
+
+    def __new__(cls, total, annotation_ids, reply_ids, aggregations, next=None,
+                sources=None):
+        if sources is None:
+            sources = {}
+        return super(SearchResult, cls).__new__(cls, total, annotation_ids,
+                                                reply_ids, aggregations, next,
+                                                sources)
 
 
 class Search(object):
@@ -34,12 +64,23 @@ class Search(object):
     :param stats: An optional statsd client to which some metrics will be
         published.
     :type stats: statsd.client.StatsClient
+
+    :param include_sources: Whether or not to fetch the indexed documents of
+        the annotations and replies found, and return them in the result's
+        ``sources``.
+    :type include_sources: bool
     """
-    def __init__(self, request, separate_replies=False, stats=None):
+    def __init__(self, request, separate_replies=False, stats=None,
+                 include_sources=False):
         self.request = request
         self.es = request.es
         self.separate_replies = separate_replies
         self.stats = stats
+        self.include_sources = include_sources
+        self._sources = {}
+        self.cache = request.registry.get(cache.CACHE_KEY)
+        self.facets = request.registry.get(facets.FACETS_KEY)
+        self.profiler = request.registry.get(profile.PROFILER_KEY)
 
         self.builder = default_querybuilder(request)
         self.reply_builder = default_querybuilder(request)
@@ -54,10 +95,42 @@ class Search(object):
         :returns: The search results
         :rtype: SearchResult
         """
-        total, annotation_ids, aggregations = self.search_annotations(params)
+        if self.separate_replies and _is_uri_scoped(params):
+            return self._search_threads(params)
+
+        total, annotation_ids, aggregations, next_ = self.search_annotations(params)
         reply_ids = self.search_replies(annotation_ids)
 
-        return SearchResult(total, annotation_ids, reply_ids, aggregations)
+        return SearchResult(total, annotation_ids, reply_ids, aggregations, next_,
+                            self._sources)
+
+    def count_all(self, params_list):
+        """
+        Count the annotations matching each of several searches at once.
+
+        The searches are run in one multi-search request, without fetching
+        any hits or aggregations.
+
+        :param params_list: the search parameters of each search
+        :type params_list: list of dict-like
+
+        :returns: the number of annotations matching each search, in order
+        :rtype: list of int
+        """
+        bodies = []
+        clauses = []
+        for params in params_list:
+            params = params.copy()
+            params['limit'] = 0
+            body = self.builder.build(params)
+            body['aggs'] = {}
+            bodies.append(body)
+            clauses.append(self.builder.clauses)
+
+        if not bodies:
+            return []
+        return [response['hits']['total']
+                for response in self._msearch(bodies, clauses)]
 
     def append_filter(self, filter_):
         """Append a search filter to the annotation and reply query."""
@@ -76,16 +149,21 @@ class Search(object):
         if self.separate_replies:
             self.builder.append_filter(query.TopLevelAnnotationsFilter())
 
-        response = None
-        with self._instrument():
-            response = self.es.conn.search(index=self.es.index,
-                                           doc_type=self.es.t.annotation,
-                                           _source=False,
-                                           body=self.builder.build(params))
-        total = response['hits']['total']
-        annotation_ids = [hit['_id'] for hit in response['hits']['hits']]
-        aggregations = self._parse_aggregation_results(response.get('aggregations', None))
-        return (total, annotation_ids, aggregations)
+        body = self._build(self.builder, params)
+        clauses = self.builder.clauses
+        if self.facets is None or not body['aggs']:
+            return self._annotation_results(body, self._search(body, clauses))
+
+        # Run the aggregations separately from the hits, so that they can be
+        # served from the facet cache.
+        facet_body = {'query': body['query'], 'size': 0, 'aggs': body['aggs']}
+        body = dict(body, aggs={})
+        total, annotation_ids, _, next_ = self._annotation_results(
+            body, self._search(body, clauses))
+        key = cache.cache_key(facet_body, self.request)
+        aggregations = self.facets.fetch(
+            key, lambda: self._aggregate(facet_body, clauses))
+        return (total, annotation_ids, aggregations, next_)
 
     def search_replies(self, annotation_ids):
         if not self.separate_replies:
@@ -93,20 +171,192 @@ class Search(object):
 
         self.reply_builder.append_matcher(query.RepliesMatcher(annotation_ids))
 
+        hits = self._all_hits(self.reply_builder, {'limit': query.LIMIT_MAX})
+        self._keep_sources(hits)
+        return [hit['_id'] for hit in hits]
+
+    def _search_threads(self, params):
+        """
+        Search for top-level annotations and their replies in one round trip.
+
+        Replies are made on the same URIs as the annotations they reply to, so
+        when the search is restricted by URI we can search for all the replies
+        on those URIs at the same time as the annotations, in one
+        multi-search request, and keep the replies to the annotations we
+        found. If there are more replies on the URIs than fit in one page of
+        results, we search for the replies to our annotations instead.
+        """
+        self.builder.append_filter(query.TopLevelAnnotationsFilter())
+        self.reply_builder.append_filter(query.RepliesFilter())
+
+        reply_params = MultiDict([(k, v) for k, v in params.items()
+                                  if k in THREAD_PARAMS])
+        reply_params['limit'] = query.LIMIT_MAX
+
+        body = self._build(self.builder, params)
+        reply_body = self.reply_builder.build(reply_params)
+        reply_body['_source'] = True if self.include_sources else ['references']
+        response, reply_response = self._msearch(
+            [body, reply_body], [self.builder.clauses, self.reply_builder.clauses])
+
+        total, annotation_ids, aggregations, next_ = self._annotation_results(body, response)
+
+        hits = reply_response['hits']['hits']
+        if len(hits) < reply_response['hits']['total']:
+            reply_ids = self.search_replies(annotation_ids)
+        else:
+            thread_ids = set(annotation_ids)
+            hits = [hit for hit in hits
+                    if thread_ids.intersection(hit.get('_source', {}).get('references', []))]
+            self._keep_sources(hits)
+            reply_ids = [hit['_id'] for hit in hits]
+
+        return SearchResult(total, annotation_ids, reply_ids, aggregations, next_,
+                            self._sources)
+
+    def _annotation_results(self, body, response):
+        total = response['hits']['total']
+        hits = response['hits']['hits']
+        annotation_ids = [hit['_id'] for hit in hits]
+        self._keep_sources(hits)
+        aggregations = self._parse_aggregation_results(response.get('aggregations', None))
+
+        next_ = None
+        if hits and body['from'] + len(hits) < total:
+            next_ = query.search_after_cursor(hits[-1])
+
+        return (total, annotation_ids, aggregations, next_)
+
+    def _build(self, builder, params):
+        body = builder.build(params)
+        if self.include_sources:
+            body['_source'] = True
+        return body
+
+    def _keep_sources(self, hits):
+        if not self.include_sources:
+            return
+        for hit in hits:
+            if '_source' in hit:
+                self._sources[hit['_id']] = hit['_source']
+
+    def _all_hits(self, builder, params):
+        """Return every hit for `params`, fetching one page at a time."""
+        params = params.copy()
+        response = self._search(self._build(builder, params), builder.clauses)
+
+        hits = []
+        while True:
+            page = response['hits']['hits']
+            hits.extend(page)
+
+            # When searching from a cursor, the total only counts the hits
+            # from the cursor on.
+            if not page or len(page) >= response['hits']['total']:
+                return hits
+
+            # Plain searches aren't sorted for paging with a cursor, and it's
+            # rare to need more than one page, so only then start over with
+            # an (empty) cursor.
+            if 'search_after' not in params:
+                params['search_after'] = ''
+                hits = []
+                response = self._search(self._build(builder, params), builder.clauses)
+                continue
+
+            cursor = query.search_after_cursor(page[-1])
+            if cursor is None:
+                log.warn("Could not fetch the next page of %d hits, as the "
+                         "last hit has no sort value.",
+                         response['hits']['total'])
+                return hits
+
+            params['search_after'] = cursor
+            response = self._search(self._build(builder, params), builder.clauses)
+
+    def _search(self, body, clauses=()):
+        key = None
+        if self.cache is not None:
+            key = cache.cache_key(body, self.request)
+            response = self.cache.get(key)
+            if response is not None:
+                self._incr('search.cache.hit')
+                return response
+            self._incr('search.cache.miss')
+
+        # Searches which don't ask for any _source fields don't get any.
+        source = {} if '_source' in body else {'_source': False}
+
+        response = None
+        with self._instrument():
+            response = self.es.conn.search(index=self.es.index,
+                                           doc_type=self.es.t.annotation,
+                                           body=body,
+                                           **source)
+        self._profile(body, response, clauses)
+
+        if self.cache is not None:
+            self.cache.set(key, cache.query_scopes(body), response)
+        return response
+
+    def _msearch(self, bodies, clauses=None):
+        """Run the searches in `bodies` in one request, and return the responses."""
+        if clauses is None:
+            clauses = [()] * len(bodies)
+        keys = [None] * len(bodies)
+        responses = [None] * len(bodies)
+        if self.cache is not None:
+            for i, body in enumerate(bodies):
+                keys[i] = cache.cache_key(body, self.request)
+                responses[i] = self.cache.get(keys[i])
+                self._incr('search.cache.hit' if responses[i] is not None
+                           else 'search.cache.miss')
+
+        missing = [i for i, response in enumerate(responses) if response is None]
+        if not missing:
+            return responses
+
+        request_body = []
+        for i in missing:
+            body = bodies[i]
+            if '_source' not in body:
+                body = dict(body, _source=False)
+            request_body.extend([{}, body])
+
+        result = None
+        with self._instrument():
+            result = self.es.conn.msearch(index=self.es.index,
+                                          doc_type=self.es.t.annotation,
+                                          body=request_body)
+
+        for i, response in zip(missing, result['responses']):
+            if 'error' in response:
+                raise TransportError('N/A', response['error'])
+            responses[i] = response
+            self._profile(bodies[i], response, clauses[i])
+            if self.cache is not None:
+                self.cache.set(keys[i], cache.query_scopes(bodies[i]), response)
+
+        return responses
+
+    def _aggregate(self, body, clauses=()):
+        # This may run in the background, after the request has finished, so
+        # it mustn't use the request.
         response = None
         with self._instrument():
             response = self.es.conn.search(index=self.es.index,
                                            doc_type=self.es.t.annotation,
-                                           _source=False,
-                                           body=self.reply_builder.build({'limit': 200}))
+                                           body=body)
+        self._profile(body, response, clauses)
+        return self._parse_aggregation_results(response.get('aggregations', None))
 
-        if len(response['hits']['hits']) < response['hits']['total']:
-            log.warn("The number of reply annotations exceeded the page size "
-                     "of the Elasticsearch query. We currently don't handle "
-                     "this, our search API doesn't support pagination of the "
-                     "reply set.")
+    def _profile(self, body, response, clauses):
+        if self.profiler is not None:
+            self.profiler.record(body, response, clauses, stats=self.stats)
 
-        return [hit['_id'] for hit in response['hits']['hits']]
+    def _incr(self, stat):
+        if self.stats:
+            self.stats.incr(stat)
 
     def _parse_aggregation_results(self, aggregations):
         if not aggregations:
@@ -159,3 +409,7 @@ def default_querybuilder(request):
     for factory in request.registry.get(MATCHERS_KEY, []):
         builder.append_matcher(factory(request))
     return builder
+
+
+def _is_uri_scoped(params):
+    return 'uri' in params or 'url' in params
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+"""
+An optional, process-wide cache of search aggregation ("facet") results.
+
+The activity pages show the top tags and users of the annotations they list.
+The terms aggregations behind those facets are much more expensive than the
+search for the page of hits, but their results change slowly. When the cache
+is enabled, :py:class:`h.search.core.Search` runs the aggregations as a
+separate query, keyed by the filter part of the search (without the paging
+parameters) and the caller's visibility context, and serves them from here.
+
+An entry is served for up to `ttl` seconds. Once it is older than `refresh`
+seconds, the next request for it is still served the cached results, and the
+aggregations are rerun in the background to replace them.
+"""
+
+from __future__ import unicode_literals
+
+import logging
+import threading
+import time
+
+from h.util.lru import LRUCache
+
+log = logging.getLogger(__name__)
+
+# The registry key under which the cache is stored, if it is enabled
+FACETS_KEY = 'search.facets'
+
+
+def _spawn_thread(func, *args):
+    thread = threading.Thread(target=func, args=args)
+    thread.daemon = True
+    thread.start()
+
+
+class FacetCache(object):
+    """
+    A bounded, LRU cache of aggregation results which refreshes stale entries
+    in the background.
+    """
+
+    def __init__(self, maxsize=1000, ttl=600, refresh=60, clock=time.time,
+                 spawn=_spawn_thread):
+        self.ttl = ttl
+        self.refresh = refresh
+        self._clock = clock
+        self._spawn = spawn
+        self._lock = threading.Lock()
+        # Mapping of key to (time fetched, aggregations)
+        self._entries = LRUCache(maxsize)
+        # Keys which are being refreshed in the background
+        self._refreshing = set()
+        self.hits = 0
+        self.misses = 0
+
+    def fetch(self, key, load):
+        """
+        Return the aggregations for `key`.
+
+        If there are no cached aggregations for `key`, or they have expired,
+        they are loaded by calling `load` and cached. If they are due a
+        refresh, they are returned and `load` is called in the background.
+        """
+        refresh = False
+        with self._lock:
+            now = self._clock()
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[0] < self.ttl:
+                self.hits += 1
+                if now - entry[0] >= self.refresh and key not in self._refreshing:
+                    self._refreshing.add(key)
+                    refresh = True
+            else:
+                entry = None
+                self.misses += 1
+
+        if entry is None:
+            aggregations = load()
+            self.set(key, aggregations)
+            return aggregations
+
+        if refresh:
+            self._spawn(self._refresh, key, load)
+        return entry[1]
+
+    def set(self, key, aggregations):
+        with self._lock:
+            self._entries[key] = (self._clock(), aggregations)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _refresh(self, key, load):
+        try:
+            self.set(key, load())
+        except Exception:
+            # Keep serving the cached aggregations until they expire.
+            log.exception('Failed to refresh cached search aggregations')
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
@@ -6,15 +6,17 @@ from __future__ import division, unicode_literals
 import logging
 import time
 from collections import namedtuple
+from datetime import datetime
 
 import sqlalchemy as sa
 from elasticsearch import helpers as es_helpers
+from pyramid.settings import asbool
 from sqlalchemy.orm import subqueryload
 
 from h import models
 from h import presenters
 from h.events import AnnotationTransformEvent
-from h.util.query import column_windows
+from h.util.query import column_window, column_window_bounds, column_windows
 
 log = logging.getLogger(__name__)
 
@@ -43,7 +45,8 @@ def index(es, annotation, request, target_index=None):
     :param target_index: the index name, uses default index if not given
     :type target_index: unicode
     """
-    presenter = presenters.AnnotationSearchIndexPresenter(annotation)
+    presenter = presenters.AnnotationSearchIndexPresenter(
+        annotation, include_extra=_index_extra(request))
     annotation_dict = presenter.asdict()
 
     event = AnnotationTransformEvent(request, annotation, annotation_dict)
@@ -89,17 +92,78 @@ def delete(es, annotation_id, target_index=None):
         id=annotation_id)
 
 
+def annotation_from_source(annotation_id, source):
+    """
+    Rebuild an annotation from its document in the search index.
+
+    The returned annotation is transient: it isn't loaded from or added to the
+    database session. It carries the fields which the API presenters and link
+    generators read, so it can be rendered without touching the database.
+
+    Documents indexed before the index presenter added the ``extra`` field
+    can't be rendered faithfully, and for those this returns `None`.
+
+    :param annotation_id: the annotation's ID (the hit's ``_id``)
+    :type annotation_id: unicode
+
+    :param source: the hit's ``_source``
+    :type source: dict
+
+    :rtype: h.models.Annotation or None
+    """
+    if 'extra' not in source:
+        return None
+
+    target = (source.get('target') or [{}])[0]
+
+    annotation = models.Annotation(
+        id=annotation_id,
+        created=_parse_iso8601(source.get('created')),
+        updated=_parse_iso8601(source.get('updated')),
+        userid=source.get('user'),
+        groupid=source.get('group'),
+        target_uri=source.get('uri'),
+        target_selectors=target.get('selector', []),
+        tags=source.get('tags'),
+        shared=source.get('shared'),
+        references=source.get('references', []),
+        extra=source['extra'],
+        deleted=False)
+    # Set the text directly, as rendering its markdown isn't needed here.
+    annotation._text = source.get('text')
+
+    document = source.get('document')
+    if document:
+        web_uri = document.get('web_uri')
+        annotation.document = models.Document(
+            title=(document.get('title') or [None])[0],
+            web_uri=web_uri,
+            document_uris=[models.DocumentURI(uri=web_uri)] if web_uri else [])
+
+    return annotation
+
+
+def _parse_iso8601(value):
+    # The inverse of h.util.datetime.utc_iso8601, giving a naive UTC datetime.
+    if value is None:
+        return None
+    return datetime.strptime(value[:-len('+00:00')], '%Y-%m-%dT%H:%M:%S.%f')
+
+
 class BatchIndexer(object):
     """
     A convenience class for reindexing all annotations from the database to
     the search index.
     """
 
-    def __init__(self, session, es_client, request, target_index=None, op_type='index'):
+    def __init__(self, session, es_client, request, target_index=None, op_type='index',
+                 chunk_size=ES_CHUNK_SIZE, window_size=PG_WINDOW_SIZE):
         self.session = session
         self.es_client = es_client
         self.request = request
         self.op_type = op_type
+        self.chunk_size = chunk_size
+        self.window_size = window_size
 
         # By default, index into the open index
         if target_index is None:
@@ -119,20 +183,82 @@ class BatchIndexer(object):
         """
         if not annotation_ids:
             annotations = _all_annotations(session=self.session,
-                                           windowsize=PG_WINDOW_SIZE)
+                                           windowsize=self.window_size)
         else:
             annotations = _filtered_annotations(session=self.session,
                                                 ids=annotation_ids)
 
         # Report indexing status as we go
-        annotations = _log_status(annotations, log_every=PG_WINDOW_SIZE)
+        annotations = _log_status(annotations, log_every=self.window_size)
+
+        return self.index_annotations(annotations)
+
+    def index_window(self, window):
+        """
+        Index the annotations last updated within a window.
+
+        :param window: the window to index, one of those returned by
+            :py:func:`windows`
+        :type window: h.search.index.Window
+
+        :returns: the number of annotations indexed, and a set of errored ids
+        :rtype: tuple
+        """
+        annotations = (_eager_loaded_annotations(self.session)
+                       .filter(_annotation_filter())
+                       .filter(column_window(models.Annotation.updated,
+                                             window.start,
+                                             window.end)))
+        return self._bulk(annotations)
+
+    def sync(self, since):
+        """
+        Bring the index up to date with the annotations updated since a time.
+
+        Annotations last updated at or after `since` are indexed, and those
+        among them which have been deleted are marked as deleted, as
+        :py:func:`delete` does. Deleted annotations which have already been
+        purged from the database can't be found, and aren't marked.
+
+        :param since: the time to sync from
+        :type since: datetime.datetime
+
+        :returns: the number of annotations synced, and a set of errored ids
+        :rtype: tuple
+        """
+        updated_since = models.Annotation.updated >= since
+        windows = column_windows(session=self.session,
+                                 column=models.Annotation.updated,
+                                 windowsize=self.window_size,
+                                 where=updated_since)
+        query = _eager_loaded_annotations(self.session).filter(updated_since)
+        annotations = (a for window in windows for a in query.filter(window))
+        return self._bulk(annotations)
+
+    def index_annotations(self, annotations):
+        """
+        Index annotations which have already been loaded.
+
+        :param annotations: the annotations to index, which should have been
+            loaded with :py:func:`fetch_annotations` or similar, so that
+            presenting them doesn't query the database
+        :type annotations: iterable of h.models.Annotation
 
+        :returns: a set of errored ids
+        :rtype: set
+        """
+        _, errored = self._bulk(annotations)
+        return errored
+
+    def _bulk(self, annotations):
         indexing = es_helpers.streaming_bulk(self.es_client.conn, annotations,
-                                             chunk_size=ES_CHUNK_SIZE,
+                                             chunk_size=self.chunk_size,
                                              raise_on_error=False,
                                              expand_action_callback=self._prepare)
+        count = 0
         errored = set()
         for ok, item in indexing:
+            count += 1
             if not ok:
                 status = item[self.op_type]
 
@@ -141,13 +267,17 @@ class BatchIndexer(object):
                     continue
 
                 errored.add(status['_id'])
-        return errored
+        return (count, errored)
 
     def _prepare(self, annotation):
         action = {self.op_type: {'_index': self._target_index,
                                  '_type': self.es_client.t.annotation,
                                  '_id': annotation.id}}
-        data = presenters.AnnotationSearchIndexPresenter(annotation).asdict()
+        if annotation.deleted:
+            return (action, {'deleted': True})
+
+        data = presenters.AnnotationSearchIndexPresenter(
+            annotation, include_extra=_index_extra(self.request)).asdict()
 
         event = AnnotationTransformEvent(self.request, annotation, data)
         self.request.registry.notify(event)
@@ -155,6 +285,50 @@ class BatchIndexer(object):
         return (action, data)
 
 
+def _index_extra(request):
+    # Indexing the extra fields needs the mapping which doesn't index them,
+    # so this is only turned on once that's been applied.
+    return asbool(request.registry.settings.get('h.search.index_extra'))
+
+
+def fetch_annotations(session, ids):
+    """
+    Load the annotations with the given ids for indexing, in one query.
+
+    Deleted annotations are skipped, and the data which the index presenter
+    needs is eager-loaded.
+
+    :rtype: list of h.models.Annotation
+    """
+    if not ids:
+        return []
+    return list(_filtered_annotations(session=session, ids=ids))
+
+
+def windows(session, windowsize=PG_WINDOW_SIZE, since=None):
+    """
+    Split the annotations to index into windows of `updated` times.
+
+    Each window holds about `windowsize` annotations. The windows can be
+    passed to other processes, and indexed with
+    :py:meth:`BatchIndexer.index_window`.
+
+    :param since: if given, only annotations last updated at or after this
+        time are included
+    :type since: datetime.datetime
+
+    :rtype: list of h.search.index.Window
+    """
+    where = _annotation_filter()
+    if since is not None:
+        where = sa.and_(where, models.Annotation.updated >= since)
+    bounds = column_window_bounds(session=session,
+                                  column=models.Annotation.updated,
+                                  windowsize=windowsize,
+                                  where=where)
+    return [Window(start, end) for start, end in bounds]
+
+
 def _all_annotations(session, windowsize=2000):
     # This is using a windowed query for loading all annotations in batches.
     # It is the most performant way of loading a big set of records from
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+"""
+Optional profiling of the searches sent to Elasticsearch.
+
+When it is enabled, :py:class:`h.search.core.Search` reports every search it
+sends to Elasticsearch (but not those answered by the search cache) to a
+:py:class:`QueryProfiler`, which:
+
+- logs the body, time taken and hit count of searches which took at least
+  `slow_ms` milliseconds,
+- logs the same for a random sample of the other searches, and
+- records the time taken by each search as a statsd timer for its "shape":
+  the combination of filters, matchers and aggregations in it, and whether
+  it was paginated with a cursor.
+
+A search's time can't be split between its clauses, and most filters are in
+every search, so a timer per clause would just repeat the overall timings.
+Instead, the cost of a clause shows up as the difference between the timers
+of two shapes which only differ by that clause, for example
+``search.query.shape.AuthFilter-DeletedFilter-UriFilter`` and
+``search.query.shape.AuthFilter-DeletedFilter-TagsMatcher-UriFilter``.
+
+The times are those Elasticsearch reports in the responses' ``took`` field,
+so they don't include the round trip to Elasticsearch.
+"""
+
+from __future__ import unicode_literals
+
+import json
+import logging
+import random
+
+log = logging.getLogger(__name__)
+
+# The registry key under which the profiler is stored, if it is enabled
+PROFILER_KEY = 'search.profiler'
+
+
+class QueryProfiler(object):
+    """Logs slow and sampled searches, and times them by their shape."""
+
+    def __init__(self, slow_ms=None, sample_rate=0, random=random.random):
+        self.slow_ms = slow_ms
+        self.sample_rate = sample_rate
+        self._random = random
+
+    def record(self, body, response, clauses=(), stats=None):
+        """
+        Record a search's response.
+
+        :param body: the body of the search
+        :type body: dict
+
+        :param response: the search's response from Elasticsearch
+        :type response: dict
+
+        :param clauses: the names of the filters and matchers in the search
+        :type clauses: list of unicode
+
+        :param stats: an optional statsd client to record the timings to
+        :type stats: statsd.client.StatsClient
+        """
+        took = response.get('took', 0)
+        total = response.get('hits', {}).get('total', 0)
+        name = shape(body, clauses)
+
+        if self.slow_ms is not None and took >= self.slow_ms:
+            log.warning('Slow search took %dms and found %d hits [%s]: %s',
+                        took, total, name, _dumps(body))
+        elif self.sample_rate and self._random() < self.sample_rate:
+            log.info('Sampled search took %dms and found %d hits [%s]: %s',
+                     took, total, name, _dumps(body))
+
+        if stats:
+            stats.timing('search.query.shape.{}'.format(name), took)
+
+
+def shape(body, clauses=()):
+    """
+    Return the name of the shape of the search with `body` and `clauses`.
+
+    This is the sorted names of the search's filters, matchers and
+    aggregations, joined by hyphens, followed by "cursor" if it was
+    paginated with a cursor, or "all" if it had none of these.
+    """
+    names = sorted(set(clauses))
+    names.extend('aggs_{}'.format(key) for key in sorted(body.get('aggs') or {}))
+    if 'post_filter' in body:
+        names.append('cursor')
+    return '-'.join(names) or 'all'
+
+
+def _dumps(body):
+    return json.dumps(body, sort_keys=True, default=repr)
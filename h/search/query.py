@@ -1,5 +1,8 @@
 # -*- coding: utf-8 -*-
 
+import base64
+import json
+
 from h import storage
 from h.util import uri
 
@@ -18,6 +21,10 @@ class Builder(object):
         self.matchers = []
         self.aggregations = []
 
+        # The names of the filters and matchers which contributed to the most
+        # recently built query, for profiling.
+        self.clauses = []
+
     def append_filter(self, f):
         self.filters.append(f)
 
@@ -34,10 +41,14 @@ class Builder(object):
         p_from = extract_offset(params)
         p_size = extract_limit(params)
         p_sort = extract_sort(params)
+        p_search_after = extract_search_after(params)
 
         filters = [f(params) for f in self.filters]
         matchers = [m(params) for m in self.matchers]
         aggregations = {a.key: a(params) for a in self.aggregations}
+        self.clauses = [_clause_name(c) for c, q in zip(self.filters + self.matchers,
+                                                        filters + matchers)
+                        if q is not None]
         filters = [f for f in filters if f is not None]
         matchers = [m for m in matchers if m is not None]
 
@@ -58,7 +69,7 @@ class Builder(object):
                 }
             }
 
-        return {
+        body = {
             "from": p_from,
             "size": p_size,
             "sort": p_sort,
@@ -66,6 +77,20 @@ class Builder(object):
             "aggs": aggregations,
         }
 
+        # The cursor is applied as a post filter, so that it only restricts
+        # the hits and not the aggregations.
+        if p_search_after is not None:
+            body["from"] = 0
+            body["post_filter"] = search_after_filter(p_sort, p_search_after)
+
+        return body
+
+
+def _clause_name(clause):
+    # Filters and matchers are usually instances of the classes below, but
+    # those registered by other packages may be plain functions.
+    return getattr(clause, '__name__', None) or type(clause).__name__
+
 
 def extract_offset(params):
     try:
@@ -91,12 +116,78 @@ def extract_limit(params):
 
 
 def extract_sort(params):
-    return [{
-        params.pop("sort", "updated"): {
-            "ignore_unmapped": True,
-            "order": params.pop("order", "desc"),
-        }
-    }]
+    order = params.pop("order", "desc")
+    sort = [
+        {
+            params.pop("sort", "updated"): {
+                "ignore_unmapped": True,
+                "order": order,
+            }
+        },
+    ]
+
+    # When paginating with a cursor (even an empty one, which asks for the
+    # first page), break ties by document, so that the order is stable and a
+    # cursor identifies a unique position in it. Sorting on _uid loads it
+    # into memory for the whole index, so other searches don't.
+    if "search_after" in params:
+        sort.append({"_uid": {"order": order}})
+
+    return sort
+
+
+def extract_search_after(params):
+    """
+    Return the sort values encoded in the ``search_after`` cursor, or `None`.
+
+    Malformed cursors are ignored, and the first page is returned instead.
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(str(params.pop("search_after"))))
+    except (KeyError, TypeError, ValueError):
+        return None
+
+    if not isinstance(values, list) or len(values) != 2:
+        return None
+
+    return values
+
+
+def search_after_cursor(hit):
+    """
+    Return an opaque cursor for the results which follow `hit`.
+
+    The cursor encodes the hit's sort values, and can be passed back as the
+    ``search_after`` parameter of a search with the same sort to fetch the
+    next page of results. Returns `None` if the hit has no sort value, or
+    wasn't found by a search which passed ``search_after``.
+    """
+    values = hit.get("sort")
+    if not values or len(values) != 2 or values[0] is None:
+        return None
+
+    return base64.urlsafe_b64encode(json.dumps(values))
+
+
+def search_after_filter(sort, values):
+    """
+    Return a filter which matches the results after the `values` cursor.
+
+    ``search_after`` isn't available in our version of Elasticsearch, so this
+    filters on the sort field and the ``_uid`` tiebreaker instead, which lets
+    Elasticsearch skip earlier results rather than collecting and sorting
+    them as it does for ``from``.
+    """
+    (field, options), = sort[0].items()
+    value, uid = values
+    op = "lt" if options["order"] == "desc" else "gt"
+    return {"or": [
+        {"range": {field: {op: value}}},
+        {"and": [
+            {"term": {field: value}},
+            {"range": {"_uid": {op: uid}}},
+        ]},
+    ]}
 
 
 class TopLevelAnnotationsFilter(object):
@@ -107,6 +198,14 @@ class TopLevelAnnotationsFilter(object):
         return {'missing': {'field': 'references'}}
 
 
+class RepliesFilter(object):
+
+    """Matches replies only, filters out top-level annotations."""
+
+    def __call__(self, _):
+        return {'exists': {'field': 'references'}}
+
+
 class AuthFilter(object):
 
     """
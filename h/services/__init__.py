@@ -4,6 +4,9 @@
 
 from __future__ import unicode_literals
 
+from h.services.group import CACHE_KEY as GROUPIDS_CACHE_KEY
+from h.services.group import GroupidsCache
+
 
 def includeme(config):
     config.register_service_factory('.annotation_json_presentation.annotation_json_presentation_service_factory',
@@ -14,6 +17,7 @@ def includeme(config):
                                     iface='pyramid_authsanity.interfaces.IAuthService')
     config.register_service_factory('.auth_token.auth_token_service_factory', name='auth_token')
     config.register_service_factory('.authority_group.authority_group_factory', name='authority_group')
+    config.register_service_factory('.badge_count.badge_count_service_factory', name='badge_count')
     config.register_service_factory('.developer_token.developer_token_service_factory', name='developer_token')
     config.register_service_factory('.feature.feature_service_factory', name='feature')
     config.register_service_factory('.flag.flag_service_factory', name='flag')
@@ -35,3 +39,11 @@ def includeme(config):
     config.add_request_method('.feature.FeatureRequestProperty',
                               name='feature',
                               reify=True)
+
+    # Optionally cache the pubids of the groups users can read or created.
+    settings = config.registry.settings
+    groupids_cache_size = int(settings.get('h.groups.cache_size', 0))
+    if groupids_cache_size > 0:
+        groupids_cache_ttl = float(settings.get('h.groups.cache_ttl', 30))
+        config.registry[GROUPIDS_CACHE_KEY] = GroupidsCache(maxsize=groupids_cache_size,
+                                                            ttl=groupids_cache_ttl)
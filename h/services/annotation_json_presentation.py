@@ -10,6 +10,7 @@ from h import presenters
 from h import resources
 from h import storage
 from h.interfaces import IGroupService
+from h.search import index
 
 
 class AnnotationJSONPresentationService(object):
@@ -35,21 +36,44 @@ class AnnotationJSONPresentationService(object):
         presenter = self._get_presenter(annotation_resource)
         return presenter.asdict()
 
-    def present_all(self, annotation_ids):
-        def eager_load_documents(query):
-            return query.options(
-                subqueryload(models.Annotation.document))
-
-        annotations = storage.fetch_ordered_annotations(
-            self.session, annotation_ids, query_processor=eager_load_documents)
+    def present_all(self, annotation_ids, sources=None):
+        """
+        Present the annotations with the given IDs, in order.
+
+        If `sources` maps some of the IDs to the annotations' documents in the
+        search index, those annotations are rendered from their documents
+        rather than loaded from the database. The formatters still load their
+        own data.
+        """
+        sources = sources or {}
+        annotations = {}
+        for id_ in annotation_ids:
+            if id_ not in sources:
+                continue
+            annotation = index.annotation_from_source(id_, sources[id_])
+            if annotation is not None:
+                annotations[id_] = annotation
+
+        missing_ids = [id_ for id_ in annotation_ids if id_ not in annotations]
+        if missing_ids:
+            annotations.update((ann.id, ann) for ann in
+                               self._fetch_annotations(missing_ids))
 
         # preload formatters, so they can optimize database access
         for formatter in self.formatters:
             formatter.preload(annotation_ids)
 
         return [self.present(
-                    resources.AnnotationResource(ann, self.group_svc, self.links_svc))
-                for ann in annotations]
+                    resources.AnnotationResource(annotations[id_], self.group_svc, self.links_svc))
+                for id_ in annotation_ids if id_ in annotations]
+
+    def _fetch_annotations(self, annotation_ids):
+        def eager_load_documents(query):
+            return query.options(
+                subqueryload(models.Annotation.document))
+
+        return storage.fetch_ordered_annotations(
+            self.session, annotation_ids, query_processor=eager_load_documents)
 
     def _get_presenter(self, annotation_resource):
         return presenters.AnnotationJSONPresenter(annotation_resource,
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import sqlalchemy as sa
+
+from h import storage
+from h.models import Annotation, BadgeCount, DocumentURI, Group, User
+from h.models.group import ReadableBy
+from h.util import uri as uri_util
+
+# The first key of the advisory locks taken while recounting a page, so that
+# they don't collide with any other advisory locks on the database.
+LOCK_NAMESPACE = 0x4bad9e
+
+
+class BadgeCountService(object):
+    """
+    A service for the per-page public annotation counts shown by the badge.
+
+    The badge shows the number of annotations on a page which an anonymous
+    user could find by searching for its URI: shared annotations in
+    world-readable groups by users who aren't NIPSA'd, on any URI which
+    refers to the same document. Those counts are stored by normalized URI,
+    so that the badge can be answered with a single primary key lookup.
+    """
+
+    def __init__(self, session):
+        self.session = session
+
+    def count(self, uri):
+        """Return the number of public annotations on the page at `uri`."""
+        count = self.session.query(BadgeCount.count) \
+                            .filter_by(uri=uri_util.normalize(uri)) \
+                            .scalar()
+        return count or 0
+
+    def counts(self, uris):
+        """
+        Return the number of public annotations on each of the pages at `uris`.
+
+        :returns: a mapping of each URI to its count
+        :rtype: dict
+        """
+        keys = dict((uri, uri_util.normalize(uri)) for uri in uris)
+        if not keys:
+            return {}
+        counts = dict(self.session.query(BadgeCount.uri, BadgeCount.count)
+                                  .filter(BadgeCount.uri.in_(set(keys.values()))))
+        return dict((uri, counts.get(key, 0)) for uri, key in keys.items())
+
+    def update(self, annotations):
+        """
+        Recount the pages which the given annotations are on.
+
+        This recounts the annotations' target URIs and the other URIs of
+        their documents, whose counts include them. The documents' URIs are
+        loaded in one query for all the annotations.
+
+        :param annotations: the annotations which have changed
+        :type annotations: iterable of h.models.Annotation
+        """
+        uris = set()
+        document_ids = set()
+        for annotation in annotations:
+            uris.add(annotation.target_uri)
+            if annotation.document_id is not None:
+                document_ids.add(annotation.document_id)
+
+        if document_ids:
+            uris.update(uri for uri, in
+                        self.session.query(DocumentURI.uri)
+                                    .filter(DocumentURI.document_id.in_(document_ids))
+                                    .distinct())
+
+        self.refresh(uris)
+
+    def refresh(self, uris):
+        """
+        Recount the pages at `uris`.
+
+        Each page is locked for the rest of the transaction before it's
+        recounted, so concurrent refreshes of the same page take turns and the
+        last count stored is always the most recent one. Pages whose URIs
+        expand to the same set of URIs, such as those of one document, are
+        only counted once.
+        """
+        keys = {}
+        for uri in uris:
+            keys.setdefault(uri_util.normalize(uri), uri)
+
+        counts = {}
+
+        # Lock the pages in a consistent order so that concurrent refreshes
+        # can't deadlock.
+        for key in sorted(keys):
+            self._lock(key)
+            expanded = frozenset(self._expand(keys[key]))
+            if expanded not in counts:
+                counts[expanded] = self._public_annotations() \
+                    .filter(Annotation.target_uri_normalized.in_(expanded)) \
+                    .count()
+            self._store(key, counts[expanded])
+
+    def rebuild(self):
+        """
+        Recount every page with public annotations from scratch.
+
+        The table is locked against writes until the transaction ends, so
+        that refreshes wait for the rebuild rather than interleaving their
+        counts with it. Reads of the counts carry on as usual.
+
+        :returns: the number of pages with public annotations
+        :rtype: int
+        """
+        self.session.execute('LOCK TABLE badge_count IN EXCLUSIVE MODE')
+        self.session.query(BadgeCount).delete(synchronize_session=False)
+
+        annotations = self._public_annotations().subquery()
+        raw_counts = dict(
+            self.session.query(annotations.c.target_uri_normalized,
+                               sa.func.count(annotations.c.id))
+                        .group_by(annotations.c.target_uri_normalized))
+
+        uris = set(uri for uri, in
+                   self.session.query(annotations.c.target_uri).distinct())
+        document_ids = self.session.query(annotations.c.document_id)
+        uris.update(uri for uri, in
+                    self.session.query(DocumentURI.uri)
+                                .filter(DocumentURI.document_id.in_(document_ids))
+                                .distinct())
+
+        counts = {}
+        for uri in uris:
+            key = uri_util.normalize(uri)
+            if key in counts:
+                continue
+            counts[key] = sum(raw_counts.get(u, 0) for u in self._expand(uri))
+
+        self.session.add_all([BadgeCount(uri=key, count=count)
+                              for key, count in counts.items() if count])
+        return sum(1 for count in counts.values() if count)
+
+    def _expand(self, uri):
+        # The counts are stored, so don't let them go stale along with a
+        # cached expansion.
+        return set(uri_util.normalize(u)
+                   for u in storage.expand_uri(self.session, uri, cached=False))
+
+    def _public_annotations(self):
+        world_readable = self.session.query(Group.pubid) \
+                                     .filter(Group.readable_by == ReadableBy.world)
+        # Filter out NIPSA'd users' annotations in the database, rather than
+        # loading their userids for every recount.
+        nipsa_userids = self.session.query(
+            sa.func.concat('acct:', User.username, '@', User.authority)) \
+            .filter(User.nipsa.is_(True))
+        return self.session.query(Annotation) \
+                           .filter(Annotation.deleted.is_(False),
+                                   Annotation.shared.is_(True),
+                                   Annotation.groupid.in_(world_readable),
+                                   Annotation.userid.notin_(nipsa_userids))
+
+    def _lock(self, key):
+        # Postgres 9.4 has no INSERT ... ON CONFLICT, so serialize the writes
+        # to each page's count with a transaction-level advisory lock instead.
+        self.session.execute(sa.select([
+            sa.func.pg_advisory_xact_lock(LOCK_NAMESPACE, sa.func.hashtext(key))
+        ]))
+
+    def _store(self, key, count):
+        # Callers must hold the page's lock (see `_lock`), or a concurrent
+        # insert of the same page could fail on its unique key.
+        if not count:
+            self.session.query(BadgeCount) \
+                        .filter_by(uri=key) \
+                        .delete(synchronize_session=False)
+            return
+
+        updated = self.session.query(BadgeCount) \
+                              .filter_by(uri=key) \
+                              .update({'count': count},
+                                      synchronize_session=False)
+        if not updated:
+            self.session.add(BadgeCount(uri=key, count=count))
+
+
+def badge_count_service_factory(context, request):
+    """Return a BadgeCountService instance for the passed context and request."""
+    return BadgeCountService(session=request.db)
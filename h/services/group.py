@@ -1,12 +1,19 @@
 # -*- coding: utf-8 -*-
 
 from functools import partial
+import logging
+import os
+import threading
+import time
 
+from pyramid.settings import asbool
 import sqlalchemy as sa
 
+from h import realtime
 from h import session
 from h.models import Annotation, Group, User
 from h.models.group import JoinableBy, ReadableBy, WriteableBy
+from h.util.lru import LRUCache
 
 GROUP_ACCESS_FLAGS = {
     'private': {
@@ -21,22 +28,140 @@ GROUP_ACCESS_FLAGS = {
     }
 }
 
+# The registry key under which the group pubids cache is stored, if it is
+# enabled
+CACHE_KEY = 'groups.cache'
+
+log = logging.getLogger(__name__)
+
+
+def _spawn_thread(func, *args):
+    thread = threading.Thread(target=func, args=args)
+    thread.daemon = True
+    thread.start()
+
+
+class GroupidsCache(object):
+
+    """
+    A process-wide cache of the pubids of the groups users can read or created.
+
+    Every search filters by the groups the user can read, and by the groups
+    they created, which costs two queries per search. The results are cached
+    here by userid for at most `ttl` seconds and up to `maxsize` entries.
+
+    The group service invalidates a user's entries once a change to their
+    memberships is committed, and all entries once a world-readable group is
+    created. If enabled, other processes drop a user's entries when they
+    receive the "group-join" and "group-leave" events published on the
+    realtime user topic for the change (see :py:meth:`listen`). Those events
+    are published before the change is committed, so the TTL bounds how stale
+    entries can get when another process reloads them in between, when an
+    event is missed, and after a world-readable group is created elsewhere.
+    """
+
+    def __init__(self, maxsize=10000, ttl=30, clock=time.time,
+                 spawn=_spawn_thread):
+        self.ttl = ttl
+        self._clock = clock
+        self._spawn = spawn
+        self._lock = threading.Lock()
+        # Mapping of (kind, userid) to (expiry time, pubids)
+        self._entries = LRUCache(maxsize)
+        # Incremented on every invalidation, so that pubids loaded while one
+        # happens aren't stored
+        self._generation = 0
+        # The process which is consuming group membership events, if any
+        self._listener_pid = None
+
+    def fetch(self, kind, userid, load):
+        """Return the cached `kind` pubids for `userid`, loading them if needed."""
+        key = (kind, userid)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > self._clock():
+                return list(entry[1])
+            generation = self._generation
+
+        pubids = load()
+        with self._lock:
+            if self._generation != generation:
+                return pubids
+            self._entries[key] = (self._clock() + self.ttl, tuple(pubids))
+        return pubids
+
+    def invalidate(self, userid):
+        """Drop the cached pubids for `userid`."""
+        with self._lock:
+            self._generation += 1
+            for key in [k for k in self._entries if k[1] == userid]:
+                self._entries.pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def listen(self, settings):
+        """
+        Consume group membership events in the background.
+
+        This starts a thread consuming the realtime user topic, once per
+        process, which invalidates the entries of users who join or leave a
+        group in other processes. It must be called after the process forks,
+        and is only called by :py:func:`groups_factory` when the
+        ``h.groups.cache_listen`` setting is enabled.
+        """
+        pid = os.getpid()
+        with self._lock:
+            if self._listener_pid == pid:
+                return
+            self._listener_pid = pid
+        self._spawn(self._consume, settings)
+
+    def handle_user_event(self, message):
+        """Invalidate the entries affected by a realtime user event."""
+        if message.get('type') in ('group-join', 'group-leave'):
+            self.invalidate(message['userid'])
+
+    def _consume(self, settings):
+        consumer = realtime.Consumer(connection=realtime.get_connection(settings),
+                                     routing_key='user',
+                                     handler=self.handle_user_event)
+        try:
+            consumer.run()
+        except Exception:
+            log.exception('stopped consuming group membership events')
+        with self._lock:
+            self._listener_pid = None
+
+    def __len__(self):
+        return len(self._entries)
+
 
 class GroupService(object):
 
     """A service for manipulating groups and group membership."""
 
-    def __init__(self, session, user_fetcher, publish=None):
+    def __init__(self, session, user_fetcher, publish=None, cache=None,
+                 after_commit=None):
         """
         Create a new groups service.
 
         :param session: the SQLAlchemy session object
         :param user_fetcher: a callable for fetching users by userid
         :param publish: a callable for publishing events
+        :param cache: an optional :py:class:`GroupidsCache` for the readable
+            and created group pubids
+        :param after_commit: an optional callable which arranges for the
+            callable it is passed to be called once the current transaction
+            commits. Cached pubids are invalidated straight away without it.
         """
         self.session = session
         self.user_fetcher = user_fetcher
         self.publish = publish
+        self.cache = cache
+        self.after_commit = after_commit
 
     def create(self, name, authority, userid, description=None, type_='private'):
         """
@@ -68,6 +193,12 @@ class GroupService(object):
         self.session.add(group)
         self.session.flush()
 
+        if self.cache is not None:
+            if group.is_public:
+                self._on_commit(self.cache.clear)
+            else:
+                self._on_commit(self.cache.invalidate, userid)
+
         if self.publish:
             self.publish('group-join', group.pubid, userid)
 
@@ -82,6 +213,9 @@ class GroupService(object):
 
         group.members.append(user)
 
+        if self.cache is not None:
+            self._on_commit(self.cache.invalidate, userid)
+
         if self.publish:
             self.publish('group-join', group.pubid, userid)
 
@@ -94,6 +228,9 @@ class GroupService(object):
 
         group.members.remove(user)
 
+        if self.cache is not None:
+            self._on_commit(self.cache.invalidate, userid)
+
         if self.publish:
             self.publish('group-leave', group.pubid, userid)
 
@@ -104,13 +241,11 @@ class GroupService(object):
         If the passed-in user is ``None``, this returns the list of
         world-readable groups.
         """
-        readable = (Group.readable_by == ReadableBy.world)
-
-        if user is not None:
-            readable_member = sa.and_(Group.readable_by == ReadableBy.members, Group.members.any(User.id == user.id))
-            readable = sa.or_(readable, readable_member)
-
-        return [record.pubid for record in self.session.query(Group.pubid).filter(readable)]
+        if self.cache is not None:
+            userid = user.userid if user is not None else None
+            return self.cache.fetch('readable', userid,
+                                    lambda: self._groupids_readable_by(user))
+        return self._groupids_readable_by(user)
 
     def groupids_created_by(self, user):
         """
@@ -121,15 +256,55 @@ class GroupService(object):
         if user is None:
             return []
 
+        if self.cache is not None:
+            return self.cache.fetch('created', user.userid,
+                                    lambda: self._groupids_created_by(user))
+        return self._groupids_created_by(user)
+
+    def _on_commit(self, func, *args):
+        # Other requests can't see a change until it's committed, so wait
+        # until then to invalidate cached pubids, lest they cache the old ones
+        # again.
+        if self.after_commit is None:
+            func(*args)
+        else:
+            self.after_commit(partial(func, *args))
+
+    def _groupids_readable_by(self, user):
+        readable = (Group.readable_by == ReadableBy.world)
+
+        if user is not None:
+            readable_member = sa.and_(Group.readable_by == ReadableBy.members, Group.members.any(User.id == user.id))
+            readable = sa.or_(readable, readable_member)
+
+        return [record.pubid for record in self.session.query(Group.pubid).filter(readable)]
+
+    def _groupids_created_by(self, user):
         return [g.pubid for g in self.session.query(Group.pubid).filter_by(creator=user)]
 
 
 def groups_factory(context, request):
     """Return a GroupService instance for the passed context and request."""
     user_service = request.find_service(name='user')
+    cache = request.registry.get(CACHE_KEY)
+    after_commit = None
+    if cache is not None:
+        after_commit = partial(_after_commit, request)
+        if asbool(request.registry.settings.get('h.groups.cache_listen')):
+            cache.listen(request.registry.settings)
     return GroupService(session=request.db,
                         user_fetcher=user_service.fetch,
-                        publish=partial(_publish, request))
+                        publish=partial(_publish, request),
+                        cache=cache,
+                        after_commit=after_commit)
+
+
+def _after_commit(request, func):
+    # The hook runs once the session is closed, so `func` mustn't use it.
+    def hook(success):
+        if success:
+            func()
+    request.tm.get().addAfterCommitHook(hook)
 
 
 def _publish(request, event_type, groupid, userid):
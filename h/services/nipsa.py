@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 
+from functools import partial
+
 from h.models import User
 from h.tasks.indexer import reindex_user_annotations
 
@@ -11,8 +13,15 @@ class NipsaService(object):
     (NIPSA) flags on userids.
     """
 
-    def __init__(self, session):
+    def __init__(self, session, publish=None):
+        """
+        Create a new NIPSA service.
+
+        :param session: the SQLAlchemy session object
+        :param publish: a callable for publishing NIPSA change events
+        """
         self.session = session
+        self.publish = publish
         self._flagged_userids = None
 
     @property
@@ -42,6 +51,9 @@ class NipsaService(object):
         user.nipsa = True
         reindex_user_annotations.delay(user.userid)
 
+        if self.publish:
+            self.publish(user.userid, True)
+
     def unflag(self, user):
         """
         Remove the NIPSA flag for a user.
@@ -53,10 +65,29 @@ class NipsaService(object):
         user.nipsa = False
         reindex_user_annotations.delay(user.userid)
 
+        if self.publish:
+            self.publish(user.userid, False)
+
     def clear(self):
         self._flagged_userids = None
 
 
 def nipsa_factory(context, request):
     """Return a NipsaService instance for the passed context and request."""
-    return NipsaService(request.db)
+    return NipsaService(request.db, publish=partial(_publish, request))
+
+
+def _publish(request, userid, nipsa):
+    # Other processes reload the flag when they get this, so only send it once
+    # the change is committed. The session can't be used by then, so the
+    # message is built now.
+    message = {
+        'type': 'nipsa-change',
+        'userid': userid,
+        'nipsa': nipsa,
+    }
+
+    def hook(success):
+        if success:
+            request.realtime.publish_user(message)
+    request.tm.get().addAfterCommitHook(hook)
@@ -24,6 +24,7 @@ from pyramid import i18n
 from h import models, schemas
 from h.db import types
 from h.models.document import update_document_metadata
+from h.util import uri_cache
 
 _ = i18n.TranslationStringFactory(__package__)
 
@@ -211,7 +212,7 @@ def delete_annotation(session, id_):
     annotation.deleted = True
 
 
-def expand_uri(session, uri):
+def expand_uri(session, uri, cached=True):
     """
     Return all URIs which refer to the same underlying document as `uri`.
 
@@ -219,15 +220,33 @@ def expand_uri(session, uri):
     passed URI, and if so returns the set of all URIs which we currently
     believe refer to the same document.
 
+    Expansions are cached for a short time in :py:mod:`h.util.uri_cache`.
+    Callers which must see the latest document records, for example to store
+    something derived from them, should pass ``cached=False``.
+
     :param session: the database session
     :type session: sqlalchemy.orm.session.Session
 
     :param uri: a URI associated with the document
     :type uri: str
 
+    :param cached: whether to use (and populate) the expansion cache
+    :type cached: bool
+
     :returns: a list of equivalent URIs
     :rtype: list
     """
+    if not cached:
+        return _expand_uri(session, uri)
+
+    expanded = uri_cache.EXPANDED_URIS.get(uri)
+    if expanded is None:
+        expanded = _expand_uri(session, uri)
+        uri_cache.EXPANDED_URIS.set(uri, expanded)
+    return expanded
+
+
+def _expand_uri(session, uri):
     doc = models.Document.find_by_uris(session, [uri]).one_or_none()
 
     if doc is None:
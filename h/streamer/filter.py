@@ -1,11 +1,11 @@
 # -*- coding: utf-8 -*-
 
-import copy
 import operator
 import unicodedata
+import weakref
 
-from jsonpointer import resolve_pointer
-from h._compat import text_type
+from jsonpointer import JsonPointer, JsonPointerException
+from h._compat import string_types, text_type
 
 SCHEMA = {
     "type": "object",
@@ -41,8 +41,23 @@ SCHEMA = {
 
 
 class FilterHandler(object):
+    """
+    A compiled streamer filter.
+
+    Filters are compiled once, when they are received from the client: clause
+    values are case- and accent-folded, JSON pointers are parsed and operators
+    are bound to callables. Matching then only has to resolve and fold field
+    values, which is done at most once per target when the target is wrapped
+    in a :py:class:`FilterTarget` shared between filters.
+
+    Raises :py:exc:`ValueError` if the filter contains malformed clauses.
+    """
+
     def __init__(self, filter_json):
         self.filter = filter_json
+        self.actions = filter_json['actions']
+        self.clauses = [_compile_clause(c) for c in filter_json['clauses']]
+        self.match_policy = getattr(self, filter_json['match_policy'])
 
     # operators
     operators = {
@@ -63,102 +78,256 @@ class FilterHandler(object):
     }
 
     def evaluate_clause(self, clause, target):
-        if isinstance(clause['field'], list):
-            for field in clause['field']:
-                copied = copy.deepcopy(clause)
-                copied['field'] = field
-                result = self.evaluate_clause(copied, target)
-                if result:
-                    return True
-            return False
-        else:
-            field_value = resolve_pointer(target, clause['field'], None)
-            if field_value is None:
-                return False
-
-            cval = clause['value']
-            fval = field_value
-
-            if isinstance(cval, list):
-                tval = []
-                for cv in cval:
-                    tval.append(uni_fold(cv))
-                cval = tval
-            else:
-                cval = uni_fold(cval)
-
-            if isinstance(fval, list):
-                tval = []
-                for fv in fval:
-                    tval.append(uni_fold(fv))
-                fval = tval
-            else:
-                fval = uni_fold(fval)
-
-            reversed_order = False
-            # Determining operator order
-            # Normal order: field_value, clause['value']
-            # i.e. condition created > 2000.01.01
-            # Here clause['value'] = '2001.01.01'.
-            # The field_value is target['created']
-            # So the natural order is: ge(field_value, clause['value']
-
-            # But!
-            # Reversed operator order for contains (b in a)
-            if isinstance(cval, list) or isinstance(fval, list):
-                if clause['operator'] in ['one_of', 'matches']:
-                    reversed_order = True
-                    # But not in every case. (i.e. tags matches 'b')
-                    # Here field_value is a list, because an annotation can
-                    # have many tags.
-                    if isinstance(field_value, list):
-                        reversed_order = False
-
-            if reversed_order:
-                lval = cval
-                rval = fval
-            else:
-                lval = fval
-                rval = cval
-
-            op = getattr(operator, self.operators[clause['operator']])
-            return op(lval, rval)
+        if not isinstance(target, FilterTarget):
+            target = FilterTarget(target)
+        if not isinstance(clause, CompiledClause):
+            clause = _compile_clause(clause)
+        return clause.evaluate(target)
 
     # match_policies
     def include_any(self, target):
-        for clause in self.filter['clauses']:
-            if self.evaluate_clause(clause, target):
+        for clause in self.clauses:
+            if clause.evaluate(target):
                 return True
         return False
 
     def include_all(self, target):
-        for clause in self.filter['clauses']:
-            if not self.evaluate_clause(clause, target):
+        for clause in self.clauses:
+            if not clause.evaluate(target):
                 return False
         return True
 
     def exclude_all(self, target):
-        for clause in self.filter['clauses']:
-            if not self.evaluate_clause(clause, target):
+        for clause in self.clauses:
+            if not clause.evaluate(target):
                 return True
         return False
 
     def exclude_any(self, target):
-        for clause in self.filter['clauses']:
-            if self.evaluate_clause(clause, target):
+        for clause in self.clauses:
+            if clause.evaluate(target):
                 return False
         return True
 
     def match(self, target, action=None):
-        if not action or action == 'past' or action in self.filter['actions']:
-            if len(self.filter['clauses']) > 0:
-                return getattr(self, self.filter['match_policy'])(target)
+        if not action or action == 'past' or action in self.actions:
+            if len(self.clauses) > 0:
+                if not isinstance(target, FilterTarget):
+                    target = FilterTarget(target)
+                return self.match_policy(target)
             else:
                 return True
         else:
             return False
 
 
+class FilterTarget(object):
+    """
+    A document to be matched against filters.
+
+    Resolves and folds the values of fields in the document on first access
+    and caches them, so that the work is shared between all the filters the
+    document is matched against.
+    """
+
+    def __init__(self, document):
+        self.document = document
+        self._values = {}
+
+    def get(self, field, pointer):
+        """Return the folded value of `field`, or None if it is missing."""
+        try:
+            return self._values[field]
+        except KeyError:
+            value = _fold(pointer.resolve(self.document, None))
+            self._values[field] = value
+            return value
+
+
+class CompiledClause(object):
+    """A filter clause, ready to be evaluated against a FilterTarget."""
+
+    def __init__(self, fields, operator_, value, reversible):
+        # A list of (field, parsed JSON pointer) pairs
+        self.fields = fields
+        self.operator = operator_
+        self.value = value
+        self.reversible = reversible
+
+    def evaluate(self, target):
+        for field, pointer in self.fields:
+            field_value = target.get(field, pointer)
+            if field_value is None:
+                continue
+
+            # Determining operator order
+            # Normal order: field_value, clause['value']
+            # i.e. condition created > 2000.01.01
+            # Here clause['value'] = '2001.01.01'.
+            # The field_value is target['created']
+            # So the natural order is: ge(field_value, clause['value']
+            #
+            # But!
+            # Reversed operator order for contains (b in a), when the clause
+            # value is a list. But not in every case: if the field value is
+            # itself a list (i.e. tags matches 'b') the order is normal.
+            if self.reversible and not isinstance(field_value, list):
+                result = self.operator(self.value, field_value)
+            else:
+                result = self.operator(field_value, self.value)
+
+            if result:
+                return True
+        return False
+
+
+def _compile_clause(clause):
+    try:
+        fields = clause['field']
+        if not isinstance(fields, list):
+            fields = [fields]
+        fields = [(f, JsonPointer(f)) for f in fields]
+        operator_name = clause['operator']
+        operator_ = getattr(operator, FilterHandler.operators[operator_name])
+        value = _fold(clause['value'])
+    except (AttributeError, JsonPointerException, KeyError, TypeError) as exc:
+        raise ValueError('invalid filter clause: {!r}'.format(exc))
+
+    reversible = (operator_name in ['one_of', 'matches'] and
+                  isinstance(value, list))
+    return CompiledClause(fields, operator_, value, reversible)
+
+
+def _fold(value):
+    if isinstance(value, list):
+        return [uni_fold(v) for v in value]
+    return uni_fold(value)
+
+
+class FilterIndex(object):
+    """
+    An index of subscribers keyed by the URIs their filters can match.
+
+    Most filters sent by clients restrict matches to a handful of (expanded)
+    document URIs. Indexing subscribers by those URIs means that an event only
+    needs to be checked against the subscribers which could possibly match its
+    target URI, rather than against every subscriber. Subscribers with filters
+    which can't be reduced to a set of URIs are kept in a fallback bucket and
+    are always considered.
+
+    Subscribers are held by weak reference, so they drop out of the index when
+    they are garbage collected.
+    """
+
+    def __init__(self):
+        self._by_uri = {}
+        self._fallback = weakref.WeakSet()
+        self._keys = weakref.WeakKeyDictionary()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, subscriber):
+        return subscriber in self._keys
+
+    def add(self, subscriber, filter_json):
+        """Index `subscriber` under the URIs that `filter_json` can match."""
+        self.remove(subscriber)
+
+        keys = indexable_uris(filter_json)
+        if keys is None:
+            self._fallback.add(subscriber)
+            keys = frozenset()
+        for key in keys:
+            self._by_uri.setdefault(key, weakref.WeakSet()).add(subscriber)
+        self._keys[subscriber] = keys
+
+    def remove(self, subscriber):
+        """Remove `subscriber` from the index, if present."""
+        keys = self._keys.pop(subscriber, None)
+        if keys is None:
+            return
+        self._fallback.discard(subscriber)
+        for key in keys:
+            bucket = self._by_uri.get(key)
+            if bucket is None:
+                continue
+            bucket.discard(subscriber)
+            if not bucket:
+                del self._by_uri[key]
+
+    def lookup(self, uri):
+        """
+        Return the set of indexed subscribers which could match `uri`.
+
+        This is the subscribers indexed under `uri` together with those in the
+        fallback bucket, so it costs time in proportion to their number rather
+        than to the number of subscribers in the index.
+        """
+        candidates = set(self._fallback)
+        bucket = self._by_uri.get(uri_key(uri))
+        if bucket is not None:
+            candidates.update(bucket)
+        return candidates
+
+
+def indexable_uris(filter_json):
+    """
+    Return the set of URI keys which `filter_json` is restricted to.
+
+    Returns None if the filter could match an annotation on any URI, in which
+    case it can't be indexed by URI.
+    """
+    clauses = filter_json.get('clauses', [])
+    policy = filter_json.get('match_policy')
+    if not clauses:
+        return None
+
+    uri_sets = [_clause_uris(clause) for clause in clauses]
+
+    if policy == 'include_all':
+        # Every clause must match, so a single URI clause restricts the filter.
+        restricted = [uris for uris in uri_sets if uris is not None]
+        if not restricted:
+            return None
+        return frozenset.intersection(*restricted)
+
+    if policy == 'include_any':
+        # Any clause may match, so every clause must be a URI clause.
+        if any(uris is None for uris in uri_sets):
+            return None
+        return frozenset.union(*uri_sets)
+
+    return None
+
+
+def uri_key(uri):
+    """Return the index key for `uri`, as compared by filter clauses."""
+    return uni_fold(uri)
+
+
+def _clause_uris(clause):
+    if clause.get('field') != '/uri':
+        return None
+
+    value = clause.get('value')
+    operator_ = clause.get('operator')
+
+    # "equals" compares the whole field value, and "one_of" is a membership
+    # test when the clause value is a list (but a substring test otherwise).
+    if operator_ == 'equals':
+        values = value if isinstance(value, list) else [value]
+    elif operator_ == 'one_of' and isinstance(value, list):
+        values = value
+    else:
+        return None
+
+    if not all(isinstance(v, string_types) for v in values):
+        return None
+
+    return frozenset(uri_key(v) for v in values)
+
+
 def first_of(a, b):
     return a[0] == b
 setattr(operator, 'first_of', first_of)
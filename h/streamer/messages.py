@@ -1,7 +1,11 @@
 # -*- coding: utf-8 -*-
 
-from collections import namedtuple
+import binascii
+from collections import deque, namedtuple
+import json
 import logging
+import os
+import time
 
 from gevent.queue import Full
 
@@ -15,6 +19,8 @@ from h.services.links import LinksService
 from h.services.nipsa import NipsaService
 from h.services.groupfinder import GroupfinderService
 from h.streamer import websocket
+from h.streamer.filter import FilterTarget
+from h.util import uri_cache
 import h.sentry
 import h.stats
 
@@ -27,6 +33,110 @@ log = logging.getLogger(__name__)
 Message = namedtuple('Message', ['topic', 'payload'])
 
 
+class NipsaCache(object):
+    """
+    The set of NIPSA'd userids, held in memory for the life of the process.
+
+    The set is loaded from the database on first use and then kept up to date
+    by the "nipsa-change" events published on the user topic, so that handling
+    an annotation event doesn't have to query the database. As a safety net
+    against missed events, the set is reloaded once it is `max_age` seconds
+    old.
+    """
+
+    def __init__(self, max_age=300, clock=time.time):
+        self.max_age = max_age
+        self._clock = clock
+        self._userids = None
+        self._loaded_at = None
+
+    def is_flagged(self, session, userid):
+        """Return whether the given userid is flagged as "NIPSA"."""
+        if self._userids is None or self._expired():
+            self._userids = set(NipsaService(session).flagged_userids)
+            self._loaded_at = self._clock()
+        return userid in self._userids
+
+    def update(self, userid, nipsa):
+        """Record a change to the NIPSA flag of the given userid."""
+        if self._userids is None:
+            return
+        if nipsa:
+            self._userids.add(userid)
+        else:
+            self._userids.discard(userid)
+
+    def clear(self):
+        self._userids = None
+        self._loaded_at = None
+
+    def _expired(self):
+        return self._clock() - self._loaded_at >= self.max_age
+
+
+# NIPSA'd userids, shared by all the messages handled by this process
+NIPSA_CACHE = NipsaCache()
+
+
+class EventLog(object):
+    """
+    A bounded, in-memory log of recent annotation events.
+
+    Each annotation event handled by the process is given a sequence id, which
+    increases monotonically and is sent to clients along with the id of the
+    log (the "stream"). A client which reconnects can send back the stream and
+    sequence id of the last notification it saw, and be sent the matching
+    events it missed, as long as they are still in the log.
+
+    Stream ids are random, so a client which reconnects to a different
+    streamer process, or to one which has restarted, can't resume from a
+    position in another log.
+    """
+
+    def __init__(self, maxlen=1000, stream=None):
+        if stream is None:
+            stream = binascii.hexlify(os.urandom(8)).decode('ascii')
+        self.stream = stream
+        self.seq = 0
+        self._events = deque()
+        self._maxlen = maxlen
+        # The highest sequence id which has been evicted from the log
+        self._evicted = 0
+
+    def next_seq(self):
+        """Allocate a new sequence id."""
+        self.seq += 1
+        return self.seq
+
+    def append(self, seq, message):
+        """Record the event `message`, which was given sequence id `seq`."""
+        self._events.append((seq, message))
+        while len(self._events) > self._maxlen:
+            self._evicted = self._events.popleft()[0]
+
+    def since(self, stream, seq):
+        """
+        Return the events after sequence id `seq`, in order.
+
+        Returns a list of `(seq, message)` tuples, or `None` if the position
+        is not in this log or events after it have already been evicted.
+        """
+        if stream != self.stream:
+            return None
+        if not isinstance(seq, int) or isinstance(seq, bool):
+            return None
+        if seq < self._evicted or seq > self.seq:
+            return None
+        return [(s, m) for s, m in self._events if s > seq]
+
+    def __len__(self):
+        return len(self._events)
+
+
+# Recent annotation events, for replay to clients which reconnect
+EVENT_LOG = EventLog()
+
+
 def process_messages(settings, routing_key, work_queue, raise_error=True):
     """
     Configure, start, and monitor a realtime consumer for the specified
@@ -63,12 +173,11 @@ def handle_message(message, settings, session, topic_handlers):
     """
     Deserialize and process a message from the reader.
 
-    For each message, `handler` is called with the deserialized message and a
-    single :py:class:`h.streamer.WebSocket` instance, and should return the
-    message to be sent to the client on that socket. The handler can return
-    `None`, to signify that no message should be sent, or a JSON-serializable
-    object. It is assumed that there is a 1:1 request-reply mapping between
-    incoming messages and messages to be sent out over the websockets.
+    For each message, `handler` is called with the deserialized message and
+    `None` in place of a list of :py:class:`h.streamer.WebSocket` instances,
+    meaning that the handler should pick the connected sockets which it needs
+    to notify itself. It is assumed that there is a 1:1 request-reply mapping
+    between incoming messages and messages to be sent out over the websockets.
     """
     try:
         handler = topic_handlers[message.topic]
@@ -76,35 +185,120 @@ def handle_message(message, settings, session, topic_handlers):
         raise RuntimeError("Don't know how to handle message from topic: "
                            "{}".format(message.topic))
 
-    # N.B. We iterate over a non-weak list of instances because there's nothing
-    # to stop connections being added or dropped during iteration, and if that
-    # happens Python will throw a "Set changed size during iteration" error.
-    sockets = list(websocket.WebSocket.instances)
-    handler(message.payload, sockets, settings, session)
+    handler(message.payload, None, settings, session)
 
 
 def handle_annotation_event(message, sockets, settings, session):
-    id_ = message['annotation_id']
-    annotation = storage.fetch_annotation(session, id_)
+    """
+    Notify sockets about annotation event `message`.
+
+    If `sockets` is `None`, only the sockets whose filters could match the
+    annotation's URI are considered, as looked up in the subscription index.
+    """
+    seq = EVENT_LOG.next_seq()
+    renderer = _notify_annotation_event(message, seq, sockets, settings, session)
+
+    if renderer is None or message['action'] == 'read':
+        return
+
+    # Saving an annotation may change which URIs refer to its document.
+    if message['action'] in ('create', 'update'):
+        uri_cache.EXPANDED_URIS.invalidate(renderer.target_uri)
+
+    # Log the presented annotation along with the event if it was rendered, so
+    # that replaying the event doesn't need to touch the database.
+    snapshot = renderer.snapshot()
+    if snapshot is not None:
+        message = dict(message, annotation=snapshot)
+    EVENT_LOG.append(seq, message)
+
+
+def replay_annotation_events(socket, settings, session):
+    """
+    Send a resuming client the annotation events it missed.
 
-    if annotation is None:
-        log.warn('received annotation event for missing annotation: %s', id_)
+    If the client has asked to resume from a position in the event log (see
+    :py:class:`EventLog`) and has set a filter, the logged events after that
+    position which match its filter are sent to it. If the events can't be
+    replayed, the client is sent a "resume-failed" message, so that it can
+    fall back to querying the API.
+    """
+    resume_from = getattr(socket, 'resume_from', None)
+    if resume_from is None or socket.filter is None:
         return
+    socket.resume_from = None
+
+    events = None
+    if isinstance(resume_from, dict):
+        events = EVENT_LOG.since(resume_from.get('stream'),
+                                 resume_from.get('seq'))
+    if events is None:
+        socket.send_json({'type': 'resume-failed'})
+        return
+
+    for seq, message in events:
+        _notify_annotation_event(message, seq, [socket], settings, session)
 
-    nipsa_service = NipsaService(session)
-    user_nipsad = nipsa_service.is_flagged(annotation.userid)
 
-    authority = text_type(settings.get('h.authority', 'localhost'))
-    group_service = GroupfinderService(session, authority)
+def _notify_annotation_event(message, seq, sockets, settings, session):
+    """
+    Send the notifications about annotation event `message` to `sockets`.
+
+    If `sockets` is `None`, the notifications are sent to the sockets
+    subscribed to the annotation's URI.
+
+    Returns the renderer used for the event, or None if the annotation could
+    not be found.
+    """
+    snapshot = message.get('annotation')
+
+    if snapshot is not None:
+        renderer = SnapshotEventRenderer(snapshot,
+                                         stream=EVENT_LOG.stream,
+                                         seq=seq)
+    else:
+        id_ = message['annotation_id']
+        annotation = storage.fetch_annotation(session, id_)
+
+        if annotation is None:
+            log.warn('received annotation event for missing annotation: %s', id_)
+            return None
+
+        authority = text_type(settings.get('h.authority', 'localhost'))
+        group_service = GroupfinderService(session, authority)
+        renderer = AnnotationEventRenderer(annotation,
+                                           group_service,
+                                           stream=EVENT_LOG.stream,
+                                           seq=seq)
+
+    user_nipsad = NIPSA_CACHE.is_flagged(session, renderer.userid)
+
+    # Only consider sockets whose filters could match the annotation's URI,
+    # without visiting every connected socket.
+    if sockets is None:
+        sockets = websocket.WebSocket.subscriptions.lookup(renderer.target_uri)
 
     for socket in sockets:
-        reply = _generate_annotation_event(message, socket, annotation, user_nipsad, group_service)
+        reply = _generate_annotation_event(message, socket, renderer, user_nipsad)
         if reply is None:
             continue
-        socket.send_json(reply)
+        socket.send_raw(reply)
+
+    return renderer
 
 
 def handle_user_event(message, sockets, settings, session):
+    # NIPSA changes update this process's state and aren't sent to clients.
+    if message.get('type') == 'nipsa-change':
+        NIPSA_CACHE.update(message['userid'], message['nipsa'])
+        return
+
+    # N.B. We iterate over a non-weak list of instances because there's nothing
+    # to stop connections being added or dropped during iteration, and if that
+    # happens Python will throw a "Set changed size during iteration" error.
+    if sockets is None:
+        sockets = list(websocket.WebSocket.instances)
+
     for socket in sockets:
         reply = _generate_user_event(message, socket)
         if reply is None:
@@ -112,7 +306,108 @@ def handle_user_event(message, sockets, settings, session):
         socket.send_json(reply)
 
 
-def _generate_annotation_event(message, socket, annotation, user_nipsad, group_service):
+class AnnotationEventRenderer(object):
+    """
+    Render the notifications for a single annotation event.
+
+    Neither the presented annotation nor the notification sent about it
+    depend on the socket that will receive it, so each is computed once per
+    event and shared between all recipients. Encoded notifications are cached
+    by action, so that every matching socket is sent the same bytes, and the
+    presented annotation is wrapped in a single
+    :py:class:`h.streamer.filter.FilterTarget` so that field values are only
+    folded once for all socket filters.
+
+    If given, the `stream` and `seq` of the event in the :py:class:`EventLog`
+    are included in the notifications, so that clients can resume from it.
+    """
+
+    def __init__(self, annotation, group_service, stream=None, seq=None):
+        self.annotation = annotation
+        self.group_service = group_service
+        self.id = annotation.id
+        self.userid = annotation.userid
+        self.target_uri = annotation.target_uri
+        self.stream = stream
+        self.seq = seq
+        self._serialized = {}
+        self._encoded = {}
+
+    def serialized(self, registry):
+        """Return the annotation as presented by the API."""
+        # All sockets normally share the application registry, but links are
+        # generated using the registry's settings, so key on it anyway.
+        key = id(registry)
+        if key not in self._serialized:
+            serialized = self._present(registry)
+            self._serialized[key] = (serialized, FilterTarget(serialized))
+        return self._serialized[key][0]
+
+    def filter_target(self, registry):
+        """Return the presented annotation, prepared for filter matching."""
+        self.serialized(registry)
+        return self._serialized[id(registry)][1]
+
+    def snapshot(self):
+        """Return the presented annotation, if it has been rendered."""
+        for serialized, _ in self._serialized.values():
+            return serialized
+        return None
+
+    def notification(self, action, registry):
+        """Return the JSON-encoded notification for `action`."""
+        key = (action, id(registry))
+        if key not in self._encoded:
+            if action == 'delete':
+                payload = [{'id': self.id}]
+            else:
+                payload = [self.serialized(registry)]
+            notification = {
+                'type': 'annotation-notification',
+                'options': {'action': action},
+                'payload': payload,
+            }
+            if self.seq is not None:
+                notification['stream'] = self.stream
+                notification['seq'] = self.seq
+            self._encoded[key] = json.dumps(notification)
+        return self._encoded[key]
+
+    def _present(self, registry):
+        base_url = registry.settings.get('h.app_url', 'http://localhost:5000')
+        links_service = LinksService(base_url, registry)
+        resource = AnnotationResource(self.annotation,
+                                      self.group_service,
+                                      links_service)
+        return presenters.AnnotationJSONPresenter(resource).asdict()
+
+
+class SnapshotEventRenderer(AnnotationEventRenderer):
+    """
+    Render the notifications for an annotation event from a snapshot.
+
+    The snapshot is the annotation as presented by the API, embedded in the
+    event by its publisher, so rendering it doesn't touch the database.
+    """
+
+    def __init__(self, snapshot, stream=None, seq=None):
+        self._snapshot = snapshot
+        self.id = snapshot['id']
+        self.userid = snapshot['user']
+        self.target_uri = snapshot['uri']
+        self.stream = stream
+        self.seq = seq
+        self._serialized = {}
+        self._encoded = {}
+
+    def snapshot(self):
+        return self._snapshot
+
+    def _present(self, registry):
+        return self._snapshot
+
+
+def _generate_annotation_event(message, socket, renderer, user_nipsad):
     """
     Get message about annotation event `message` to be sent to `socket`.
 
@@ -120,7 +415,7 @@ def _generate_annotation_event(message, socket, annotation, user_nipsad, group_s
     passed socket should receive notification of the event.
 
     Returns None if the socket should not receive any message about this
-    annotation event, otherwise a dict containing information about the event.
+    annotation event, otherwise the JSON-encoded notification to send.
     """
     action = message['action']
 
@@ -136,31 +431,19 @@ def _generate_annotation_event(message, socket, annotation, user_nipsad, group_s
 
     # Don't sent annotations from NIPSA'd users to anyone other than that
     # user.
-    if user_nipsad and socket.authenticated_userid != annotation.userid:
+    if user_nipsad and socket.authenticated_userid != renderer.userid:
         return None
 
-    notification = {
-        'type': 'annotation-notification',
-        'options': {'action': action},
-    }
-
-    base_url = socket.registry.settings.get('h.app_url',
-                                            'http://localhost:5000')
-    links_service = LinksService(base_url, socket.registry)
-    resource = AnnotationResource(annotation, group_service, links_service)
-    serialized = presenters.AnnotationJSONPresenter(resource).asdict()
+    serialized = renderer.serialized(socket.registry)
 
     permissions = serialized.get('permissions')
     if not _authorized_to_read(socket.effective_principals, permissions):
         return None
 
-    if not socket.filter.match(serialized, action):
+    if not socket.filter.match(renderer.filter_target(socket.registry), action):
         return None
 
-    notification['payload'] = [serialized]
-    if action == 'delete':
-        notification['payload'] = [{'id': annotation.id}]
-    return notification
+    return renderer.notification(action, socket.registry)
 
 
 def _generate_user_event(message, socket):
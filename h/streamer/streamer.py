@@ -2,13 +2,20 @@
 
 import logging
 import sys
+import time
 
 import gevent
+from gevent.queue import Empty
+from sqlalchemy.orm import subqueryload
 
 from h import db
+from h import models
 from h import stats
+from h import storage
+from h.db.types import InvalidUUID
 from h.streamer import messages
 from h.streamer import websocket
+from h.util import uri_cache
 
 log = logging.getLogger(__name__)
 
@@ -67,6 +74,12 @@ def process_work_queue(settings, queue, session_factory=None):
     dispatching them as appropriate. The handling of each message is wrapped in
     code that ensures the database session is appropriately committed and
     closed between messages.
+
+    If the ``h.streamer.batch_size`` setting is greater than one, messages are
+    instead handled in batches of up to that many messages, waiting at most
+    ``h.streamer.batch_latency_ms`` milliseconds for a batch to fill. Each
+    batch is handled in a single database transaction, and the annotations
+    referenced by a batch are loaded with a single query.
     """
     if session_factory is None:
         session_factory = _get_session
@@ -76,36 +89,59 @@ def process_work_queue(settings, queue, session_factory=None):
         ANNOTATION_TOPIC: messages.handle_annotation_event,
         USER_TOPIC: messages.handle_user_event,
     }
+    batch_size = int(settings.get('h.streamer.batch_size', 1))
+    batch_latency = float(settings.get('h.streamer.batch_latency_ms', 10)) / 1000
 
-    for msg in queue:
+    for batch in _batches(queue, batch_size, batch_latency):
         t_total = s.timer('streamer.msg.handler_total')
         t_total.start()
+        in_transaction = False
+        # Hold references to prefetched annotations for the whole batch, so
+        # that they stay in the session's (weak-referencing) identity map.
+        prefetched = []
         try:
-            # All access to the database in the streamer is currently
-            # read-only, so enforce that:
-            session.execute("SET TRANSACTION "
-                            "ISOLATION LEVEL SERIALIZABLE "
-                            "READ ONLY "
-                            "DEFERRABLE")
-
-            if isinstance(msg, messages.Message):
-                with s.timer('streamer.msg.handler_message'):
-                    messages.handle_message(msg, settings, session, topic_handlers)
-            elif isinstance(msg, websocket.Message):
-                with s.timer('streamer.msg.handler_websocket'):
-                    websocket.handle_message(msg, session)
-            else:
-                raise UnknownMessageType(repr(msg))
-
-        except (KeyboardInterrupt, SystemExit):
-            session.rollback()
-            raise
-        except:
-            log.exception('Caught exception handling streamer message:')
-            session.rollback()
-        else:
-            session.commit()
+            if len(batch) > 1:
+                _begin_read_only(session)
+                in_transaction = True
+                try:
+                    prefetched = _prefetch_annotations(session, batch)
+                except (KeyboardInterrupt, SystemExit):
+                    raise
+                except:
+                    log.exception('Caught exception prefetching annotations:')
+                    session.rollback()
+                    in_transaction = False
+
+            for msg in batch:
+                try:
+                    if not in_transaction:
+                        _begin_read_only(session)
+                        in_transaction = True
+
+                    if isinstance(msg, messages.Message):
+                        with s.timer('streamer.msg.handler_message'):
+                            messages.handle_message(msg, settings, session, topic_handlers)
+                    elif isinstance(msg, websocket.Message):
+                        with s.timer('streamer.msg.handler_websocket'):
+                            websocket.handle_message(msg, session)
+                            messages.replay_annotation_events(msg.socket,
+                                                              settings,
+                                                              session)
+                    else:
+                        raise UnknownMessageType(repr(msg))
+
+                except (KeyboardInterrupt, SystemExit):
+                    session.rollback()
+                    raise
+                except:
+                    log.exception('Caught exception handling streamer message:')
+                    session.rollback()
+                    in_transaction = False
+
+            if in_transaction:
+                session.commit()
         finally:
+            del prefetched[:]
             session.close()
         t_total.stop()
         s.send()
@@ -114,9 +150,25 @@ def process_work_queue(settings, queue, session_factory=None):
 def report_stats(settings):
     client = stats.get_client(settings)
     while True:
-        client.gauge('streamer.connected_clients',
-                     len(websocket.WebSocket.instances))
+        instances = list(websocket.WebSocket.instances)
+        client.gauge('streamer.connected_clients', len(instances))
         client.gauge('streamer.queue_length', WORK_QUEUE.qsize())
+        client.gauge('streamer.outbox_bytes',
+                     sum(i.outbox_bytes for i in instances))
+
+        evictions = websocket.WebSocket.evictions
+        dropped = websocket.WebSocket.dropped_messages
+        websocket.WebSocket.evictions = 0
+        websocket.WebSocket.dropped_messages = 0
+        client.incr('streamer.slow_client_evictions', evictions)
+        client.incr('streamer.outbox_dropped_messages', dropped)
+
+        expanded_uris = uri_cache.EXPANDED_URIS
+        client.incr('streamer.uri_cache.hits', expanded_uris.hits)
+        client.incr('streamer.uri_cache.misses', expanded_uris.misses)
+        expanded_uris.hits = 0
+        expanded_uris.misses = 0
+
         gevent.sleep(10)
 
 
@@ -135,6 +187,67 @@ def supervise(greenlets):
     sys.exit(1)
 
 
+def _batches(queue, size, latency):
+    """
+    Yield lists of messages from `queue`.
+
+    Each list contains at most `size` messages. Once the first message of a
+    list has been received, it waits no more than `latency` seconds for the
+    list to fill before yielding it.
+    """
+    if size <= 1:
+        for msg in queue:
+            yield [msg]
+        return
+
+    while True:
+        msg = queue.get()
+        if msg is StopIteration:
+            return
+        batch = [msg]
+        deadline = time.time() + latency
+        while len(batch) < size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                msg = queue.get(timeout=timeout)
+            except Empty:
+                break
+            if msg is StopIteration:
+                yield batch
+                return
+            batch.append(msg)
+        yield batch
+
+
+def _begin_read_only(session):
+    # All access to the database in the streamer is currently read-only, so
+    # enforce that:
+    session.execute("SET TRANSACTION "
+                    "ISOLATION LEVEL SERIALIZABLE "
+                    "READ ONLY "
+                    "DEFERRABLE")
+
+
+def _prefetch_annotations(session, batch):
+    """Load all the annotations referenced by `batch` in a single query."""
+    # Events which embed the annotation are handled without loading it.
+    ids = set(msg.payload['annotation_id'] for msg in batch
+              if isinstance(msg, messages.Message) and
+              msg.topic == ANNOTATION_TOPIC and
+              'annotation_id' in msg.payload and
+              'annotation' not in msg.payload)
+    try:
+        return storage.fetch_ordered_annotations(
+            session, list(ids),
+            query_processor=lambda query: query.options(
+                subqueryload(models.Annotation.document)))
+    except InvalidUUID:
+        # Leave it to the handler to deal with the invalid ID.
+        return []
+
+
 def _get_session(settings):
     engine = db.make_engine(settings)
     return db.Session(bind=engine)
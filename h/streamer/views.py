@@ -19,6 +19,13 @@ def websocket_view(request):
         'h.ws.streamer_work_queue': streamer.WORK_QUEUE,
     })
 
+    # ...the limits on buffering outbound messages for slow clients...
+    settings = request.registry.settings
+    if 'h.streamer.outbox_max_bytes' in settings:
+        request.environ['h.ws.outbox_max_bytes'] = settings['h.streamer.outbox_max_bytes']
+    if 'h.streamer.outbox_overflow' in settings:
+        request.environ['h.ws.outbox_overflow'] = settings['h.streamer.outbox_overflow']
+
     # ...and ensure that any persistent connections associated with this
     # WebSocket connection are closed.
     request.db.close()
@@ -1,11 +1,13 @@
 # -*- coding: utf-8 -*-
 
-from collections import namedtuple
+from collections import deque, namedtuple
 import copy
 import json
 import logging
 import weakref
 
+import gevent
+from gevent.event import Event
 from gevent.queue import Full
 import jsonschema
 from ws4py.websocket import WebSocket as _WebSocket
@@ -19,6 +21,20 @@ log = logging.getLogger(__name__)
 # below.
 MESSAGE_HANDLERS = {}
 
+# The default number of bytes which may be buffered for sending to a single
+# client before its overflow policy is applied.
+DEFAULT_OUTBOX_MAX_BYTES = 1024 * 1024
+
+# What to do when a client's outbound buffer overflows: either drop the oldest
+# buffered messages until the buffer is back under its limit, or close the
+# connection.
+OVERFLOW_DROP_OLDEST = 'drop_oldest'
+OVERFLOW_CLOSE = 'close'
+
+# Queued in a client's outbound buffer in place of a message, to have the
+# greenlet writing the buffer close the connection.
+_CLOSE = object()
+
 
 # An incoming message from a WebSocket client.
 class Message(namedtuple('Message', [
@@ -46,10 +62,19 @@ class WebSocket(_WebSocket):
     # All instances of WebSocket, allowing us to iterate over open websockets
     instances = weakref.WeakSet()
 
+    # Index of instances by the URIs their filters are subscribed to
+    subscriptions = filter.FilterIndex()
+
+    # Counts of messages dropped from, and connections closed because of,
+    # overflowing outbound buffers since the counts were last reset.
+    dropped_messages = 0
+    evictions = 0
+
     # Instance attributes
     client_id = None
     filter = None
     query = None
+    resume_from = None
 
     def __init__(self, sock, protocols=None, extensions=None, environ=None):
         super(WebSocket, self).__init__(sock,
@@ -64,6 +89,18 @@ class WebSocket(_WebSocket):
 
         self._work_queue = environ['h.ws.streamer_work_queue']
 
+        # Outbound messages are buffered and written by a greenlet per socket,
+        # so that a slow client can't hold up delivery to other clients.
+        self._outbox = deque()
+        self._outbox_ready = Event()
+        self._outbox_sender = None
+        self._outbox_closing = False
+        self.outbox_bytes = 0
+        self.outbox_max_bytes = environ.get('h.ws.outbox_max_bytes',
+                                            DEFAULT_OUTBOX_MAX_BYTES)
+        self.outbox_overflow = environ.get('h.ws.outbox_overflow',
+                                           OVERFLOW_CLOSE)
+
     def __new__(cls, *args, **kwargs):
         instance = super(WebSocket, cls).__new__(cls, *args, **kwargs)
         cls.instances.add(instance)
@@ -87,10 +124,86 @@ class WebSocket(_WebSocket):
             self.instances.remove(self)
         except KeyError:
             pass
+        self.subscriptions.remove(self)
+        self._outbox.clear()
+        self.outbox_bytes = 0
+        if self._outbox_sender is not None:
+            self._outbox_sender.kill(block=False)
+            self._outbox_sender = None
 
     def send_json(self, payload):
-        if not self.terminated:
-            self.send(json.dumps(payload))
+        self.send_raw(json.dumps(payload))
+
+    def send_raw(self, data):
+        """
+        Queue an already-encoded message for sending to the client.
+
+        If this takes the client's outbound buffer over its limit, its
+        overflow policy is applied.
+        """
+        if not self._can_send:
+            return
+
+        self._outbox.append(data)
+        self.outbox_bytes += len(data)
+
+        if self.outbox_bytes > self.outbox_max_bytes:
+            self._overflow()
+
+        self._outbox_ready.set()
+        if self._outbox_sender is None:
+            self._outbox_sender = gevent.spawn(self._send_outbox)
+
+    @property
+    def _can_send(self):
+        return not (self._outbox_closing or self._connection_closed)
+
+    @property
+    def _connection_closed(self):
+        return self.terminated or self.server_terminated
+
+    def _overflow(self):
+        if self.outbox_overflow == OVERFLOW_DROP_OLDEST:
+            while self.outbox_bytes > self.outbox_max_bytes and self._outbox:
+                dropped = self._outbox.popleft()
+                self.outbox_bytes -= len(dropped)
+                WebSocket.dropped_messages += 1
+        else:
+            log.info('closing connection to slow client: %d bytes buffered',
+                     self.outbox_bytes)
+            WebSocket.evictions += 1
+            WebSocket.dropped_messages += len(self._outbox)
+            self._outbox.clear()
+            self.outbox_bytes = 0
+            # Writing the close frame could block on the slow client, so
+            # leave it to the greenlet which writes to this client, which also
+            # stops it interleaving with a message being written.
+            self._outbox.append(_CLOSE)
+            self._outbox_closing = True
+
+    def _send_outbox(self):
+        while not self._connection_closed:
+            if not self._outbox:
+                self._outbox_ready.clear()
+                self._outbox_ready.wait()
+                continue
+
+            data = self._outbox.popleft()
+            if data is _CLOSE:
+                self.close(code=1008, reason='client too slow')
+                break
+
+            self.outbox_bytes -= len(data)
+            try:
+                self.send(data)
+            except Exception:
+                log.warn('error sending to client, dropping connection',
+                         exc_info=True)
+                self._outbox.clear()
+                self.outbox_bytes = 0
+                self.close_connection()
+                break
+        self._outbox_sender = None
 
 
 def handle_message(message, session=None):
@@ -132,6 +245,7 @@ def handle_client_id_message(message, session=None):
                       ok=False)
         return
     message.socket.client_id = message.payload['value']
+    _set_resume_from(message)
 MESSAGE_HANDLERS['client_id'] = handle_client_id_message
 
 
@@ -155,7 +269,16 @@ def handle_filter_message(message, session=None):
     if session is not None:
         # Add backend expands for clauses
         _expand_clauses(session, filter_)
-    message.socket.filter = filter.FilterHandler(filter_)
+    try:
+        message.socket.filter = filter.FilterHandler(filter_)
+    except ValueError:
+        message.reply({'type': 'error',
+                       'error': {'type': 'invalid_data',
+                                 'description': 'failed to parse filter'}},
+                      ok=False)
+        return
+    WebSocket.subscriptions.add(message.socket, filter_)
+    _set_resume_from(message)
 MESSAGE_HANDLERS['filter'] = handle_filter_message
 
 
@@ -183,6 +306,14 @@ def handle_unknown_message(message, session=None):
 MESSAGE_HANDLERS[None] = handle_unknown_message
 
 
+def _set_resume_from(message):
+    # A reconnecting client may send the position of the last notification it
+    # received along with its client ID or filter. The missed events are
+    # replayed by the streamer once the client has a filter.
+    if 'resume_from' in message.payload:
+        message.socket.resume_from = message.payload['resume_from']
+
+
 def _expand_clauses(session, filter_):
     for clause in filter_['clauses']:
         if 'field' in clause and clause['field'] == '/uri':
@@ -1,10 +1,14 @@
 # -*- coding: utf-8 -*-
 
+from pyramid.settings import asbool
 
 from h import __version__
 from h import emails
+from h import presenters
 from h import storage
+from h.interfaces import IGroupService
 from h.notification import reply
+from h.resources import AnnotationResource
 from h.tasks import mailer
 
 
@@ -36,6 +40,15 @@ def publish_annotation_event(event):
         'annotation_id': event.annotation_id,
         'src_client_id': event.request.headers.get('X-Client-Id'),
     }
+
+    # Optionally embed the presented annotation, so that the streamer doesn't
+    # need to load it from the database again.
+    settings = event.request.registry.settings
+    if asbool(settings.get('h.realtime.embed_annotations', False)):
+        snapshot = _annotation_snapshot(event.request, event.annotation_id)
+        if snapshot is not None:
+            data['annotation'] = snapshot
+
     event.request.realtime.publish_annotation(data)
 
 
@@ -53,3 +66,14 @@ def send_reply_notifications(event,
             return
         send_params = generate_mail(request, notification)
         send(*send_params)
+
+
+def _annotation_snapshot(request, annotation_id):
+    with request.tm:
+        annotation = storage.fetch_annotation(request.db, annotation_id)
+        if annotation is None:
+            return None
+        group_service = request.find_service(IGroupService)
+        links_service = request.find_service(name='links')
+        resource = AnnotationResource(annotation, group_service, links_service)
+        return presenters.AnnotationJSONPresenter(resource).asdict()
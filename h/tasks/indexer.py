@@ -1,12 +1,20 @@
 # -*- coding: utf-8 -*-
 
+from celery.contrib.batches import Batches
+from pyramid.settings import asbool
+
 from h import models, storage
 from h.celery import celery, get_task_logger
 from h.indexer.reindexer import SETTING_NEW_INDEX
-from h.search.index import BatchIndexer, delete, index
+from h.search.index import BatchIndexer, delete, fetch_annotations, index
 
 log = get_task_logger(__name__)
 
+# The most annotations to index in one batch (and one bulk request) ...
+BATCH_SIZE = 100
+# ... and the longest, in seconds, to wait for a batch to fill up.
+BATCH_INTERVAL = 1
+
 
 @celery.task
 def add_annotation(id_):
@@ -21,9 +29,63 @@ def add_annotation(id_):
             index(celery.request.es, annotation, celery.request,
                   target_index=future_index)
 
+        _update_badge_counts(celery.request, [annotation])
+
         if annotation.is_reply:
             add_annotation.delay(annotation.thread_root_id)
 
+
+@celery.task(base=Batches, flush_every=BATCH_SIZE, flush_interval=BATCH_INTERVAL)
+def add_annotations(requests):
+    """
+    Index the annotations added or updated in a batch of requests.
+
+    This is the coalescing version of :py:func:`add_annotation`. The worker
+    buffers its requests for up to `BATCH_INTERVAL` seconds or `BATCH_SIZE`
+    requests, whichever comes first, and this indexes the distinct annotations
+    requested, along with the thread roots of any replies among them, using
+    one bulk request per index.
+
+    Celery runs batched tasks without sending the task signals which, for
+    other tasks, reset the NIPSA cache and commit or abort the transaction
+    (see :py:mod:`h.celery`), so this does both itself.
+    """
+    celery.request.find_service(name='nipsa').clear()
+    try:
+        _add_annotations(requests)
+    except Exception:
+        celery.request.tm.abort()
+        raise
+    celery.request.tm.commit()
+
+
+def _add_annotations(requests):
+    ids = set(request.args[0] for request in requests)
+    annotations = fetch_annotations(celery.request.db, ids)
+
+    root_ids = set(a.thread_root_id for a in annotations if a.is_reply) - ids
+    annotations.extend(fetch_annotations(celery.request.db, root_ids))
+
+    if not annotations:
+        return
+
+    target_indexes = [None]
+    # If a reindex is running at the moment, add annotations to the new index
+    # as well.
+    future_index = _current_reindex_new_name(celery.request)
+    if future_index is not None:
+        target_indexes.append(future_index)
+
+    for target_index in target_indexes:
+        indexer = BatchIndexer(celery.request.db, celery.request.es, celery.request,
+                               target_index=target_index)
+        errored = indexer.index_annotations(annotations)
+        if errored:
+            log.warning('Failed to index annotations %s', errored)
+
+    _update_badge_counts(celery.request, annotations)
+
+
 @celery.task
 def delete_annotation(id_):
     delete(celery.request.es, id_)
@@ -34,16 +96,35 @@ def delete_annotation(id_):
     if future_index is not None:
         delete(celery.request.es, id_, target_index=future_index)
 
+    annotation = storage.fetch_annotation(celery.request.db, id_)
+    if annotation:
+        _update_badge_counts(celery.request, [annotation])
+
 
 @celery.task
 def reindex_user_annotations(userid):
-    ids = [a.id for a in celery.request.db.query(models.Annotation.id).filter_by(userid=userid)]
+    annotations = celery.request.db.query(models.Annotation).filter_by(userid=userid).all()
+    ids = [a.id for a in annotations]
 
     indexer = BatchIndexer(celery.request.db, celery.request.es, celery.request)
     errored = indexer.index(ids)
     if errored:
         log.warning('Failed to re-index annotations %s', errored)
 
+    # The user's NIPSA status may have changed, which changes whether their
+    # annotations count towards the badge.
+    _update_badge_counts(celery.request, annotations)
+
+
+def _update_badge_counts(request, annotations):
+    # The stored counts are only read if they're enabled, so don't pay for
+    # keeping them up to date otherwise.
+    if not asbool(request.registry.settings.get('h.badge.use_counts', False)):
+        return
+
+    svc = request.find_service(name='badge_count')
+    svc.update(annotations)
+
 
 def _current_reindex_new_name(request):
     settings = celery.request.find_service(name='settings')
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+"""A bounded mapping which drops its least recently used items first."""
+
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    A mapping of at most `maxsize` items, least recently used first out.
+
+    Getting an item with :py:meth:`get`, or setting it, marks it as the most
+    recently used. When setting an item makes the mapping too big, the least
+    recently used items are dropped, and `on_evict` (if given) is called with
+    the key and value of each, so that callers can drop anything they keep
+    about them alongside.
+
+    It isn't thread-safe: the caches built on it keep other state which has
+    to change along with it, so they hold their own locks around both.
+    """
+
+    def __init__(self, maxsize, on_evict=None):
+        self.maxsize = maxsize
+        self._on_evict = on_evict
+        self._items = OrderedDict()
+
+    def get(self, key, default=None):
+        """Return the value for `key`, marking it as the most recently used."""
+        try:
+            value = self._items.pop(key)
+        except KeyError:
+            return default
+        self._items[key] = value
+        return value
+
+    def pop(self, key, default=None):
+        """Remove `key` and return its value, without calling `on_evict`."""
+        return self._items.pop(key, default)
+
+    def clear(self):
+        self._items.clear()
+
+    def __setitem__(self, key, value):
+        self._items.pop(key, None)
+        self._items[key] = value
+        while len(self._items) > self.maxsize:
+            evicted_key, evicted = self._items.popitem(last=False)
+            if self._on_evict is not None:
+                self._on_evict(evicted_key, evicted)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __iter__(self):
+        # Iterate over a copy, so that items can be popped along the way.
+        return iter(list(self._items))
+
+    def __len__(self):
+        return len(self._items)
@@ -18,6 +18,20 @@ def column_windows(session, column, windowsize=2000, where=None):
     Returns an iterable of SQLAlchemy expressions which can be used in a
     .filter(...) clause.
     """
+    for start, end in column_window_bounds(session, column, windowsize, where):
+        yield column_window(column, start, end)
+
+
+def column_window_bounds(session, column, windowsize=2000, where=None):
+    """
+    Return the bounds of the windows which :py:func:`column_windows` returns.
+
+    Takes the same arguments as :py:func:`column_windows`, and returns a list
+    of ``(start, end)`` values of the column, where ``end`` is `None` for the
+    last window. Unlike the windows' SQLAlchemy expressions, the bounds can
+    be passed to other processes, which can turn them back into windows with
+    :py:func:`column_window`.
+    """
 
     # This function is adapted from a recipe supplied by the SQLAlchemy
     # maintainers:
@@ -27,18 +41,9 @@ def column_windows(session, column, windowsize=2000, where=None):
     # In overview: we generate a list of all the possible values of `column`
     # on the server, and then turn that list into a subquery with
     # Query#from_self(). We then use the row number of the inner query to
-    # select every `windowsize`'th row. The resulting values are then
-    # translated into an iterable of SQLAlchemy expressions suitable for use
-    # in Query#filter(...).
-
-    def interval_for_range(start_id, end_id):
-        if end_id:
-            return sa.and_(
-                column >= start_id,
-                column < end_id
-            )
-        else:
-            return column >= start_id
+    # select every `windowsize`'th row. The resulting values are the window
+    # bounds, which column_windows translates into an iterable of SQLAlchemy
+    # expressions suitable for use in Query#filter(...).
 
     q = session.query(
         column,
@@ -56,10 +61,21 @@ def column_windows(session, column, windowsize=2000, where=None):
 
     intervals = [id for id, in q]
 
-    while intervals:
-        start = intervals.pop(0)
-        if intervals:
-            end = intervals[0]
-        else:
-            end = None
-        yield interval_for_range(start, end)
+    return zip(intervals, intervals[1:] + [None])
+
+
+def column_window(column, start, end):
+    """
+    Return a WHERE clause selecting one window of a column.
+
+    :param column: the SQLAlchemy column object
+    :param start: the (inclusive) start of the window
+    :param end: the (exclusive) end of the window, or `None` for no end
+    """
+    if end:
+        return sa.and_(
+            column >= start,
+            column < end
+        )
+    else:
+        return column >= start
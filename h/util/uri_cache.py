@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+"""
+A process-wide cache of URI expansions.
+
+Finding the URIs which refer to the same document as a URI (see
+:py:func:`h.storage.expand_uri`) takes a join across the ``document`` and
+``document_uri`` tables, and happens on every URI-scoped search, on every
+streamer filter and when recounting the badge. Expansions are cached here for
+a short time so that repeated lookups of the same page don't hit the database.
+
+Which URIs refer to the same document only changes when document metadata is
+saved, and :py:mod:`h.models.document` invalidates the affected entries when
+that happens. That only reaches the cache of the process doing the saving, so
+entries also expire after a TTL, which bounds how stale the other processes'
+caches can get.
+"""
+
+from __future__ import unicode_literals
+
+import threading
+import time
+
+from h.util.lru import LRUCache
+
+
+class ExpandedURICache(object):
+    """
+    A bounded cache of the URIs which refer to the same document as a URI.
+
+    Expansions are cached for at most `ttl` seconds and up to `maxsize` URIs,
+    least recently used first out. Each entry is indexed by the URIs it
+    expands to as well as its own, so that invalidating a URI drops every
+    expansion which involves it.
+    """
+
+    def __init__(self, maxsize=10000, ttl=60, clock=time.time):
+        self.ttl = ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        # Mapping of URI to (expiry time, expanded URIs)
+        self._entries = LRUCache(maxsize,
+                                 on_evict=lambda key, entry: self._unindex(key, entry[1]))
+        # Mapping of each URI to the cached URIs whose expansions involve it
+        self._keys_by_uri = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, uri):
+        """Return the cached expansion of `uri`, or None if there isn't one."""
+        with self._lock:
+            entry = self._entries.get(uri)
+            if entry is not None:
+                if entry[0] > self._clock():
+                    self.hits += 1
+                    return list(entry[1])
+                self._entries.pop(uri)
+                self._unindex(uri, entry[1])
+
+            self.misses += 1
+            return None
+
+    def set(self, uri, expanded):
+        """Cache `expanded` as the URIs which refer to the same document as `uri`."""
+        expanded = tuple(expanded)
+        with self._lock:
+            previous = self._entries.pop(uri, None)
+            if previous is not None:
+                self._unindex(uri, previous[1])
+
+            for u in self._involved(uri, expanded):
+                self._keys_by_uri.setdefault(u, set()).add(uri)
+            self._entries[uri] = (self._clock() + self.ttl, expanded)
+
+    def invalidate(self, uri):
+        """Drop the cached expansions of, or including, `uri`."""
+        with self._lock:
+            keys = self._keys_by_uri.get(uri, set()) | set([uri])
+            for key in keys:
+                entry = self._entries.pop(key, None)
+                if entry is not None:
+                    self._unindex(key, entry[1])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_uri.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _unindex(self, key, expanded):
+        for u in self._involved(key, expanded):
+            keys = self._keys_by_uri.get(u)
+            if keys is None:
+                continue
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_uri[u]
+
+    @staticmethod
+    def _involved(key, expanded):
+        return set(expanded) | set([key])
+
+
+# Expanded URIs, shared by everything in this process which expands URIs
+EXPANDED_URIS = ExpandedURICache()
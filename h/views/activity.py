@@ -74,7 +74,8 @@ class SearchController(object):
         return {
             'search_results': results,
             'groups_suggestions': groups_suggestions,
-            'page': paginate(self.request, results.total, page_size=page_size),
+            'page': paginate(self.request, results.total, page_size=page_size,
+                             next_cursor=results.next),
             'pretty_link': pretty_link,
             'q': self.request.params.get('q', ''),
             'tag_link': tag_link,
@@ -18,6 +18,7 @@ objects and Pyramid ACLs in :mod:`h.resources`.
 """
 from pyramid import i18n
 from pyramid import security
+from pyramid.settings import asbool
 
 from h import search as search_lib
 from h import storage
@@ -99,19 +100,24 @@ def search(request):
 
     separate_replies = params.pop('_separate_replies', False)
     stats = getattr(request, 'stats', None)
+    from_index = asbool(request.registry.settings.get('h.search.render_from_index'))
     result = search_lib.Search(request,
                                separate_replies=separate_replies,
-                               stats=stats).run(params)
+                               stats=stats,
+                               include_sources=from_index).run(params)
 
     svc = request.find_service(name='annotation_json_presentation')
 
     out = {
         'total': result.total,
-        'rows': svc.present_all(result.annotation_ids)
+        'rows': svc.present_all(result.annotation_ids, result.sources)
     }
 
     if separate_replies:
-        out['replies'] = svc.present_all(result.reply_ids)
+        out['replies'] = svc.present_all(result.reply_ids, result.sources)
+
+    if result.next is not None:
+        out['next'] = result.next
 
     return out
 
@@ -3,10 +3,14 @@
 from __future__ import unicode_literals
 
 from pyramid import httpexceptions
+from pyramid.settings import asbool
 
 from h import models, search
 from h.util.view import json_view
 
+# The most URIs which can be counted in one request to the bulk badge API
+MAX_BADGE_URIS = 100
+
 
 @json_view(route_name='badge')
 def badge(request):
@@ -18,6 +22,9 @@ def badge(request):
     those pages. The Chrome extension is oblivious to this, we just tell it
     that there are 0 annotations.
 
+    If ``h.badge.use_counts`` is set the number is read from the counts which
+    the indexer maintains, rather than from a search.
+
     """
     uri = request.params.get('uri')
 
@@ -27,7 +34,42 @@ def badge(request):
     if models.Blocklist.is_blocked(request.db, uri):
         return {'total': 0}
 
+    if asbool(request.registry.settings.get('h.badge.use_counts', False)):
+        badge_count = request.find_service(name='badge_count')
+        return {'total': badge_count.count(uri)}
+
     query = {'uri': uri, 'limit': 0}
     result = search.Search(request, stats=request.stats).run(query)
 
     return {'total': result.total}
+
+
+@json_view(route_name='badges')
+def badges(request):
+    """Return the number of public annotations on each of several pages.
+
+    This is the bulk version of :py:func:`badge`, for clients which show
+    counts for lists of links. It takes up to ``MAX_BADGE_URIS`` ``uri``
+    parameters and counts them all in one round trip, returning a mapping of
+    each URI to its count.
+
+    """
+    uris = request.params.getall('uri')
+
+    if not uris or len(set(uris)) > MAX_BADGE_URIS:
+        raise httpexceptions.HTTPBadRequest()
+
+    blocked = models.Blocklist.blocked(request.db, uris)
+    uris = [uri for uri in set(uris) if uri not in blocked]
+    totals = dict((uri, 0) for uri in blocked)
+
+    if asbool(request.registry.settings.get('h.badge.use_counts', False)):
+        badge_count = request.find_service(name='badge_count')
+        totals.update(badge_count.counts(uris))
+        return {'totals': totals}
+
+    counts = search.Search(request, stats=request.stats).count_all(
+        [{'uri': uri} for uri in uris])
+    totals.update(zip(uris, counts))
+
+    return {'totals': totals}
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measure the per-match cost of streamer filters.
+
+Matches a representative sidebar filter against an annotation three ways:
+
+- with a baseline copy of the filter matching the streamer did before filters
+  were compiled, which resolves JSON pointers and folds both the clause and
+  the field values on every match,
+- with compiled filters, passing the raw annotation to each filter (so that
+  every filter resolves and folds field values itself), and
+- with compiled filters sharing a single FilterTarget, as the streamer does
+  when fanning out an annotation event.
+"""
+
+from __future__ import print_function, unicode_literals
+
+import argparse
+import copy
+import operator
+import timeit
+
+from jsonpointer import resolve_pointer
+
+from h.streamer.filter import FilterHandler, FilterTarget, uni_fold
+
+FILTER = {
+    'match_policy': 'include_any',
+    'actions': {'create': True, 'update': True, 'delete': True},
+    'clauses': [
+        {'field': '/uri', 'operator': 'one_of',
+         'value': ['http://example.com/page/{}'.format(i) for i in range(5)]},
+        {'field': '/references', 'operator': 'one_of',
+         'value': ['a1b2c3', 'd4e5f6']},
+        {'field': ['/group', '/user'], 'operator': 'equals',
+         'value': 'acct:Bob@example.com'},
+    ],
+}
+
+ANNOTATION = {
+    'uri': 'http://example.com/page/9',
+    'references': ['x1y2z3'],
+    'group': '__world__',
+    'user': 'acct:Alice@example.com',
+    'tags': ['Café', 'reading'],
+}
+
+
+class BaselineFilterHandler(object):
+    """The filter matching of the streamer before filters were compiled."""
+
+    def __init__(self, filter_json):
+        self.filter = filter_json
+
+    def evaluate_clause(self, clause, target):
+        if isinstance(clause['field'], list):
+            for field in clause['field']:
+                copied = copy.deepcopy(clause)
+                copied['field'] = field
+                result = self.evaluate_clause(copied, target)
+                if result:
+                    return True
+            return False
+        else:
+            field_value = resolve_pointer(target, clause['field'], None)
+            if field_value is None:
+                return False
+
+            cval = clause['value']
+            fval = field_value
+
+            if isinstance(cval, list):
+                cval = [uni_fold(cv) for cv in cval]
+            else:
+                cval = uni_fold(cval)
+
+            if isinstance(fval, list):
+                fval = [uni_fold(fv) for fv in fval]
+            else:
+                fval = uni_fold(fval)
+
+            reversed_order = False
+            if isinstance(cval, list) or isinstance(fval, list):
+                if clause['operator'] in ['one_of', 'matches']:
+                    reversed_order = not isinstance(field_value, list)
+
+            if reversed_order:
+                lval, rval = cval, fval
+            else:
+                lval, rval = fval, cval
+
+            op = getattr(operator, FilterHandler.operators[clause['operator']])
+            return op(lval, rval)
+
+    def include_any(self, target):
+        for clause in self.filter['clauses']:
+            if self.evaluate_clause(clause, target):
+                return True
+        return False
+
+    def match(self, target, action=None):
+        if not action or action == 'past' or action in self.filter['actions']:
+            if len(self.filter['clauses']) > 0:
+                return getattr(self, self.filter['match_policy'])(target)
+            else:
+                return True
+        else:
+            return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--filters', type=int, default=1000,
+                        help='number of filters to match against')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='number of times to match every filter')
+    args = parser.parse_args()
+
+    baseline_handlers = [BaselineFilterHandler(FILTER) for _ in range(args.filters)]
+    handlers = [FilterHandler(FILTER) for _ in range(args.filters)]
+
+    def baseline():
+        for handler in baseline_handlers:
+            handler.match(ANNOTATION, 'create')
+
+    def unshared():
+        for handler in handlers:
+            handler.match(ANNOTATION, 'create')
+
+    def shared():
+        target = FilterTarget(ANNOTATION)
+        for handler in handlers:
+            handler.match(target, 'create')
+
+    for name, func in [('baseline', baseline),
+                       ('unshared target', unshared),
+                       ('shared target', shared)]:
+        elapsed = timeit.timeit(func, number=args.repeat)
+        per_match = elapsed / (args.repeat * args.filters) * 1e6
+        print('{:<16} {:8.2f} us/match'.format(name, per_match))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,394 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Load-test the streamer with simulated clients and an in-memory broker.
+
+Connects a number of simulated WebSocket clients, each subscribed with a
+sidebar-like filter to one of a set of pages (some pages being much more
+popular than others), and then publishes a stream of annotation and user
+events through an in-memory stand-in for the realtime exchange. Messages are
+handled by the streamer's own work queue processing, so the only parts of the
+streamer not exercised are the RabbitMQ consumers and the network.
+
+Annotation events embed the presented annotation, as they do when the
+`h.realtime.embed_annotations` setting is on, so no annotations need to exist
+in the database. A database is still needed for the streamer's session: it is
+taken from --database-url or the DATABASE_URL environment variable.
+
+Reports the rate at which events were handled, the latency between an event
+being published and each notification about it being written to a client,
+the number of messages dropped and clients evicted for being too slow, and the
+memory used per connection.
+"""
+
+from __future__ import division, print_function, unicode_literals
+
+import argparse
+import json
+import os
+import random
+import time
+
+import gevent
+from gevent.event import Event
+from gevent.queue import Full, Queue
+from pyramid import security
+from pyramid.registry import Registry
+from ws4py.messaging import TextMessage
+
+from h.settings import database_url
+from h.streamer import messages
+from h.streamer import streamer
+from h.streamer import websocket
+
+AUTHORITY = 'example.com'
+PAGE_URI = 'https://example.com/page/{}'
+
+
+class InMemoryExchange(object):
+    """
+    A stand-in for the realtime exchange and the streamer's consumers.
+
+    Published payloads are round-tripped through JSON, as they would be by the
+    broker, and put straight onto the streamer's work queue. As with the real
+    consumers, a message is dropped if the queue stays full for 0.1s.
+    """
+
+    def __init__(self, work_queue):
+        self.work_queue = work_queue
+        self.dropped = 0
+
+    def publish_annotation(self, payload):
+        self._publish(streamer.ANNOTATION_TOPIC, payload)
+
+    def publish_user(self, payload):
+        self._publish(streamer.USER_TOPIC, payload)
+
+    def _publish(self, routing_key, payload):
+        message = messages.Message(topic=routing_key,
+                                   payload=json.loads(json.dumps(payload)))
+        try:
+            self.work_queue.put(message, timeout=0.1)
+        except Full:
+            self.dropped += 1
+
+
+class SinkSocket(object):
+    """A client connection which takes `delay` seconds to accept each write."""
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.bytes_received = 0
+
+    def sendall(self, data):
+        if self.delay:
+            gevent.sleep(self.delay)
+        self.bytes_received += len(data)
+
+
+class SimulatedClient(websocket.WebSocket):
+    """A streamer WebSocket whose client records the messages it receives."""
+
+    def __init__(self, recorder, environ, delay=0):
+        super(SimulatedClient, self).__init__(SinkSocket(delay),
+                                              environ=environ)
+        self.recorder = recorder
+
+    def send(self, payload, binary=False):
+        super(SimulatedClient, self).send(payload, binary)
+        self.recorder.record(payload)
+
+    def client_message(self, payload):
+        self.received_message(TextMessage(json.dumps(payload)))
+
+
+class Recorder(object):
+    """
+    Record when events are published and when notifications are written.
+
+    Received messages are only decoded once the run is over, so that doing so
+    doesn't compete with the streamer for the CPU.
+    """
+
+    def __init__(self):
+        self.published_at = {}
+        self.received = []
+        self.pong = Event()
+
+    def publish(self, key):
+        self.published_at[key] = time.time()
+
+    def record(self, data):
+        self.received.append((time.time(), data))
+
+    def latencies(self):
+        result = []
+        for received_at, data in self.received:
+            key = _event_key(json.loads(data))
+            if key in self.published_at:
+                result.append(received_at - self.published_at[key])
+        return result
+
+
+class ControlClient(SimulatedClient):
+    """A client used to find out when the streamer has caught up."""
+
+    def send(self, payload, binary=False):
+        if json.loads(payload).get('type') == 'pong':
+            self.recorder.pong.set()
+
+
+def _event_key(message):
+    if message.get('type') == 'annotation-notification':
+        return message['payload'][0]['id']
+    if message.get('type') == 'session-change':
+        return message['model'].get('loadtest_id')
+    return None
+
+
+def _environ(work_queue, registry, userid, args):
+    principals = [security.Everyone, 'group:__world__']
+    if userid is not None:
+        principals.extend([security.Authenticated, userid])
+    return {
+        'h.ws.authenticated_userid': userid,
+        'h.ws.effective_principals': principals,
+        'h.ws.registry': registry,
+        'h.ws.streamer_work_queue': work_queue,
+        'h.ws.outbox_max_bytes': args.outbox_max_bytes,
+        'h.ws.outbox_overflow': args.outbox_overflow,
+    }
+
+
+def _page_weights(pages):
+    # Page popularity roughly follows Zipf's law.
+    return [1 / (i + 1) for i in range(pages)]
+
+
+def _choose(rng, weights, total):
+    x = rng.random() * total
+    for i, weight in enumerate(weights):
+        x -= weight
+        if x < 0:
+            return i
+    return len(weights) - 1
+
+
+def _filter(uri):
+    return {
+        'match_policy': 'include_any',
+        'clauses': [{'field': '/uri',
+                     'operator': 'one_of',
+                     'value': [uri, uri + '?print=1'],
+                     'case_sensitive': False}],
+        'actions': {'create': True, 'update': True, 'delete': True},
+    }
+
+
+def _userid(i):
+    return 'acct:user{}@{}'.format(i, AUTHORITY)
+
+
+def connect_clients(args, rng, work_queue, registry, recorder):
+    weights = _page_weights(args.pages)
+    total = sum(weights)
+    clients = []
+    for i in range(args.clients):
+        userid = None
+        if rng.random() < args.authenticated:
+            userid = _userid(i)
+        delay = 0
+        if rng.random() < args.slow_clients:
+            delay = args.slow_client_delay / 1000
+        client = SimulatedClient(recorder,
+                                 _environ(work_queue, registry, userid, args),
+                                 delay=delay)
+        uri = PAGE_URI.format(_choose(rng, weights, total))
+        client.client_message({'messageType': 'client_id',
+                               'value': 'client-{}'.format(i)})
+        client.client_message({'filter': _filter(uri)})
+        clients.append(client)
+    return clients
+
+
+def publish_events(args, rng, exchange, recorder):
+    weights = _page_weights(args.pages)
+    total = sum(weights)
+    interval = 1 / args.rate if args.rate else 0
+    text = 'x' * args.annotation_size
+    start = time.time()
+
+    for n in range(args.events):
+        key = 'event-{}'.format(n)
+        recorder.publish(key)
+
+        if rng.random() < args.user_events:
+            exchange.publish_user({
+                'type': 'group-join',
+                'userid': _userid(rng.randrange(args.clients)),
+                'session_model': {'loadtest_id': key},
+            })
+        else:
+            userid = _userid(rng.randrange(args.clients))
+            read = ['group:__world__']
+            if rng.random() < args.private:
+                read = [userid]
+            action = rng.choice(['create'] * 6 + ['update'] * 3 + ['delete'])
+            exchange.publish_annotation({
+                'action': action,
+                'annotation_id': key,
+                'src_client_id': None,
+                'annotation': {
+                    'id': key,
+                    'user': userid,
+                    'uri': PAGE_URI.format(_choose(rng, weights, total)),
+                    'group': '__world__',
+                    'text': text,
+                    'permissions': {'read': read},
+                },
+            })
+
+        if interval:
+            gevent.sleep(max(0, start + (n + 1) * interval - time.time()))
+        elif n % 100 == 0:
+            gevent.sleep(0)
+
+
+def _rss():
+    """Return the resident set size of this process in bytes (Linux only)."""
+    with open('/proc/self/statm') as statm:
+        pages = int(statm.read().split()[1])
+    return pages * os.sysconf(str('SC_PAGE_SIZE'))
+
+
+def _percentile(values, p):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def _wait_until_caught_up(control, recorder, timeout):
+    recorder.pong.clear()
+    control.client_message({'type': 'ping', 'id': 1})
+    if not recorder.pong.wait(timeout):
+        raise RuntimeError('streamer did not catch up within {}s'.format(timeout))
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    settings = {
+        'sqlalchemy.url': args.database_url,
+        'h.authority': AUTHORITY,
+        'h.streamer.batch_size': args.batch_size,
+        'h.streamer.batch_latency_ms': args.batch_latency_ms,
+    }
+    registry = Registry('loadtest')
+    registry.settings = {'h.app_url': 'http://localhost:5000'}
+    work_queue = Queue(maxsize=4096)
+    recorder = Recorder()
+    exchange = InMemoryExchange(work_queue)
+
+    worker = gevent.spawn(streamer.process_work_queue, settings, work_queue)
+    control = ControlClient(recorder, _environ(work_queue, registry, None, args))
+
+    rss_before = _rss()
+    clients = connect_clients(args, rng, work_queue, registry, recorder)
+    _wait_until_caught_up(control, recorder, args.timeout)
+    memory_per_connection = (_rss() - rss_before) / max(1, len(clients))
+
+    websocket.WebSocket.dropped_messages = 0
+    websocket.WebSocket.evictions = 0
+
+    start = time.time()
+    publish_events(args, rng, exchange, recorder)
+    _wait_until_caught_up(control, recorder, args.timeout)
+    elapsed = time.time() - start
+
+    # Give slow clients a chance to receive what is buffered for them.
+    deadline = time.time() + args.drain_timeout
+    while time.time() < deadline and any(c.outbox_bytes for c in clients):
+        gevent.sleep(0.01)
+
+    worker.kill()
+
+    latencies = recorder.latencies()
+    return {
+        'clients': len(clients),
+        'events': args.events,
+        'events_per_sec': args.events / elapsed,
+        'deliveries': len(latencies),
+        'fanout_latency_p50_ms': _percentile(latencies, 50) * 1000,
+        'fanout_latency_p99_ms': _percentile(latencies, 99) * 1000,
+        'dropped_messages': websocket.WebSocket.dropped_messages,
+        'evicted_clients': websocket.WebSocket.evictions,
+        'queue_full_drops': exchange.dropped,
+        'memory_per_connection_kib': memory_per_connection / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url',
+                        default=os.environ.get('DATABASE_URL',
+                                               'postgresql://postgres@localhost/postgres'),
+                        help='database to use for the streamer session')
+    parser.add_argument('--clients', type=int, default=1000,
+                        help='number of simulated clients')
+    parser.add_argument('--pages', type=int, default=100,
+                        help='number of pages the clients are spread across')
+    parser.add_argument('--authenticated', type=float, default=0.5,
+                        help='fraction of clients which are logged in')
+    parser.add_argument('--slow-clients', type=float, default=0.0,
+                        help='fraction of clients which are slow to receive')
+    parser.add_argument('--slow-client-delay', type=float, default=50,
+                        help='milliseconds a slow client takes per message')
+    parser.add_argument('--events', type=int, default=10000,
+                        help='number of events to publish')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='events to publish per second (0: unthrottled)')
+    parser.add_argument('--user-events', type=float, default=0.1,
+                        help='fraction of events which are user events')
+    parser.add_argument('--private', type=float, default=0.1,
+                        help='fraction of annotations which are private')
+    parser.add_argument('--annotation-size', type=int, default=200,
+                        help='length of the text of each annotation')
+    parser.add_argument('--batch-size', type=int, default=1,
+                        help='h.streamer.batch_size setting')
+    parser.add_argument('--batch-latency-ms', type=float, default=10,
+                        help='h.streamer.batch_latency_ms setting')
+    parser.add_argument('--outbox-max-bytes', type=int,
+                        default=websocket.DEFAULT_OUTBOX_MAX_BYTES,
+                        help='h.streamer.outbox_max_bytes setting')
+    parser.add_argument('--outbox-overflow', default=websocket.OVERFLOW_CLOSE,
+                        choices=[websocket.OVERFLOW_CLOSE,
+                                 websocket.OVERFLOW_DROP_OLDEST],
+                        help='h.streamer.outbox_overflow setting')
+    parser.add_argument('--timeout', type=float, default=300,
+                        help='seconds to wait for the streamer to catch up')
+    parser.add_argument('--drain-timeout', type=float, default=5,
+                        help='seconds to wait for slow clients to drain')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed, for reproducible runs')
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    args = parser.parse_args()
+    args.database_url = database_url(args.database_url)
+
+    results = run(args)
+
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+        return
+
+    for name, value in sorted(results.items()):
+        if isinstance(value, float):
+            print('{:<28} {:12.2f}'.format(name, value))
+        else:
+            print('{:<28} {:12d}'.format(name, value))
+
+
+if __name__ == '__main__':
+    main()
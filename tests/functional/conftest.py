@@ -25,9 +25,11 @@ TEST_SETTINGS = {
 @pytest.fixture
 def app(pyramid_app, db_engine):
     from h import db
+    from h.util.uri_cache import EXPANDED_URIS
 
     _clean_database(db_engine)
     _clean_elasticsearch(TEST_SETTINGS)
+    EXPANDED_URIS.clear()
     db.init(db_engine, authority=text_type(TEST_SETTINGS['h.authority']))
 
     return TestApp(pyramid_app)
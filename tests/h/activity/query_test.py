@@ -14,6 +14,7 @@ from h.activity.query import (
     check_url,
     fetch_annotations,
 )
+from h.search.core import SearchResult
 
 
 class TestExtract(object):
@@ -321,6 +322,52 @@ class TestExecute(object):
         query = search.run.call_args[0][0]
         assert query['offset'] == 0
 
+    def test_it_uses_the_search_after_cursor_if_given(self, pyramid_request, search):
+        pyramid_request.params['page'] = '3'
+        pyramid_request.params['search_after'] = 'cursor'
+        search.run.return_value = SearchResult(14, [], [], {})
+
+        execute(pyramid_request, MultiDict(), self.PAGE_SIZE)
+
+        query = search.run.call_args[0][0]
+        assert query['search_after'] == 'cursor'
+
+    def test_it_counts_all_results_if_given_a_cursor(self, pyramid_request, search):
+        pyramid_request.params['page'] = '3'
+        pyramid_request.params['search_after'] = 'cursor'
+        search.run.return_value = SearchResult(14, [], [], {})
+        search.count_all.return_value = [57]
+
+        result = execute(pyramid_request, MultiDict(foo='bar'), self.PAGE_SIZE)
+
+        counted, = search.count_all.call_args[0][0]
+        assert 'search_after' not in counted
+        assert counted['foo'] == 'bar'
+        assert result.total == 57
+
+    def test_it_doesnt_ask_for_a_cursor_for_the_first_page(self, pyramid_request, search):
+        execute(pyramid_request, MultiDict(), self.PAGE_SIZE)
+
+        query = search.run.call_args[0][0]
+        assert 'search_after' not in query
+        assert not search.count_all.called
+
+    def test_it_asks_for_a_cursor_for_later_pages(self, pyramid_request, search):
+        pyramid_request.params['page'] = '2'
+
+        execute(pyramid_request, MultiDict(), self.PAGE_SIZE)
+
+        query = search.run.call_args[0][0]
+        assert query['search_after'] == ''
+        assert not search.count_all.called
+
+    def test_it_returns_the_next_cursor(self, pyramid_request, search):
+        search.run.return_value.next = 'cursor'
+
+        result = execute(pyramid_request, MultiDict(), self.PAGE_SIZE)
+
+        assert result.next == 'cursor'
+
     def test_it_passes_the_given_query_params_to_the_search(self,
                                                             pyramid_request,
                                                             search):
@@ -550,10 +597,11 @@ class TestExecute(object):
     @pytest.fixture
     def search(self, annotations):
         search = mock.Mock(
-            spec_set=['append_filter', 'append_aggregation', 'run'])
+            spec_set=['append_filter', 'append_aggregation', 'run', 'count_all'])
         search.run.return_value = mock.Mock(
-            spec_set=['total', 'aggregations', 'annotation_ids'])
+            spec_set=['total', 'aggregations', 'annotation_ids', 'next'])
         search.run.return_value.total = 20
+        search.run.return_value.next = None
         search.run.return_value.aggregations = mock.sentinel.aggregations
         search.run.return_value.annotation_ids = [
             annotation.id for annotation in annotations]
@@ -1,10 +1,15 @@
 # -*- coding: utf-8 -*-
 
+import datetime
+
 import mock
 import os
 import pytest
 
+from h import models
 from h.cli.commands import search
+from h.indexer.consistency import Drift
+from h.search.index import Window
 
 
 class TestReindexCommand(object):
@@ -19,12 +24,126 @@ class TestReindexCommand(object):
         assert result.exit_code == 0
         reindex.assert_called_once_with(pyramid_request.db,
                                         pyramid_request.es,
-                                        pyramid_request)
+                                        pyramid_request,
+                                        workers=1,
+                                        chunk_size=100,
+                                        window_size=2000,
+                                        resume=False)
+
+    def test_passes_options_to_reindex(self, cli, cliconfig, reindex):
+        result = cli.invoke(search.reindex,
+                            ['--workers', '8', '--chunk-size', '500', '--window-size', '5000'],
+                            obj=cliconfig)
+
+        assert result.exit_code == 0
+        _, kwargs = reindex.call_args
+        assert kwargs == {'workers': 8, 'chunk_size': 500, 'window_size': 5000,
+                          'resume': False}
+
+    def test_passes_resume_to_reindex(self, cli, cliconfig, reindex):
+        result = cli.invoke(search.reindex, ['--resume'], obj=cliconfig)
+
+        assert result.exit_code == 0
+        _, kwargs = reindex.call_args
+        assert kwargs['resume'] is True
+
+    def test_handles_runtimeerror(self, cli, cliconfig, reindex):
+        reindex.side_effect = RuntimeError('there is no interrupted reindex to resume')
+
+        result = cli.invoke(search.reindex, ['--resume'], obj=cliconfig)
+
+        assert result.exit_code == 1
+        assert 'no interrupted reindex' in result.output
+
+    def test_aborts_reindex(self, cli, cliconfig, indexer):
+        indexer.abort_reindex.return_value = 'hypothesis-abcd1234'
+
+        result = cli.invoke(search.reindex, ['--abort'], obj=cliconfig)
+
+        assert result.exit_code == 0
+        assert not indexer.reindex.called
+        assert 'hypothesis-abcd1234' in result.output
+
+    def test_handles_runtimeerror_when_aborting(self, cli, cliconfig, indexer):
+        indexer.abort_reindex.side_effect = RuntimeError('there is no interrupted reindex to abort')
+
+        result = cli.invoke(search.reindex, ['--abort'], obj=cliconfig)
+
+        assert result.exit_code == 1
+        assert 'no interrupted reindex' in result.output
+
+    def test_rejects_resume_with_abort(self, cli, cliconfig, indexer):
+        result = cli.invoke(search.reindex, ['--resume', '--abort'], obj=cliconfig)
+
+        assert result.exit_code == 2
+        assert not indexer.abort_reindex.called
+        assert not indexer.reindex.called
+
+    @pytest.fixture
+    def indexer(self, patch):
+        return patch('h.cli.commands.search.indexer')
 
     @pytest.fixture
-    def reindex(self, patch):
-        index = patch('h.cli.commands.search.indexer')
-        return index.reindex
+    def reindex(self, indexer):
+        return indexer.reindex
+
+
+class TestCheckIndexCommand(object):
+    def test_succeeds_when_index_matches_database(self, cli, cliconfig, pyramid_request, indexer):
+        result = cli.invoke(search.check_index, [], obj=cliconfig)
+
+        assert result.exit_code == 0
+        indexer.find_drift.assert_called_once_with(pyramid_request.db,
+                                                   pyramid_request.es,
+                                                   windowsize=2000)
+        assert 'matches the database' in result.output
+
+    def test_fails_and_lists_ids_when_index_differs(self, cli, cliconfig, indexer, drift):
+        indexer.find_drift.return_value = [drift]
+
+        result = cli.invoke(search.check_index, [], obj=cliconfig)
+
+        assert result.exit_code == 1
+        assert '1 stale, 1 deleted: abc123, def456' in result.output
+        assert not indexer.repair_drift.called
+
+    def test_repairs_drift(self, cli, cliconfig, pyramid_request, indexer, drift):
+        indexer.find_drift.return_value = [drift]
+
+        result = cli.invoke(search.check_index, ['--repair'], obj=cliconfig)
+
+        assert result.exit_code == 0
+        indexer.repair_drift.assert_called_once_with(pyramid_request.db,
+                                                     pyramid_request.es,
+                                                     pyramid_request,
+                                                     [drift])
+
+    def test_fails_when_repair_fails(self, cli, cliconfig, indexer, drift):
+        indexer.find_drift.return_value = [drift]
+        indexer.repair_drift.return_value = set(['abc123'])
+
+        result = cli.invoke(search.check_index, ['--repair'], obj=cliconfig)
+
+        assert result.exit_code == 1
+        assert 'failed to reindex 1 annotations' in result.output
+
+    def test_rejects_large_windows(self, cli, cliconfig, indexer):
+        result = cli.invoke(search.check_index, ['--window-size', '10000'], obj=cliconfig)
+
+        assert result.exit_code == 2
+        assert not indexer.find_drift.called
+
+    @pytest.fixture
+    def indexer(self, patch):
+        indexer = patch('h.cli.commands.search.indexer')
+        indexer.find_drift.return_value = []
+        indexer.repair_drift.return_value = set()
+        return indexer
+
+    @pytest.fixture
+    def drift(self):
+        window = Window(datetime.datetime(2017, 1, 1), None)
+        return Drift(window, set(['abc123']), set(['def456']))
 
 
 class TestUpdateSettingsCommand(object):
@@ -48,6 +167,142 @@ class TestUpdateSettingsCommand(object):
         return config.update_index_settings
 
 
+class TestSyncCommand(object):
+    def test_syncs_annotations_updated_since(self, cli, cliconfig, pyramid_request, sync):
+        result = cli.invoke(search.sync, ['--since', '2017-01-02T03:04:05'], obj=cliconfig)
+
+        assert result.exit_code == 0
+        sync.assert_called_once_with(pyramid_request.db,
+                                     pyramid_request.es,
+                                     pyramid_request,
+                                     datetime.datetime(2017, 1, 2, 3, 4, 5))
+        assert 'Synced 3 annotations' in result.output
+
+    def test_accepts_dates(self, cli, cliconfig, sync):
+        cli.invoke(search.sync, ['--since', '2017-01-02'], obj=cliconfig)
+
+        args, _ = sync.call_args
+        assert args[3] == datetime.datetime(2017, 1, 2)
+
+    def test_rejects_invalid_timestamps(self, cli, cliconfig, sync):
+        result = cli.invoke(search.sync, ['--since', 'yesterday'], obj=cliconfig)
+
+        assert result.exit_code == 2
+        assert not sync.called
+
+    def test_commits_after_each_sync(self, cli, cliconfig, pyramid_request, sync):
+        cli.invoke(search.sync, ['--since', '2017-01-02'], obj=cliconfig)
+
+        pyramid_request.tm.commit.assert_called_once_with()
+
+    def test_fails_when_annotations_fail_to_index(self, cli, cliconfig, sync):
+        sync.return_value = (3, set(['abc123']))
+
+        result = cli.invoke(search.sync, ['--since', '2017-01-02'], obj=cliconfig)
+
+        assert result.exit_code == 1
+        assert 'abc123' in result.output
+
+    def test_follow_keeps_syncing_from_shortly_before_each_sync(self, cli, cliconfig, sync, time):
+        sync.side_effect = [(3, set()), (1, set()), RuntimeError('stop')]
+
+        cli.invoke(search.sync, ['--since', '2017-01-02', '--follow',
+                                 '--interval', '5', '--overlap', '30'], obj=cliconfig)
+
+        assert sync.call_count == 3
+        first, second = [args[3] for args, _ in sync.call_args_list[1:]]
+        assert first > datetime.datetime(2017, 1, 2)
+        assert second >= first
+        time.sleep.assert_called_with(5)
+
+    @pytest.fixture
+    def sync(self, patch):
+        indexer = patch('h.cli.commands.search.indexer')
+        indexer.sync.return_value = (3, set())
+        return indexer.sync
+
+    @pytest.fixture
+    def time(self, patch):
+        return patch('h.cli.commands.search.time')
+
+    @pytest.fixture
+    def pyramid_request(self, pyramid_request):
+        pyramid_request.tm = mock.Mock()
+        return pyramid_request
+
+
+class TestRebuildBadgeCountsCommand(object):
+    def test_rebuilds_badge_counts(self, cli, cliconfig, badge_count_service):
+        badge_count_service.rebuild.return_value = 3
+
+        result = cli.invoke(search.rebuild_badge_counts, [], obj=cliconfig)
+
+        assert result.exit_code == 0
+        badge_count_service.rebuild.assert_called_once_with()
+        assert '3 pages' in result.output
+
+    def test_commits_the_counts(self, cli, cliconfig, pyramid_request):
+        cli.invoke(search.rebuild_badge_counts, [], obj=cliconfig)
+
+        pyramid_request.tm.commit.assert_called_once_with()
+
+    @pytest.fixture
+    def badge_count_service(self, pyramid_config):
+        svc = mock.Mock(spec_set=['rebuild'])
+        pyramid_config.register_service(svc, name='badge_count')
+        return svc
+
+    @pytest.fixture
+    def pyramid_request(self, pyramid_request):
+        pyramid_request.tm = mock.Mock()
+        return pyramid_request
+
+
+class TestCheckBadgeCountsCommand(object):
+    def test_succeeds_when_counts_match_search(self, cli, cliconfig, db_session, search_run):
+        db_session.add(models.BadgeCount(uri='httpx://example.com', count=2))
+        search_run.return_value = mock.Mock(total=2)
+
+        result = cli.invoke(search.check_badge_counts, [], obj=cliconfig)
+
+        assert result.exit_code == 0
+        search_run.assert_called_once_with({'uri': 'httpx://example.com',
+                                            'limit': 0})
+
+    def test_fails_when_counts_differ_from_search(self, cli, cliconfig, db_session, search_run):
+        db_session.add(models.BadgeCount(uri='httpx://example.com', count=2))
+        search_run.return_value = mock.Mock(total=3)
+
+        result = cli.invoke(search.check_badge_counts, [], obj=cliconfig)
+
+        assert result.exit_code == 1
+        assert 'httpx://example.com: stored 2, search index 3' in result.output
+
+    def test_checks_at_most_limit_pages(self, cli, cliconfig, db_session, search_run):
+        db_session.add(models.BadgeCount(uri='httpx://example.com', count=2))
+        db_session.add(models.BadgeCount(uri='httpx://example.org', count=2))
+        search_run.return_value = mock.Mock(total=2)
+
+        cli.invoke(search.check_badge_counts, ['--limit', '1'], obj=cliconfig)
+
+        assert search_run.call_count == 1
+
+    def test_checks_pages_of_recent_annotations_without_counts(self, cli, cliconfig, factories, search_run):
+        annotation = factories.Annotation(shared=True)
+        search_run.return_value = mock.Mock(total=1)
+
+        result = cli.invoke(search.check_badge_counts, [], obj=cliconfig)
+
+        assert result.exit_code == 1
+        assert '{}: stored 0, search index 1'.format(
+            annotation.target_uri_normalized) in result.output
+
+    @pytest.fixture
+    def search_run(self, patch):
+        Search = patch('h.cli.commands.search.Search')
+        return Search.return_value.run
+
+
 @pytest.fixture
 def cliconfig(pyramid_request):
     pyramid_request.es = mock.sentinel.es
@@ -22,6 +22,7 @@ from webob.multidict import MultiDict
 from h import db
 from h import form
 from h.settings import database_url
+from h.util import uri_cache
 from h._compat import text_type
 
 TEST_AUTHORITY = u'example.com'
@@ -152,6 +153,14 @@ def factories(db_session):
     factories.set_session(None)
 
 
+@pytest.yield_fixture(autouse=True)
+def expanded_uris():
+    """Stop URI expansions cached by one test leaking into the next."""
+    uri_cache.EXPANDED_URIS.clear()
+    yield uri_cache.EXPANDED_URIS
+    uri_cache.EXPANDED_URIS.clear()
+
+
 @pytest.fixture
 def fake_feature():
     return DummyFeature()
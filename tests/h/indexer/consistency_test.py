@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import calendar
+import datetime
+
+import mock
+import pytest
+
+from h.indexer import consistency
+from h.indexer.reindexer import SETTING_NEW_INDEX
+from h.search.index import Window
+from h.util.datetime import utc_iso8601
+
+
+class TestFindDrift(object):
+    def test_skips_windows_which_match(self, db_session, es, annotations, scan):
+        index_summary(es, annotations)
+        indexed(scan, annotations)
+
+        assert list(consistency.find_drift(db_session, es)) == []
+        # Only the ids are fetched.
+        _, kwargs = scan.call_args
+        assert kwargs['query']['_source'] is False
+
+    def test_finds_annotations_replaced_in_index_by_others_with_same_updated(
+            self, db_session, es, annotations, scan, factories):
+        deleted = factories.Annotation(updated=annotations[1].updated, deleted=True)
+        index_summary(es, annotations)
+        indexed(scan, annotations[:1], extra=[deleted])
+
+        drift, = consistency.find_drift(db_session, es)
+
+        assert drift.stale == set([annotations[1].id])
+        assert drift.deleted == set([deleted.id])
+
+    def test_finds_annotations_missing_from_index(self, db_session, es, annotations, scan):
+        index_summary(es, annotations[:1])
+        indexed(scan, annotations[:1])
+
+        drifts = list(consistency.find_drift(db_session, es))
+
+        assert len(drifts) == 1
+        assert drifts[0].window == Window(annotations[0].updated, None)
+        assert drifts[0].stale == set([annotations[1].id])
+        assert drifts[0].deleted == set()
+
+    def test_finds_annotations_out_of_date_in_index(self, db_session, es, annotations, scan):
+        index_summary(es, annotations, offset=1)
+        indexed(scan, annotations, stale=annotations[1])
+
+        drift, = consistency.find_drift(db_session, es)
+
+        assert drift.stale == set([annotations[1].id])
+
+    def test_finds_deleted_annotations_still_in_index(self, db_session, es, annotations, scan,
+                                                      factories):
+        deleted = factories.Annotation(updated=annotations[0].updated, deleted=True)
+        index_summary(es, annotations + [deleted])
+        indexed(scan, annotations, extra=[deleted])
+
+        drift, = consistency.find_drift(db_session, es)
+
+        assert drift.stale == set()
+        assert drift.deleted == set([deleted.id])
+
+    def test_ignores_annotations_updated_into_another_window(self, db_session, es, annotations,
+                                                             scan):
+        index_summary(es, annotations, offset=1)
+        moved = mock.Mock(id=annotations[1].id, updated=annotations[0].updated)
+        indexed(scan, annotations, extra=[moved])
+
+        assert list(consistency.find_drift(db_session, es, windowsize=1)) == []
+
+    @pytest.fixture
+    def annotations(self, db_session, factories):
+        annotations = [
+            factories.Annotation(updated=datetime.datetime(2017, 1, 1, 0, 0, 0, 123000)),
+            factories.Annotation(updated=datetime.datetime(2017, 1, 2, 0, 0, 0, 456000)),
+        ]
+        return annotations
+
+    @pytest.fixture
+    def es(self):
+        return mock.Mock(spec_set=['conn', 'index', 't'])
+
+
+class TestRepairDrift(object):
+    def test_reindexes_stale_annotations(self, es, pyramid_request, BatchIndexer, delete):
+        drifts = [consistency.Drift(mock.sentinel.window_1, set(['a']), set()),
+                  consistency.Drift(mock.sentinel.window_2, set(['b']), set())]
+
+        consistency.repair_drift(mock.sentinel.session, es, pyramid_request, drifts)
+
+        BatchIndexer.assert_called_once_with(mock.sentinel.session, es, pyramid_request,
+                                             target_index=None)
+        BatchIndexer.return_value.index.assert_called_once_with(set(['a', 'b']))
+
+    def test_marks_deleted_annotations_as_deleted(self, es, pyramid_request, BatchIndexer,
+                                                  delete):
+        drifts = [consistency.Drift(mock.sentinel.window, set(), set(['c']))]
+
+        consistency.repair_drift(mock.sentinel.session, es, pyramid_request, drifts)
+
+        delete.assert_called_once_with(es, 'c', target_index=None)
+        assert not BatchIndexer.called
+
+    def test_repairs_new_index_during_reindex(self, es, pyramid_request, settings_service,
+                                              BatchIndexer, delete):
+        settings_service.get.return_value = 'hypothesis-abcd1234'
+        drifts = [consistency.Drift(mock.sentinel.window, set(['a']), set(['c']))]
+
+        consistency.repair_drift(mock.sentinel.session, es, pyramid_request, drifts)
+
+        settings_service.get.assert_called_once_with(SETTING_NEW_INDEX)
+        assert BatchIndexer.call_args_list == [
+            mock.call(mock.sentinel.session, es, pyramid_request, target_index=None),
+            mock.call(mock.sentinel.session, es, pyramid_request,
+                      target_index='hypothesis-abcd1234'),
+        ]
+        assert delete.call_args_list == [
+            mock.call(es, 'c', target_index=None),
+            mock.call(es, 'c', target_index='hypothesis-abcd1234'),
+        ]
+
+    def test_returns_errored_ids(self, es, pyramid_request, BatchIndexer, delete):
+        BatchIndexer.return_value.index.return_value = set(['a'])
+        drifts = [consistency.Drift(mock.sentinel.window, set(['a']), set())]
+
+        result = consistency.repair_drift(mock.sentinel.session, es, pyramid_request, drifts)
+
+        assert result == set(['a'])
+
+    @pytest.fixture
+    def es(self):
+        return mock.Mock(spec_set=['conn', 'index', 't'])
+
+    @pytest.fixture
+    def settings_service(self, pyramid_config):
+        service = mock.Mock(spec_set=['get'])
+        service.get.return_value = None
+        pyramid_config.register_service(service, name='settings')
+        return service
+
+    @pytest.fixture
+    def pyramid_request(self, pyramid_request, settings_service):
+        return pyramid_request
+
+    @pytest.fixture
+    def BatchIndexer(self, patch):
+        return patch('h.indexer.consistency.BatchIndexer')
+
+    @pytest.fixture
+    def delete(self, patch):
+        return patch('h.indexer.consistency.index.delete')
+
+
+def index_summary(es, annotations, offset=0):
+    """Make the search index's summary of every window match `annotations`."""
+    checksum = sum(_ms(a.updated) for a in annotations) + offset
+    es.conn.search.return_value = {
+        'hits': {'total': len(annotations), 'hits': []},
+        'aggregations': {'checksum': {'value': float(checksum)}},
+    }
+
+
+def indexed(scan, annotations, stale=None, extra=()):
+    """Make the search index contain `annotations` (and `extra`)."""
+    def hit(annotation):
+        updated = utc_iso8601(annotation.updated)
+        if annotation is stale:
+            updated = utc_iso8601(annotation.updated - datetime.timedelta(days=1))
+        return {'_id': annotation.id, '_source': {'updated': updated}}
+
+    def fake_scan(conn, query, **kwargs):
+        filter_ = query['query']['filtered']['filter']
+        if 'ids' in filter_:
+            return [hit(a) for a in annotations if a.id in filter_['ids']['values']]
+        return [hit(a) for a in list(annotations) + list(extra)]
+
+    scan.side_effect = fake_scan
+
+
+def _ms(dt):
+    return calendar.timegm(dt.timetuple()) * 1000 + dt.microsecond // 1000
+
+
+@pytest.fixture
+def scan(patch):
+    return patch('h.indexer.consistency.es_helpers.scan')
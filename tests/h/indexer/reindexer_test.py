@@ -1,17 +1,28 @@
 # -*- coding: utf-8 -*-
 
+import datetime
+
 import mock
 import pytest
 
-from h.indexer.reindexer import reindex, SETTING_NEW_INDEX
+from h.indexer import reindexer
+from h.indexer.reindexer import abort, reindex, SETTING_CHECKPOINT, SETTING_NEW_INDEX
 from h.search import client
+from h.search.index import Window
+
+WINDOWS = [
+    Window(datetime.datetime(2017, 1, 1), datetime.datetime(2017, 1, 2)),
+    Window(datetime.datetime(2017, 1, 2), datetime.datetime(2017, 1, 3)),
+    Window(datetime.datetime(2017, 1, 3), None),
+]
 
 
 @pytest.mark.usefixtures('BatchIndexer',
                          'configure_index',
                          'get_aliased_index',
                          'update_aliased_index',
-                         'settings_service')
+                         'settings_service',
+                         'windows')
 class TestReindex(object):
     def test_sets_op_type_to_create(self, pyramid_request, es, BatchIndexer):
         reindex(mock.sentinel.session, es, pyramid_request)
@@ -19,22 +30,21 @@ class TestReindex(object):
         _, kwargs = BatchIndexer.call_args
         assert kwargs['op_type'] == 'create'
 
-    def test_indexes_annotations(self, pyramid_request, es, batchindexer):
-        """Should call .index() on the batch indexer instance."""
+    def test_indexes_annotations_window_by_window(self, pyramid_request, es, batchindexer, windows):
         reindex(mock.sentinel.session, es, pyramid_request)
 
-        batchindexer.index.assert_called_once_with()
+        windows.assert_called_once_with(mock.sentinel.session, windowsize=2000, since=None)
+        assert batchindexer.index_window.mock_calls == [mock.call(w) for w in WINDOWS]
 
     def test_retries_failed_annotations(self, pyramid_request, es, batchindexer):
-        """Should call .index() a second time with any failed annotation IDs."""
-        batchindexer.index.return_value = ['abc123', 'def456']
+        """Should call .index() with any failed annotation IDs."""
+        batchindexer.index_window.side_effect = [(2, set(['abc123'])),
+                                                 (2, set()),
+                                                 (1, set(['def456']))]
 
         reindex(mock.sentinel.session, es, pyramid_request)
 
-        assert batchindexer.index.mock_calls == [
-            mock.call(),
-            mock.call(['abc123', 'def456']),
-        ]
+        batchindexer.index.assert_called_once_with(set(['abc123', 'def456']))
 
     def test_creates_new_index(self, pyramid_request, es, configure_index, matchers):
         """Creates a new target index."""
@@ -60,8 +70,8 @@ class TestReindex(object):
         update_aliased_index.assert_called_once_with(es, 'hypothesis-abcd1234')
 
     def test_does_not_update_alias_if_indexing_fails(self, pyramid_request, es, batchindexer, update_aliased_index):
-        """Don't call update_aliased_index if index() fails..."""
-        batchindexer.index.side_effect = RuntimeError('fail')
+        """Don't call update_aliased_index if indexing fails..."""
+        batchindexer.index_window.side_effect = RuntimeError('fail')
 
         try:
             reindex(mock.sentinel.session, es, pyramid_request)
@@ -81,20 +91,108 @@ class TestReindex(object):
 
         reindex(mock.sentinel.session, es, pyramid_request)
 
-        settings_service.put.assert_called_once_with(SETTING_NEW_INDEX, 'hypothesis-abcd1234')
+        settings_service.put.assert_any_call(SETTING_NEW_INDEX, 'hypothesis-abcd1234')
+
+    def test_checkpoints_end_of_each_completed_window(self, pyramid_request, es, settings_service):
+        reindex(mock.sentinel.session, es, pyramid_request)
+
+        checkpoints = [args[1] for args, _ in settings_service.put.call_args_list
+                       if args[0] == SETTING_CHECKPOINT]
+        assert checkpoints == ['2017-01-02T00:00:00.000000', '2017-01-03T00:00:00.000000']
 
-    def test_deletes_index_name_setting(self, pyramid_request, es, settings_service):
+    def test_deletes_settings_when_reindexed(self, pyramid_request, es, settings_service):
         reindex(mock.sentinel.session, es, pyramid_request)
 
-        settings_service.delete.assert_called_once_with(SETTING_NEW_INDEX)
+        settings_service.delete.assert_any_call(SETTING_NEW_INDEX)
+        settings_service.delete.assert_any_call(SETTING_CHECKPOINT)
+
+    def test_keeps_settings_when_exception_raised(self, pyramid_request, es, settings_service, batchindexer):
+        batchindexer.index_window.side_effect = [(2, set()), RuntimeError('boom!')]
+
+        with pytest.raises(RuntimeError):
+            reindex(mock.sentinel.session, es, pyramid_request)
+
+        assert mock.call(SETTING_NEW_INDEX) not in settings_service.delete.mock_calls
+        settings_service.put.assert_called_with(SETTING_CHECKPOINT, '2017-01-02T00:00:00.000000')
 
-    def test_deletes_index_name_setting_when_exception_raised(self, pyramid_request, es, settings_service, batchindexer):
-        batchindexer.index.side_effect = RuntimeError('boom!')
+    def test_logs_error_when_exception_raised(self, patch, pyramid_request, es, batchindexer):
+        log = patch('h.indexer.reindexer.log')
+        batchindexer.index_window.side_effect = RuntimeError('boom!')
 
         with pytest.raises(RuntimeError):
             reindex(mock.sentinel.session, es, pyramid_request)
 
-        settings_service.delete.assert_called_once_with(SETTING_NEW_INDEX)
+        assert log.exception.called
+
+    def test_resume_continues_into_same_index_from_checkpoint(self, pyramid_request, es,
+                                                              settings_service, configure_index,
+                                                              BatchIndexer, windows):
+        settings_service.get.side_effect = {
+            SETTING_NEW_INDEX: 'hypothesis-abcd1234',
+            SETTING_CHECKPOINT: '2017-01-02T00:00:00.000000',
+        }.get
+
+        reindex(mock.sentinel.session, es, pyramid_request, resume=True)
+
+        assert not configure_index.called
+        _, kwargs = BatchIndexer.call_args
+        assert kwargs['target_index'] == 'hypothesis-abcd1234'
+        _, kwargs = windows.call_args
+        assert kwargs['since'] == datetime.datetime(2017, 1, 2)
+
+    def test_resume_raises_if_no_reindex_to_resume(self, pyramid_request, es, settings_service):
+        settings_service.get.return_value = None
+
+        with pytest.raises(RuntimeError):
+            reindex(mock.sentinel.session, es, pyramid_request, resume=True)
+
+    def test_passes_sizes_to_indexer(self, pyramid_request, es, BatchIndexer, windows):
+        reindex(mock.sentinel.session, es, pyramid_request, chunk_size=500, window_size=5000)
+
+        _, kwargs = BatchIndexer.call_args
+        assert kwargs['chunk_size'] == 500
+        assert kwargs['window_size'] == 5000
+        _, kwargs = windows.call_args
+        assert kwargs['windowsize'] == 5000
+
+    def test_indexes_windows_in_parallel_with_workers(self, pyramid_request, es, batchindexer, pool):
+        reindex(mock.Mock(), es, pyramid_request, workers=4)
+
+        _, kwargs = reindexer.multiprocessing.Pool.call_args
+        assert reindexer.multiprocessing.Pool.call_args[0] == (4,)
+        assert kwargs['initializer'] == reindexer._init_worker
+        pool.imap.assert_called_once_with(reindexer._index_window, WINDOWS)
+        assert not batchindexer.index_window.called
+
+    def test_checkpoints_windows_completed_in_parallel(self, pyramid_request, es, settings_service, pool):
+        reindex(mock.Mock(), es, pyramid_request, workers=4)
+
+        checkpoints = [args[1] for args, _ in settings_service.put.call_args_list
+                       if args[0] == SETTING_CHECKPOINT]
+        assert checkpoints == ['2017-01-02T00:00:00.000000', '2017-01-03T00:00:00.000000']
+
+    def test_closes_database_connections_before_forking_workers(self, pyramid_request, es, pool):
+        session = mock.Mock()
+
+        reindex(session, es, pyramid_request, workers=4)
+
+        session.close.assert_called_once_with()
+        pyramid_request.registry['sqlalchemy.engine'].dispose.assert_called_once_with()
+
+    def test_retries_annotations_which_failed_in_workers(self, pyramid_request, es, batchindexer, pool):
+        pool.imap.return_value = [(2, set(['abc123'])), (3, set(['def456'])), (1, set())]
+
+        reindex(mock.Mock(), es, pyramid_request, workers=4)
+
+        batchindexer.index.assert_called_once_with(set(['abc123', 'def456']))
+
+    def test_terminates_workers_when_indexing_fails(self, pyramid_request, es, pool):
+        pool.imap.side_effect = RuntimeError('boom!')
+
+        with pytest.raises(RuntimeError):
+            reindex(mock.Mock(), es, pyramid_request, workers=4)
+
+        pool.terminate.assert_called_once_with()
 
     @pytest.fixture
     def BatchIndexer(self, patch):
@@ -118,8 +216,22 @@ class TestReindex(object):
     def batchindexer(self, BatchIndexer):
         indexer = BatchIndexer.return_value
         indexer.index.return_value = []
+        indexer.index_window.return_value = (2, set())
         return indexer
 
+    @pytest.fixture
+    def pool(self, patch):
+        multiprocessing = patch('h.indexer.reindexer.multiprocessing')
+        pool = multiprocessing.Pool.return_value
+        pool.imap.return_value = [(2, set()), (3, set()), (1, set())]
+        return pool
+
+    @pytest.fixture
+    def windows(self, patch):
+        windows = patch('h.indexer.reindexer.index.windows')
+        windows.return_value = WINDOWS
+        return windows
+
     @pytest.fixture
     def es(self):
         mock_es = mock.Mock(spec=client.Client('localhost', 'hypothesis'))
@@ -136,4 +248,85 @@ class TestReindex(object):
     @pytest.fixture
     def pyramid_request(self, pyramid_request):
         pyramid_request.tm = mock.Mock()
+        pyramid_request.registry['sqlalchemy.engine'] = mock.Mock()
+        return pyramid_request
+
+
+class TestAbort(object):
+    def test_deletes_settings(self, pyramid_request, settings_service):
+        abort(pyramid_request)
+
+        settings_service.delete.assert_any_call(SETTING_NEW_INDEX)
+        settings_service.delete.assert_any_call(SETTING_CHECKPOINT)
+        pyramid_request.tm.commit.assert_called_once_with()
+
+    def test_returns_new_index(self, pyramid_request, settings_service):
+        assert abort(pyramid_request) == 'hypothesis-abcd1234'
+
+    def test_raises_if_no_reindex_to_abort(self, pyramid_request, settings_service):
+        settings_service.get.return_value = None
+
+        with pytest.raises(RuntimeError):
+            abort(pyramid_request)
+
+        assert not settings_service.delete.called
+
+    @pytest.fixture
+    def settings_service(self, pyramid_config):
+        service = mock.Mock(spec_set=['get', 'delete'])
+        service.get.return_value = 'hypothesis-abcd1234'
+        pyramid_config.register_service(service, name='settings')
+        return service
+
+    @pytest.fixture
+    def pyramid_request(self, pyramid_request):
+        pyramid_request.tm = mock.Mock()
+        return pyramid_request
+
+
+class TestIndexWindow(object):
+    def test_worker_indexes_windows_with_its_own_connections(self, pyramid_request,
+                                                            BatchIndexer, db, get_client):
+        reindexer._init_worker(pyramid_request, 'hypothesis-abcd1234', 500)
+
+        BatchIndexer.assert_called_once_with(db.Session.return_value,
+                                             get_client.return_value,
+                                             pyramid_request,
+                                             target_index='hypothesis-abcd1234',
+                                             op_type='create',
+                                             chunk_size=500)
+
+    def test_it_indexes_window(self, pyramid_request, BatchIndexer, db, get_client):
+        indexer = BatchIndexer.return_value
+        indexer.index_window.return_value = (3, set())
+        reindexer._init_worker(pyramid_request, 'hypothesis-abcd1234', 500)
+
+        result = reindexer._index_window(mock.sentinel.window)
+
+        indexer.index_window.assert_called_once_with(mock.sentinel.window)
+        assert result == (3, set())
+
+    def test_it_closes_session_after_each_window(self, pyramid_request, BatchIndexer, db,
+                                                 get_client):
+        reindexer._init_worker(pyramid_request, 'hypothesis-abcd1234', 500)
+
+        reindexer._index_window(mock.sentinel.window)
+
+        BatchIndexer.return_value.session.close.assert_called_once_with()
+
+    @pytest.fixture
+    def BatchIndexer(self, patch):
+        return patch('h.indexer.reindexer.BatchIndexer')
+
+    @pytest.fixture
+    def db(self, patch):
+        return patch('h.indexer.reindexer.db')
+
+    @pytest.fixture
+    def get_client(self, patch):
+        return patch('h.indexer.reindexer.get_client')
+
+    @pytest.fixture
+    def pyramid_request(self, pyramid_request):
+        pyramid_request.registry['sqlalchemy.engine'] = mock.Mock()
         return pyramid_request
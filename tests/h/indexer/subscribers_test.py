@@ -6,7 +6,7 @@ from h import events
 from h.indexer import subscribers
 
 
-@pytest.mark.usefixtures('add_annotation', 'delete_annotation')
+@pytest.mark.usefixtures('add_annotation', 'add_annotations', 'delete_annotation')
 class TestSubscribeAnnotationEvent(object):
 
     @pytest.mark.parametrize('action', ['create', 'update'])
@@ -24,6 +24,22 @@ class TestSubscribeAnnotationEvent(object):
         add_annotation.delay.assert_called_once_with(event.annotation_id)
         assert not delete_annotation.delay.called
 
+    @pytest.mark.parametrize('action', ['create', 'update'])
+    def test_it_enqueues_add_annotations_celery_task_when_coalescing(self,
+                                                                     action,
+                                                                     add_annotation,
+                                                                     add_annotations,
+                                                                     pyramid_request):
+        pyramid_request.registry.settings['h.indexer.coalesce'] = 'true'
+        event = events.AnnotationEvent(pyramid_request,
+                                       {'id': 'test_annotation_id'},
+                                       action)
+
+        subscribers.subscribe_annotation_event(event)
+
+        add_annotations.delay.assert_called_once_with(event.annotation_id)
+        assert not add_annotation.delay.called
+
     def test_it_enqueues_delete_annotation_celery_task_for_delete(self,
                                                                   add_annotation,
                                                                   delete_annotation,
@@ -41,6 +57,10 @@ class TestSubscribeAnnotationEvent(object):
     def add_annotation(self, patch):
         return patch('h.indexer.subscribers.add_annotation')
 
+    @pytest.fixture
+    def add_annotations(self, patch):
+        return patch('h.indexer.subscribers.add_annotations')
+
     @pytest.fixture
     def delete_annotation(self, patch):
         return patch('h.indexer.subscribers.delete_annotation')
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+
+import mock
+import pytest
+
+from h.indexer.reindexer import SETTING_NEW_INDEX
+from h.indexer.sync import sync
+
+SINCE = datetime.datetime(2017, 1, 2)
+
+
+@pytest.mark.usefixtures('settings_service')
+class TestSync(object):
+    def test_syncs_current_index(self, pyramid_request, BatchIndexer):
+        sync(mock.sentinel.session, mock.sentinel.es, pyramid_request, SINCE)
+
+        BatchIndexer.assert_called_once_with(mock.sentinel.session,
+                                             mock.sentinel.es,
+                                             pyramid_request,
+                                             target_index=None)
+        BatchIndexer.return_value.sync.assert_called_once_with(SINCE)
+
+    def test_during_reindex_syncs_new_index(self, pyramid_request, BatchIndexer, settings_service):
+        settings_service.get.return_value = 'hypothesis-abcd1234'
+
+        sync(mock.sentinel.session, mock.sentinel.es, pyramid_request, SINCE)
+
+        settings_service.get.assert_called_once_with(SETTING_NEW_INDEX)
+        _, kwargs = BatchIndexer.call_args
+        assert kwargs['target_index'] == 'hypothesis-abcd1234'
+        assert BatchIndexer.return_value.sync.call_count == 2
+
+    def test_returns_count_and_errored_ids(self, pyramid_request, BatchIndexer):
+        BatchIndexer.return_value.sync.return_value = (3, set(['abc123']))
+
+        result = sync(mock.sentinel.session, mock.sentinel.es, pyramid_request, SINCE)
+
+        assert result == (3, set(['abc123']))
+
+    @pytest.fixture
+    def BatchIndexer(self, patch):
+        BatchIndexer = patch('h.indexer.sync.BatchIndexer')
+        BatchIndexer.return_value.sync.return_value = (0, set())
+        return BatchIndexer
+
+    @pytest.fixture
+    def settings_service(self, pyramid_config):
+        service = mock.Mock(spec_set=['get'])
+        service.get.return_value = None
+        pyramid_config.register_service(service, name='settings')
+        return service
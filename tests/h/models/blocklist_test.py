@@ -15,6 +15,22 @@ def test_is_blocked(db_session):
     assert not models.Blocklist.is_blocked(db_session, "http://example.com/foo")
 
 
+def test_blocked(db_session):
+    db_session.add(models.Blocklist(uri="http://example.com"))
+    db_session.add(models.Blocklist(uri="%//example.org%"))
+    db_session.flush()
+
+    blocked = models.Blocklist.blocked(db_session, ["http://example.com",
+                                                    "http://example.com/foo",
+                                                    "http://example.org/bar"])
+
+    assert blocked == set(["http://example.com", "http://example.org/bar"])
+
+
+def test_blocked_with_no_uris(db_session):
+    assert models.Blocklist.blocked(db_session, []) == set()
+
+
 def test_is_blocked_with_wildcards(db_session):
     db_session.add(models.Blocklist(uri="%//example.com%"))
     db_session.flush()
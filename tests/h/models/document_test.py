@@ -675,6 +675,18 @@ class TestMergeDocuments(object):
         assert 0 == \
             db_session.query(models.Annotation).filter_by(document_id=duplicate_2.id).count()
 
+    def test_merge_documents_invalidates_expanded_uris(self,
+                                                       db_session,
+                                                       merge_data,
+                                                       invalidate_expanded_uris):
+        master = document.merge_documents(db_session, merge_data)
+
+        invalidate_expanded_uris.assert_called_once_with(db_session, master)
+
+    @pytest.fixture
+    def invalidate_expanded_uris(self, patch):
+        return patch('h.models.document._invalidate_expanded_uris')
+
     def test_raises_retryable_error_when_flush_fails(self, db_session, merge_data, monkeypatch):
         def err():
             raise sa.exc.IntegrityError(None, None, None)
@@ -931,6 +943,25 @@ class TestUpdateDocumentMetadata(object):
                 **document_meta_dict
             )
 
+    def test_it_invalidates_expanded_uris(self,
+                                          annotation,
+                                          Document,
+                                          invalidate_expanded_uris,
+                                          session):
+        Document.find_or_create_by_uris.return_value.count.return_value = 1
+
+        document.update_document_metadata(session,
+                                          annotation.target_uri,
+                                          [],
+                                          [],
+                                          annotation.created,
+                                          annotation.updated)
+
+        invalidate_expanded_uris.assert_called_once_with(
+            session,
+            Document.find_or_create_by_uris.return_value.first.return_value,
+            annotation.target_uri)
+
     def test_it_returns_a_document(self,
                                    annotation,
                                    create_or_update_document_meta,
@@ -967,11 +998,59 @@ class TestUpdateDocumentMetadata(object):
     def merge_documents(self, patch):
         return patch('h.models.document.merge_documents')
 
+    @pytest.fixture(autouse=True)
+    def invalidate_expanded_uris(self, patch):
+        return patch('h.models.document._invalidate_expanded_uris')
+
     @pytest.fixture
     def session(self, db_session):
         return mock.Mock(spec=db_session)
 
 
+class TestInvalidateExpandedURIs(object):
+    def test_it_invalidates_the_documents_uris_once_committed(self, session, expanded_uris):
+        expanded_uris.set('http://example.com/', ['http://example.com/'])
+        expanded_uris.set('http://example.org/', ['http://example.org/'])
+        doc = document.Document(document_uris=[
+            document.DocumentURI(claimant='http://example.com/', uri='http://example.com/')])
+
+        document._invalidate_expanded_uris(session, doc, 'http://example.org/')
+
+        assert len(expanded_uris) == 2
+        session.commit()
+        assert len(expanded_uris) == 0
+
+    def test_it_does_not_invalidate_uris_if_rolled_back(self, session, expanded_uris):
+        expanded_uris.set('http://example.com/', ['http://example.com/'])
+        doc = document.Document()
+
+        document._invalidate_expanded_uris(session, doc, 'http://example.com/')
+        session.rollback()
+        session.commit()
+
+        assert len(expanded_uris) == 1
+
+    def test_it_waits_for_the_outermost_transaction(self, session, expanded_uris):
+        expanded_uris.set('http://example.com/', ['http://example.com/'])
+        doc = document.Document()
+
+        session.begin_nested()
+        document._invalidate_expanded_uris(session, doc, 'http://example.com/')
+        session.commit()
+
+        assert len(expanded_uris) == 1
+        session.commit()
+        assert len(expanded_uris) == 0
+
+    @pytest.fixture
+    def session(self, db_engine):
+        # A session of its own, whose outermost transaction can be committed,
+        # as the db_session fixture's can't. Nothing is written with it.
+        session = sa.orm.Session(bind=db_engine)
+        yield session
+        session.close()
+
+
 def now():
     return datetime.datetime.now()
 
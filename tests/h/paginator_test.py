@@ -149,6 +149,26 @@ class TestPaginate(object):
             _query=expected)
         assert url == pyramid_request.current_route_path.return_value
 
+    def test_url_for_next_page_includes_cursor(self, pyramid_request):
+        pyramid_request.params = NestedMultiDict({'page': '32'})
+        pyramid_request.current_route_path = mock.Mock(spec_set=['__call__'])
+        url_for = paginate(pyramid_request, 600, 10, next_cursor='cursor')['url_for']
+
+        url_for(page=33)
+
+        pyramid_request.current_route_path.assert_called_once_with(
+            _query={'page': 33, 'search_after': 'cursor'})
+
+    def test_url_for_other_pages_drops_cursor(self, pyramid_request):
+        pyramid_request.params = NestedMultiDict({'page': '32',
+                                                  'search_after': 'old'})
+        pyramid_request.current_route_path = mock.Mock(spec_set=['__call__'])
+        url_for = paginate(pyramid_request, 600, 10, next_cursor='cursor')['url_for']
+
+        url_for(page=26)
+
+        pyramid_request.current_route_path.assert_called_once_with(
+            _query={'page': 26})
 
 @pytest.mark.usefixtures('paginate')
 class TestPaginateQuery(object):
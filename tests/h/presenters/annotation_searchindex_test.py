@@ -31,7 +31,8 @@ class TestAnnotationSearchIndexPresenter(object):
             extra={'extra-1': 'foo', 'extra-2': 'bar'})
         DocumentSearchIndexPresenter.return_value.asdict.return_value = {'foo': 'bar'}
 
-        annotation_dict = AnnotationSearchIndexPresenter(annotation).asdict()
+        annotation_dict = AnnotationSearchIndexPresenter(annotation,
+                                                         include_extra=True).asdict()
 
         assert annotation_dict == {
             'id': 'xyz123',
@@ -51,6 +52,7 @@ class TestAnnotationSearchIndexPresenter(object):
             'document': {'foo': 'bar'},
             'references': ['referenced-id-1', 'referenced-id-2'],
             'thread_ids': ['thread-id-1', 'thread-id-2'],
+            'extra': {'extra-1': 'foo', 'extra-2': 'bar'},
         }
 
     def test_it_copies_target_uri_normalized_to_target_scope(self):
@@ -63,6 +65,21 @@ class TestAnnotationSearchIndexPresenter(object):
         assert annotation_dict['target'][0]['scope'] == [
             'http://example.com/normalized']
 
+    def test_it_presents_missing_extra_as_empty(self):
+        annotation = mock.Mock(extra=None)
+
+        annotation_dict = AnnotationSearchIndexPresenter(annotation,
+                                                         include_extra=True).asdict()
+
+        assert annotation_dict['extra'] == {}
+
+    def test_it_omits_extra_by_default(self):
+        annotation = mock.Mock(extra={'extra-1': 'foo'})
+
+        annotation_dict = AnnotationSearchIndexPresenter(annotation).asdict()
+
+        assert 'extra' not in annotation_dict
+
     @pytest.fixture
     def DocumentSearchIndexPresenter(self, patch):
         class_ = patch('h.presenters.annotation_searchindex.DocumentSearchIndexPresenter')
@@ -84,6 +84,7 @@ def test_includeme():
         call('api.users', '/api/users'),
         call('api.user', '/api/users/{username}'),
         call('badge', '/api/badge'),
+        call('badges', '/api/badges'),
         call('token', '/api/token'),
         call('oauth_authorize', '/oauth/authorize'),
         call('oauth_revoke', '/oauth/revoke'),
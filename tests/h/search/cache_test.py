@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import mock
+import pytest
+
+from h import events
+from h.search import cache
+
+
+class TestSearchCache(object):
+    def test_get_returns_none_for_missing_keys(self):
+        search_cache = cache.SearchCache()
+
+        assert search_cache.get('key') is None
+        assert search_cache.misses == 1
+
+    def test_get_returns_cached_response(self):
+        search_cache = cache.SearchCache()
+        search_cache.set('key', None, {'hits': {}})
+
+        assert search_cache.get('key') == {'hits': {}}
+        assert search_cache.hits == 1
+
+    def test_get_expires_entries(self, clock):
+        search_cache = cache.SearchCache(ttl=30, clock=clock)
+        search_cache.set('key', None, {'hits': {}})
+
+        clock.return_value = 30
+
+        assert search_cache.get('key') is None
+        assert len(search_cache) == 0
+
+    def test_set_evicts_least_recently_used(self):
+        search_cache = cache.SearchCache(maxsize=2)
+        search_cache.set('a', None, 'a')
+        search_cache.set('b', None, 'b')
+        search_cache.get('a')
+
+        search_cache.set('c', None, 'c')
+
+        assert search_cache.get('a') == 'a'
+        assert search_cache.get('b') is None
+        assert search_cache.get('c') == 'c'
+
+    def test_invalidate_drops_entries_for_scope(self):
+        search_cache = cache.SearchCache()
+        search_cache.set('a', frozenset(['http://a.com']), 'a')
+        search_cache.set('b', frozenset(['http://b.com']), 'b')
+
+        search_cache.invalidate('http://a.com')
+
+        assert search_cache.get('a') is None
+        assert search_cache.get('b') == 'b'
+
+    def test_invalidate_drops_unscoped_entries(self):
+        search_cache = cache.SearchCache()
+        search_cache.set('a', None, 'a')
+
+        search_cache.invalidate('http://a.com')
+
+        assert search_cache.get('a') is None
+
+    def test_invalidate_none_drops_all_entries(self):
+        search_cache = cache.SearchCache()
+        search_cache.set('a', frozenset(['http://a.com']), 'a')
+        search_cache.set('b', None, 'b')
+
+        search_cache.invalidate(None)
+
+        assert len(search_cache) == 0
+
+    def test_set_does_not_cache_recently_changed_scopes(self, clock):
+        search_cache = cache.SearchCache(settle=5, clock=clock)
+        search_cache.invalidate('http://a.com')
+
+        clock.return_value = 4
+        search_cache.set('a', frozenset(['http://a.com']), 'a')
+        search_cache.set('b', frozenset(['http://b.com']), 'b')
+
+        assert search_cache.get('a') is None
+        assert search_cache.get('b') == 'b'
+
+    def test_set_does_not_cache_unscoped_entries_after_any_change(self, clock):
+        search_cache = cache.SearchCache(settle=5, clock=clock)
+        search_cache.invalidate('http://a.com')
+
+        clock.return_value = 4
+        search_cache.set('a', None, 'a')
+
+        assert search_cache.get('a') is None
+
+    def test_set_caches_scopes_once_settled(self, clock):
+        search_cache = cache.SearchCache(settle=5, clock=clock)
+        search_cache.invalidate('http://a.com')
+
+        clock.return_value = 5
+        search_cache.set('a', frozenset(['http://a.com']), 'a')
+        search_cache.set('b', None, 'b')
+
+        assert search_cache.get('a') == 'a'
+        assert search_cache.get('b') == 'b'
+
+    def test_clear_drops_all_entries(self):
+        search_cache = cache.SearchCache()
+        search_cache.set('a', None, 'a')
+
+        search_cache.clear()
+
+        assert len(search_cache) == 0
+
+    @pytest.fixture
+    def clock(self):
+        return mock.Mock(return_value=0)
+
+
+class TestCacheKey(object):
+    def test_it_depends_on_the_query(self, pyramid_request):
+        assert (cache.cache_key({'size': 1}, pyramid_request) !=
+                cache.cache_key({'size': 2}, pyramid_request))
+
+    def test_it_depends_on_the_user(self, pyramid_config, pyramid_request):
+        anonymous = cache.cache_key({}, pyramid_request)
+        pyramid_config.testing_securitypolicy('acct:bob@example.com')
+
+        assert cache.cache_key({}, pyramid_request) != anonymous
+
+    def test_it_depends_on_the_groups(self, pyramid_config, pyramid_request):
+        pyramid_config.testing_securitypolicy('acct:bob@example.com',
+                                              groupids=['group:abc'])
+        in_group = cache.cache_key({}, pyramid_request)
+        pyramid_config.testing_securitypolicy('acct:bob@example.com',
+                                              groupids=['group:def'])
+
+        assert cache.cache_key({}, pyramid_request) != in_group
+
+    def test_it_ignores_dict_ordering(self, pyramid_request):
+        assert (cache.cache_key({'a': 1, 'b': 2}, pyramid_request) ==
+                cache.cache_key({'b': 2, 'a': 1}, pyramid_request))
+
+
+class TestQueryScopes(object):
+    def test_it_returns_none_for_queries_without_uri(self):
+        body = {'query': {'filtered': {'filter': {'and': [{'term': {'shared': True}}]}}}}
+
+        assert cache.query_scopes(body) is None
+
+    def test_it_returns_target_scopes(self):
+        body = {'query': {'filtered': {'filter': {'and': [
+            {'term': {'shared': True}},
+            {'terms': {'target.scope': ['http://a.com', 'http://b.com']}},
+        ]}}}}
+
+        assert cache.query_scopes(body) == frozenset(['http://a.com', 'http://b.com'])
+
+
+@pytest.mark.usefixtures('fetch_annotation')
+class TestSubscribeAnnotationEvent(object):
+    def test_it_invalidates_annotation_scope(self, fetch_annotation, pyramid_request, search_cache):
+        fetch_annotation.return_value.target_uri_normalized = 'http://a.com'
+        event = events.AnnotationEvent(pyramid_request, 'abc', 'create')
+
+        cache.subscribe_annotation_event(event)
+
+        fetch_annotation.assert_called_once_with(pyramid_request.db, 'abc')
+        search_cache.invalidate.assert_called_once_with('http://a.com')
+
+    def test_it_invalidates_everything_if_annotation_missing(self,
+                                                             fetch_annotation,
+                                                             pyramid_request,
+                                                             search_cache):
+        fetch_annotation.return_value = None
+        event = events.AnnotationEvent(pyramid_request, 'abc', 'delete')
+
+        cache.subscribe_annotation_event(event)
+
+        search_cache.invalidate.assert_called_once_with(None)
+
+    def test_it_fetches_the_annotation_in_a_transaction(self,
+                                                       fetch_annotation,
+                                                       pyramid_request,
+                                                       search_cache):
+        event = events.AnnotationEvent(pyramid_request, 'abc', 'create')
+
+        def fetch(*args):
+            assert pyramid_request.tm.__enter__.called
+            assert not pyramid_request.tm.__exit__.called
+        fetch_annotation.side_effect = fetch
+
+        cache.subscribe_annotation_event(event)
+
+        assert pyramid_request.tm.__exit__.called
+
+    def test_it_does_nothing_if_cache_disabled(self, fetch_annotation, pyramid_request):
+        event = events.AnnotationEvent(pyramid_request, 'abc', 'create')
+
+        cache.subscribe_annotation_event(event)
+
+        assert not fetch_annotation.called
+
+    @pytest.fixture
+    def fetch_annotation(self, patch):
+        return patch('h.search.cache.storage.fetch_annotation')
+
+    @pytest.fixture
+    def pyramid_request(self, pyramid_request):
+        pyramid_request.tm = mock.MagicMock()
+        pyramid_request.tm.__exit__.return_value = False
+        return pyramid_request
+
+    @pytest.yield_fixture
+    def search_cache(self, pyramid_request):
+        search_cache = mock.Mock(spec_set=cache.SearchCache())
+        pyramid_request.registry[cache.CACHE_KEY] = search_cache
+        yield search_cache
+        del pyramid_request.registry[cache.CACHE_KEY]
@@ -1,7 +1,12 @@
 import mock
 import pytest
+from elasticsearch.exceptions import TransportError
 
 from h.search import core
+from h.search.query import extract_search_after
+from h.search.cache import CACHE_KEY, SearchCache
+from h.search.facets import FACETS_KEY, FacetCache
+from h.search.profile import PROFILER_KEY
 
 
 class FakeStatsdClient(object):
@@ -32,7 +37,7 @@ class TestSearch(object):
     def test_run_searches_annotations(self, pyramid_request, search_annotations):
         params = mock.Mock()
 
-        search_annotations.return_value = (0, [], {})
+        search_annotations.return_value = (0, [], {}, None)
 
         search = core.Search(pyramid_request)
         search.run(params)
@@ -44,7 +49,7 @@ class TestSearch(object):
                                   search_replies,
                                   search_annotations):
         annotation_ids = [mock.Mock(), mock.Mock()]
-        search_annotations.return_value = (2, annotation_ids, {})
+        search_annotations.return_value = (2, annotation_ids, {}, None)
 
         search = core.Search(pyramid_request)
         search.run({})
@@ -59,13 +64,13 @@ class TestSearch(object):
         annotation_ids = ['id-1', 'id-3', 'id-6', 'id-5']
         reply_ids = ['reply-8', 'reply-5']
         aggregations = {'foo': 'bar'}
-        search_annotations.return_value = (total, annotation_ids, aggregations)
+        search_annotations.return_value = (total, annotation_ids, aggregations, 'cursor')
         search_replies.return_value = reply_ids
 
         search = core.Search(pyramid_request)
         result = search.run({})
 
-        assert result == core.SearchResult(total, annotation_ids, reply_ids, aggregations)
+        assert result == core.SearchResult(total, annotation_ids, reply_ids, aggregations, 'cursor')
 
     def test_search_annotations_includes_replies_by_default(self, pyramid_request, query):
         search = core.Search(pyramid_request)
@@ -106,14 +111,73 @@ class TestSearch(object):
         foobaragg = mock.Mock(key='foobar')
         search.append_aggregation(foobaragg)
 
-        _, _, aggregations = search.search_annotations({})
+        _, _, aggregations, _ = search.search_annotations({})
         assert aggregations == {'foobar': foobaragg.parse_result.return_value}
 
+    def test_search_annotations_returns_cursor_for_next_page(self, pyramid_request):
+        results = dummy_search_results(count=2)
+        results['hits']['total'] = 3
+        results['hits']['hits'][-1]['sort'] = [1234, 'annotation#id_2']
+        pyramid_request.es.conn.search.return_value = results
+
+        _, _, _, next_ = core.Search(pyramid_request).search_annotations({'limit': 2,
+                                                                          'search_after': ''})
+
+        assert extract_search_after({'search_after': next_}) == [1234, 'annotation#id_2']
+
+    def test_search_annotations_returns_no_cursor_without_search_after(self, pyramid_request):
+        results = dummy_search_results(count=2)
+        results['hits']['total'] = 3
+        results['hits']['hits'][-1]['sort'] = [1234]
+        pyramid_request.es.conn.search.return_value = results
+
+        _, _, _, next_ = core.Search(pyramid_request).search_annotations({'limit': 2})
+
+        assert next_ is None
+
+    def test_search_annotations_returns_no_cursor_on_last_page(self, pyramid_request):
+        results = dummy_search_results(count=2)
+        results['hits']['hits'][-1]['sort'] = [1234, 'annotation#id_2']
+        pyramid_request.es.conn.search.return_value = results
+
+        _, _, _, next_ = core.Search(pyramid_request).search_annotations({'limit': 2})
+
+        assert next_ is None
+
     def test_search_annotations_works_with_stats_client(self, pyramid_request):
         search = core.Search(pyramid_request, stats=FakeStatsdClient())
         # This should not raise
         search.search_annotations({})
 
+    def test_search_annotations_caches_responses(self, pyramid_request, search_cache):
+        search = core.Search(pyramid_request)
+
+        search.search_annotations({})
+        search = core.Search(pyramid_request)
+        search.search_annotations({})
+
+        assert pyramid_request.es.conn.search.call_count == 1
+        assert len(search_cache) == 1
+
+    def test_search_annotations_returns_cached_results(self, pyramid_request, search_cache):
+        core.Search(pyramid_request).search_annotations({})
+        pyramid_request.es.conn.search.return_value = dummy_search_results(3)
+
+        total, ids, _, _ = core.Search(pyramid_request).search_annotations({})
+
+        assert (total, ids) == (0, [])
+
+    def test_search_annotations_does_not_share_cached_results_between_users(self,
+                                                                             pyramid_config,
+                                                                             pyramid_request,
+                                                                             search_cache):
+        core.Search(pyramid_request).search_annotations({})
+        pyramid_config.testing_securitypolicy('acct:someone@example.com')
+
+        core.Search(pyramid_request).search_annotations({})
+
+        assert pyramid_request.es.conn.search.call_count == 2
+
     def test_search_replies_skips_search_by_default(self, pyramid_request):
         search = core.Search(pyramid_request)
         search.search_replies(['id-1', 'id-2'])
@@ -161,6 +225,40 @@ class TestSearch(object):
         search.search_replies(['id-1'])
         assert log.warn.call_count == 1
 
+    def test_search_replies_fetches_every_page_of_replies(self, pyramid_request):
+        search = core.Search(pyramid_request, separate_replies=True)
+        plain = {'hits': {'total': 3, 'hits': [
+            {'_id': 'reply-1', 'sort': [3]},
+            {'_id': 'reply-2', 'sort': [2]},
+        ]}}
+        first = {'hits': {'total': 3, 'hits': [
+            {'_id': 'reply-1', 'sort': [3, 'annotation#reply-1']},
+            {'_id': 'reply-2', 'sort': [2, 'annotation#reply-2']},
+        ]}}
+        second = {'hits': {'total': 1, 'hits': [
+            {'_id': 'reply-3', 'sort': [1, 'annotation#reply-3']},
+        ]}}
+        search.es.conn.search.side_effect = [plain, first, second]
+
+        reply_ids = search.search_replies(['id-1'])
+
+        assert reply_ids == ['reply-1', 'reply-2', 'reply-3']
+        bodies = [kwargs['body'] for _, kwargs in search.es.conn.search.call_args_list]
+        assert [len(body['sort']) for body in bodies] == [1, 2, 2]
+        assert 'post_filter' in bodies[-1]
+
+    def test_search_replies_does_not_sort_for_cursor_when_one_page_is_enough(self, pyramid_request):
+        search = core.Search(pyramid_request, separate_replies=True)
+        search.es.conn.search.return_value = {'hits': {'total': 1, 'hits': [
+            {'_id': 'reply-1', 'sort': [1]},
+        ]}}
+
+        search.search_replies(['id-1'])
+
+        _, kwargs = search.es.conn.search.call_args
+        assert search.es.conn.search.call_count == 1
+        assert len(kwargs['body']['sort']) == 1
+
     def test_search_replies_works_with_stats_client(self, pyramid_request):
         search = core.Search(pyramid_request,
                              stats=FakeStatsdClient(),
@@ -168,6 +266,189 @@ class TestSearch(object):
         # This should not raise
         search.search_replies(['id-1'])
 
+    def test_run_searches_annotations_and_replies_together_for_uris(self, pyramid_request):
+        search = core.Search(pyramid_request, separate_replies=True)
+        search.es.conn.msearch.return_value = {'responses': [
+            dummy_search_results(count=2),
+            {'hits': {'total': 2, 'hits': [
+                {'_id': 'reply-1', '_source': {'references': ['id_1']}},
+                {'_id': 'reply-2', '_source': {'references': ['other']}},
+            ]}},
+        ]}
+
+        result = search.run({'uri': 'http://example.com'})
+
+        assert not search.es.conn.search.called
+        assert result.annotation_ids == ['id_1', 'id_2']
+        assert result.reply_ids == ['reply-1']
+
+    def test_run_only_fetches_reply_references_for_uris(self, pyramid_request):
+        search = core.Search(pyramid_request, separate_replies=True)
+        search.es.conn.msearch.return_value = {'responses': [
+            dummy_search_results(), dummy_search_results()]}
+
+        search.run({'uri': 'http://example.com'})
+
+        _, kwargs = search.es.conn.msearch.call_args
+        _, body, _, reply_body = kwargs['body']
+        assert body['_source'] is False
+        assert reply_body['_source'] == ['references']
+
+    def test_run_searches_replies_to_annotations_if_uris_have_too_many_replies(self, pyramid_request):
+        search = core.Search(pyramid_request, separate_replies=True)
+        search.es.conn.msearch.return_value = {'responses': [
+            dummy_search_results(count=1),
+            {'hits': {'total': 500, 'hits': [
+                {'_id': 'reply-1', '_source': {'references': ['other']}},
+            ]}},
+        ]}
+        search.es.conn.search.return_value = {'hits': {'total': 1, 'hits': [
+            {'_id': 'reply-2'},
+        ]}}
+
+        result = search.run({'uri': 'http://example.com'})
+
+        assert result.reply_ids == ['reply-2']
+
+    def test_count_all_counts_each_search_in_one_request(self, pyramid_request):
+        search = core.Search(pyramid_request)
+        search.es.conn.msearch.return_value = {'responses': [
+            dummy_search_results(count=3), dummy_search_results(count=5)]}
+
+        totals = search.count_all([{'uri': 'http://a.com'}, {'uri': 'http://b.com'}])
+
+        assert totals == [3, 5]
+        _, kwargs = search.es.conn.msearch.call_args
+        _, first, _, second = kwargs['body']
+        assert first['size'] == second['size'] == 0
+
+    def test_count_all_with_no_searches(self, pyramid_request):
+        assert core.Search(pyramid_request).count_all([]) == []
+        assert not pyramid_request.es.conn.msearch.called
+
+    def test_run_raises_if_multi_search_fails(self, pyramid_request):
+        search = core.Search(pyramid_request, separate_replies=True)
+        search.es.conn.msearch.return_value = {'responses': [
+            dummy_search_results(), {'error': 'asplode'}]}
+
+        with pytest.raises(TransportError):
+            search.run({'uri': 'http://example.com'})
+
+    def test_run_caches_multi_search_responses(self, pyramid_request, search_cache):
+        pyramid_request.es.conn.msearch.return_value = {'responses': [
+            dummy_search_results(), dummy_search_results()]}
+
+        core.Search(pyramid_request, separate_replies=True).run({'uri': 'http://example.com'})
+        core.Search(pyramid_request, separate_replies=True).run({'uri': 'http://example.com'})
+
+        assert pyramid_request.es.conn.msearch.call_count == 1
+
+    def test_run_returns_no_sources_by_default(self, pyramid_request):
+        pyramid_request.es.conn.search.return_value = dummy_search_results(count=2)
+
+        result = core.Search(pyramid_request).run({})
+
+        _, kwargs = pyramid_request.es.conn.search.call_args
+        assert kwargs['_source'] is False
+        assert result.sources == {}
+
+    def test_run_returns_sources_when_asked(self, pyramid_request):
+        pyramid_request.es.conn.search.return_value = dummy_search_results(count=2)
+
+        result = core.Search(pyramid_request, include_sources=True).run({})
+
+        _, kwargs = pyramid_request.es.conn.search.call_args
+        assert kwargs['body']['_source'] is True
+        assert '_source' not in kwargs
+        assert result.sources == {'id_1': {'name': 'annotation_1'},
+                                  'id_2': {'name': 'annotation_2'}}
+
+    def test_run_returns_reply_sources_when_asked(self, pyramid_request):
+        pyramid_request.es.conn.search.side_effect = [
+            dummy_search_results(count=1),
+            dummy_search_results(start=2, count=1, name='reply'),
+        ]
+
+        result = core.Search(pyramid_request,
+                             separate_replies=True,
+                             include_sources=True).run({})
+
+        assert result.sources == {'id_1': {'name': 'annotation_1'},
+                                  'id_2': {'name': 'reply_2'}}
+
+    def test_run_returns_reply_sources_for_uris_when_asked(self, pyramid_request):
+        pyramid_request.es.conn.msearch.return_value = {'responses': [
+            dummy_search_results(count=1),
+            {'hits': {'total': 2, 'hits': [
+                {'_id': 'reply-1', '_source': {'references': ['id_1']}},
+                {'_id': 'reply-2', '_source': {'references': ['other']}},
+            ]}},
+        ]}
+
+        result = core.Search(pyramid_request,
+                             separate_replies=True,
+                             include_sources=True).run({'uri': 'http://example.com'})
+
+        _, kwargs = pyramid_request.es.conn.msearch.call_args
+        _, body, _, reply_body = kwargs['body']
+        assert body['_source'] is True
+        assert reply_body['_source'] is True
+        assert result.sources == {'id_1': {'name': 'annotation_1'},
+                                  'reply-1': {'references': ['id_1']}}
+
+    def test_search_annotations_runs_aggregations_separately_when_caching_facets(self,
+                                                                                pyramid_request,
+                                                                                facet_cache):
+        search = core.Search(pyramid_request)
+        search.append_aggregation(self.tags_aggregation())
+
+        search.search_annotations({'limit': 10})
+
+        bodies = [kwargs['body'] for _, kwargs in
+                  pyramid_request.es.conn.search.call_args_list]
+        assert [list(b['aggs'].keys()) for b in bodies] == [[], ['tags']]
+        assert bodies[1]['size'] == 0
+        assert bodies[1]['query'] == bodies[0]['query']
+
+    def test_search_annotations_returns_aggregations_when_caching_facets(self,
+                                                                       pyramid_request,
+                                                                       facet_cache):
+        search = core.Search(pyramid_request)
+        search.append_aggregation(self.tags_aggregation())
+        pyramid_request.es.conn.search.return_value = {
+            'hits': {'total': 0, 'hits': []},
+            'aggregations': {'tags': {'buckets': []}},
+        }
+
+        _, _, aggregations, _ = search.search_annotations({})
+
+        assert aggregations == {'tags': 'parsed'}
+
+    def test_search_annotations_caches_facets_for_every_page(self, pyramid_request, facet_cache):
+        for offset in (0, 20):
+            search = core.Search(pyramid_request)
+            search.append_aggregation(self.tags_aggregation())
+            search.search_annotations({'offset': offset})
+
+        assert pyramid_request.es.conn.search.call_count == 3
+        assert len(facet_cache) == 1
+
+    def test_search_annotations_runs_aggregations_with_hits_without_facet_cache(self,
+                                                                              pyramid_request):
+        search = core.Search(pyramid_request)
+        search.append_aggregation(self.tags_aggregation())
+
+        search.search_annotations({})
+
+        _, kwargs = pyramid_request.es.conn.search.call_args
+        assert pyramid_request.es.conn.search.call_count == 1
+        assert list(kwargs['body']['aggs'].keys()) == ['tags']
+
+    def tags_aggregation(self):
+        aggregation = mock.Mock(key='tags', return_value={'terms': {}})
+        aggregation.parse_result.return_value = 'parsed'
+        return aggregation
+
     def test_append_filter_appends_to_annotation_builder(self, pyramid_request):
         filter_ = mock.Mock()
         search = core.Search(pyramid_request)
@@ -229,6 +510,56 @@ class TestSearch(object):
     def log(self, patch):
         return patch('h.search.core.log')
 
+    @pytest.yield_fixture
+    def search_cache(self, pyramid_request):
+        cache = SearchCache()
+        pyramid_request.registry[CACHE_KEY] = cache
+        yield cache
+        del pyramid_request.registry[CACHE_KEY]
+
+    def test_search_annotations_reports_searches_to_profiler(self, pyramid_request, profiler):
+        response = dummy_search_results(count=1)
+        pyramid_request.es.conn.search.return_value = response
+
+        core.Search(pyramid_request).search_annotations({'user': 'acct:foo@example.com'})
+
+        body = pyramid_request.es.conn.search.call_args[1]['body']
+        profiler.record.assert_called_once_with(body, response, mock.ANY, stats=None)
+        clauses = profiler.record.call_args[0][2]
+        assert 'UserFilter' in clauses
+        assert 'GroupFilter' not in clauses
+
+    def test_run_reports_multi_searches_to_profiler(self, pyramid_request, profiler):
+        responses = [dummy_search_results(), dummy_search_results()]
+        pyramid_request.es.conn.msearch.return_value = {'responses': responses}
+
+        core.Search(pyramid_request, separate_replies=True).run({'uri': 'http://example.com'})
+
+        assert [args[1] for args, _ in profiler.record.call_args_list] == responses
+        _, _, reply_clauses = profiler.record.call_args_list[1][0]
+        assert 'RepliesFilter' in reply_clauses
+
+    def test_cached_searches_are_not_reported_to_profiler(self, pyramid_request, profiler,
+                                                          search_cache):
+        core.Search(pyramid_request).search_annotations({})
+        core.Search(pyramid_request).search_annotations({})
+
+        assert profiler.record.call_count == 1
+
+    @pytest.yield_fixture
+    def profiler(self, pyramid_request):
+        profiler = mock.Mock(spec_set=['record'])
+        pyramid_request.registry[PROFILER_KEY] = profiler
+        yield profiler
+        del pyramid_request.registry[PROFILER_KEY]
+
+    @pytest.yield_fixture
+    def facet_cache(self, pyramid_request):
+        cache = FacetCache()
+        pyramid_request.registry[FACETS_KEY] = cache
+        yield cache
+        del pyramid_request.registry[FACETS_KEY]
+
 
 # @search_fixtures
 # def test_search_logs_a_warning_if_there_are_too_many_replies(log, pyramid_request):
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import mock
+import pytest
+
+from h.search import facets
+
+
+class TestFacetCache(object):
+    def test_fetch_loads_missing_aggregations(self, load):
+        facet_cache = facets.FacetCache()
+
+        assert facet_cache.fetch('key', load) == {'tags': []}
+        assert facet_cache.misses == 1
+
+    def test_fetch_returns_cached_aggregations(self, load):
+        facet_cache = facets.FacetCache()
+        facet_cache.set('key', {'tags': ['cached']})
+
+        assert facet_cache.fetch('key', load) == {'tags': ['cached']}
+        assert not load.called
+        assert facet_cache.hits == 1
+
+    def test_fetch_reloads_expired_aggregations(self, clock, load):
+        facet_cache = facets.FacetCache(ttl=600, clock=clock)
+        facet_cache.set('key', {'tags': ['cached']})
+
+        clock.return_value = 600
+
+        assert facet_cache.fetch('key', load) == {'tags': []}
+
+    def test_fetch_refreshes_stale_aggregations_in_the_background(self, clock, load, spawn):
+        facet_cache = facets.FacetCache(refresh=60, clock=clock, spawn=spawn)
+        facet_cache.set('key', {'tags': ['cached']})
+
+        clock.return_value = 60
+        result = facet_cache.fetch('key', load)
+
+        assert result == {'tags': ['cached']}
+        spawn.assert_called_once_with(mock.ANY, 'key', load)
+
+    def test_background_refresh_replaces_cached_aggregations(self, clock, load):
+        facet_cache = facets.FacetCache(refresh=60, clock=clock,
+                                        spawn=lambda func, *args: func(*args))
+        facet_cache.set('key', {'tags': ['cached']})
+
+        clock.return_value = 60
+        facet_cache.fetch('key', load)
+
+        assert facet_cache.fetch('key', load) == {'tags': []}
+
+    def test_fetch_refreshes_each_key_once_at_a_time(self, clock, load, spawn):
+        facet_cache = facets.FacetCache(refresh=60, clock=clock, spawn=spawn)
+        facet_cache.set('key', {'tags': ['cached']})
+
+        clock.return_value = 60
+        facet_cache.fetch('key', load)
+        facet_cache.fetch('key', load)
+
+        assert spawn.call_count == 1
+
+    def test_failed_refresh_keeps_cached_aggregations(self, clock, load):
+        facet_cache = facets.FacetCache(refresh=60, clock=clock,
+                                        spawn=lambda func, *args: func(*args))
+        facet_cache.set('key', {'tags': ['cached']})
+        load.side_effect = RuntimeError('asplode')
+
+        clock.return_value = 60
+        facet_cache.fetch('key', load)
+
+        assert facet_cache.fetch('key', load) == {'tags': ['cached']}
+
+    def test_set_evicts_least_recently_used(self, load):
+        facet_cache = facets.FacetCache(maxsize=2)
+        facet_cache.set('a', 'a')
+        facet_cache.set('b', 'b')
+        facet_cache.fetch('a', load)
+
+        facet_cache.set('c', 'c')
+
+        assert len(facet_cache) == 2
+        assert facet_cache.fetch('b', load) == {'tags': []}
+
+    @pytest.fixture
+    def clock(self):
+        return mock.Mock(return_value=0)
+
+    @pytest.fixture
+    def load(self):
+        return mock.Mock(return_value={'tags': []})
+
+    @pytest.fixture
+    def spawn(self):
+        return mock.Mock()
+
+    @pytest.fixture(autouse=True)
+    def log(self, patch):
+        return patch('h.search.facets.log')
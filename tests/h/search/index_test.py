@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import datetime
+
 import mock
 import pytest
 
@@ -19,7 +21,17 @@ class TestIndexAnnotation:
 
         index.index(es, annotation, pyramid_request)
 
-        presenters.AnnotationSearchIndexPresenter.assert_called_once_with(annotation)
+        presenters.AnnotationSearchIndexPresenter.assert_called_once_with(
+            annotation, include_extra=False)
+
+    def test_it_presents_extra_if_enabled(self, es, presenters, pyramid_request):
+        pyramid_request.registry.settings['h.search.index_extra'] = 'true'
+        annotation = mock.Mock()
+
+        index.index(es, annotation, pyramid_request)
+
+        presenters.AnnotationSearchIndexPresenter.assert_called_once_with(
+            annotation, include_extra=True)
 
     def test_it_creates_an_annotation_before_save_event(self,
                                                         AnnotationTransformEvent,
@@ -94,6 +106,105 @@ class TestDeleteAnnotation:
         assert kwargs['index'] == 'custom-index'
 
 
+class TestAnnotationFromSource(object):
+
+    def test_it_rebuilds_the_indexed_annotation(self, factories):
+        annotation = factories.Annotation(references=['parent-id'],
+                                          extra={'foo': 'bar'})
+
+        rebuilt = index.annotation_from_source(annotation.id, self.source(annotation))
+
+        for attr in ['id', 'created', 'updated', 'userid', 'groupid',
+                     'target_uri', 'target_uri_normalized', 'target_selectors',
+                     'text', 'tags', 'shared', 'references', 'extra',
+                     'thread_root_id']:
+            assert getattr(rebuilt, attr) == getattr(annotation, attr)
+
+    def test_it_rebuilds_the_document(self, factories):
+        annotation = factories.Annotation()
+
+        rebuilt = index.annotation_from_source(annotation.id, self.source(annotation))
+
+        assert rebuilt.document.title == annotation.document.title
+        assert rebuilt.document.web_uri == annotation.document.web_uri
+
+    def test_it_presents_like_the_annotation(self, factories, pyramid_request):
+        annotation = factories.Annotation(extra={'foo': 'bar'})
+        rebuilt = index.annotation_from_source(annotation.id, self.source(annotation))
+
+        def present(annotation):
+            resource = mock.Mock(annotation=annotation, links={})
+            with mock.patch('h.presenters.annotation_json.security'):
+                return presenters.AnnotationJSONPresenter(resource).asdict()
+
+        assert present(rebuilt) == present(annotation)
+
+    def test_it_does_not_add_the_annotation_to_the_session(self, db_session, factories):
+        annotation = factories.Annotation()
+
+        rebuilt = index.annotation_from_source(annotation.id, self.source(annotation))
+
+        assert rebuilt not in db_session
+        assert rebuilt.document not in db_session
+
+    def test_it_returns_none_for_documents_without_extra(self, factories):
+        annotation = factories.Annotation()
+        source = self.source(annotation)
+        del source['extra']
+
+        assert index.annotation_from_source(annotation.id, source) is None
+
+    def source(self, annotation):
+        source = presenters.AnnotationSearchIndexPresenter(annotation,
+                                                           include_extra=True).asdict()
+        del source['id']
+        return source
+
+
+class TestFetchAnnotations(object):
+    def test_it_fetches_annotations_with_ids(self, db_session, factories):
+        ann_1, ann_2, _ = factories.Annotation.create_batch(3)
+
+        result = index.fetch_annotations(db_session, [ann_1.id, ann_2.id])
+
+        assert set(result) == set([ann_1, ann_2])
+
+    def test_it_skips_deleted_annotations(self, db_session, factories):
+        annotation = factories.Annotation(deleted=True)
+
+        assert index.fetch_annotations(db_session, [annotation.id]) == []
+
+    def test_it_returns_nothing_for_no_ids(self, db_session):
+        assert index.fetch_annotations(db_session, []) == []
+
+
+class TestWindows(object):
+    def test_it_splits_annotations_into_windows_of_updated_times(self, db_session, factories):
+        annotations = [factories.Annotation(updated=datetime.datetime(2017, 1, day))
+                       for day in range(1, 6)]
+
+        windows = index.windows(db_session, windowsize=2)
+
+        assert windows == [
+            index.Window(annotations[0].updated, annotations[2].updated),
+            index.Window(annotations[2].updated, annotations[4].updated),
+            index.Window(annotations[4].updated, None),
+        ]
+
+    def test_it_skips_deleted_annotations(self, db_session, factories):
+        factories.Annotation(deleted=True)
+
+        assert index.windows(db_session) == []
+
+    def test_it_only_includes_annotations_updated_since(self, db_session, factories):
+        annotations = [factories.Annotation(updated=datetime.datetime(2017, 1, day))
+                       for day in range(1, 4)]
+
+        windows = index.windows(db_session, since=annotations[1].updated)
+
+        assert windows == [index.Window(annotations[1].updated, None)]
+
+
 class TestBatchIndexer(object):
     def test_index_indexes_all_annotations_to_es(self, db_session, indexer, matchers, streaming_bulk, factories):
         ann_1, ann_2 = factories.Annotation(), factories.Annotation()
@@ -138,6 +249,70 @@ class TestBatchIndexer(object):
             indexer.es_client.conn, matchers.iterable_with([ann_2]),
             chunk_size=mock.ANY, raise_on_error=False, expand_action_callback=mock.ANY)
 
+    def test_index_annotations_indexes_given_annotations_to_es(self, indexer, streaming_bulk, factories):
+        annotations = [factories.Annotation(), factories.Annotation()]
+
+        indexer.index_annotations(annotations)
+
+        streaming_bulk.assert_called_once_with(
+            indexer.es_client.conn, annotations,
+            chunk_size=mock.ANY, raise_on_error=False, expand_action_callback=mock.ANY)
+
+    def test_index_window_indexes_annotations_in_window(self, db_session, indexer, matchers,
+                                                         streaming_bulk, factories):
+        first = factories.Annotation(updated=datetime.datetime(2017, 1, 1))
+        second = factories.Annotation(updated=datetime.datetime(2017, 1, 2))
+        factories.Annotation(updated=datetime.datetime(2017, 1, 3))
+
+        indexer.index_window(index.Window(first.updated, datetime.datetime(2017, 1, 3)))
+
+        streaming_bulk.assert_called_once_with(
+            indexer.es_client.conn, matchers.iterable_with([first, second]),
+            chunk_size=mock.ANY, raise_on_error=False, expand_action_callback=mock.ANY)
+
+    def test_index_window_returns_count_and_failed_bulk_actions(self, indexer, streaming_bulk,
+                                                                factories):
+        annotation = factories.Annotation()
+        streaming_bulk.return_value = [(True, {'index': {'_id': 'ok'}}),
+                                       (False, {'index': {'_id': 'failed', 'error': 'asplode'}})]
+
+        result = indexer.index_window(index.Window(annotation.updated, None))
+
+        assert result == (2, set(['failed']))
+
+    def test_sync_indexes_annotations_updated_since(self, db_session, indexer, matchers,
+                                                    streaming_bulk, factories):
+        factories.Annotation(updated=datetime.datetime(2017, 1, 1))
+        updated = factories.Annotation(updated=datetime.datetime(2017, 1, 2))
+        deleted = factories.Annotation(updated=datetime.datetime(2017, 1, 3), deleted=True)
+
+        indexer.sync(datetime.datetime(2017, 1, 2))
+
+        streaming_bulk.assert_called_once_with(
+            indexer.es_client.conn, matchers.iterable_with([updated, deleted]),
+            chunk_size=mock.ANY, raise_on_error=False, expand_action_callback=mock.ANY)
+
+    def test_sync_marks_deleted_annotations_as_deleted(self, db_session, indexer, streaming_bulk,
+                                                       factories):
+        annotation = factories.Annotation(deleted=True)
+
+        indexer.sync(annotation.updated)
+
+        _, kwargs = streaming_bulk.call_args
+        action, data = kwargs['expand_action_callback'](annotation)
+        assert action == {'index': {'_index': 'hypothesis',
+                                    '_type': 'annotation',
+                                    '_id': annotation.id}}
+        assert data == {'deleted': True}
+
+    def test_index_uses_chunk_size(self, db_session, es, pyramid_request, streaming_bulk):
+        indexer = index.BatchIndexer(db_session, es, pyramid_request, chunk_size=500)
+
+        indexer.index()
+
+        _, kwargs = streaming_bulk.call_args
+        assert kwargs['chunk_size'] == 500
+
     def test_index_correctly_presents_bulk_actions(self,
                                                    db_session,
                                                    indexer,
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import mock
+import pytest
+
+from h.search import profile
+
+
+class TestQueryProfiler(object):
+    def test_record_logs_slow_searches(self, log):
+        profiler = profile.QueryProfiler(slow_ms=100)
+
+        profiler.record({'query': {}}, response(took=100), ['UriFilter'])
+
+        assert log.warning.call_count == 1
+        args = log.warning.call_args[0]
+        assert args[1:] == (100, 3, 'UriFilter', '{"query": {}}')
+
+    def test_record_does_not_log_fast_searches(self, log):
+        profiler = profile.QueryProfiler(slow_ms=100)
+
+        profiler.record({}, response(took=99))
+
+        assert not log.warning.called
+        assert not log.info.called
+
+    def test_record_logs_sampled_searches(self, log):
+        profiler = profile.QueryProfiler(sample_rate=0.1,
+                                         random=mock.Mock(return_value=0.05))
+
+        profiler.record({}, response(took=5))
+
+        assert log.info.call_count == 1
+
+    def test_record_does_not_log_unsampled_searches(self, log):
+        profiler = profile.QueryProfiler(sample_rate=0.1,
+                                         random=mock.Mock(return_value=0.1))
+
+        profiler.record({}, response(took=5))
+
+        assert not log.info.called
+
+    def test_record_times_the_search_by_its_shape(self, stats):
+        profiler = profile.QueryProfiler()
+
+        profiler.record({'aggs': {'tags': {}}}, response(took=42),
+                        ['UriFilter', 'AnyMatcher'], stats=stats)
+
+        stats.timing.assert_called_once_with(
+            'search.query.shape.AnyMatcher-UriFilter-aggs_tags', 42)
+
+    @pytest.fixture
+    def log(self, patch):
+        return patch('h.search.profile.log')
+
+    @pytest.fixture
+    def stats(self):
+        return mock.Mock(spec_set=['timing'])
+
+
+class TestShape(object):
+    def test_it_is_independent_of_clause_order(self):
+        assert (profile.shape({}, ['UriFilter', 'AuthFilter']) ==
+                profile.shape({}, ['AuthFilter', 'UriFilter']))
+
+    def test_it_distinguishes_clause_combinations(self):
+        assert (profile.shape({}, ['AuthFilter', 'UriFilter']) !=
+                profile.shape({}, ['AuthFilter', 'TagsMatcher', 'UriFilter']))
+
+    def test_it_includes_aggregations(self):
+        assert profile.shape({'aggs': {'users': {}, 'tags': {}}}, ['AuthFilter']) == \
+            'AuthFilter-aggs_tags-aggs_users'
+
+    def test_it_marks_cursor_searches(self):
+        assert profile.shape({'post_filter': {}}, ['AuthFilter']) == 'AuthFilter-cursor'
+
+    def test_it_names_searches_without_clauses(self):
+        assert profile.shape({}) == 'all'
+
+
+def response(took):
+    return {'took': took, 'hits': {'total': 3, 'hits': []}}
@@ -88,9 +88,23 @@ class TestBuilder(object):
         q = builder.build({})
 
         sort = q["sort"]
-        assert len(sort) == 1
         assert sort[0].keys() == ["updated"]
 
+    @pytest.mark.parametrize('search_after', ['', 'cursor'])
+    def test_sort_breaks_ties_by_document_when_paginating_with_cursor(self, search_after):
+        builder = query.Builder()
+
+        q = builder.build({"order": "asc", "search_after": search_after})
+
+        assert q["sort"][-1] == {"_uid": {"order": "asc"}}
+
+    def test_sort_does_not_break_ties_without_cursor(self):
+        builder = query.Builder()
+
+        q = builder.build({})
+
+        assert len(q["sort"]) == 1
+
     def test_sort_includes_ignore_unmapped(self):
         """'ignore_unmapped': True is used in the sort clause."""
         builder = query.Builder()
@@ -125,6 +139,40 @@ class TestBuilder(object):
         sort = q["sort"]
         assert sort[0]["updated"]["order"] == "asc"
 
+    def test_search_after_filters_hits_after_cursor(self):
+        builder = query.Builder()
+        cursor = query.search_after_cursor({"sort": [1234, "annotation#abc"]})
+
+        q = builder.build({"search_after": cursor, "offset": 40})
+
+        assert q["from"] == 0
+        assert q["post_filter"] == {"or": [
+            {"range": {"updated": {"lt": 1234}}},
+            {"and": [
+                {"term": {"updated": 1234}},
+                {"range": {"_uid": {"lt": "annotation#abc"}}},
+            ]},
+        ]}
+
+    def test_search_after_follows_sort_order(self):
+        builder = query.Builder()
+        cursor = query.search_after_cursor({"sort": ["foo", "annotation#abc"]})
+
+        q = builder.build({"search_after": cursor, "sort": "user", "order": "asc"})
+
+        assert q["post_filter"]["or"][0] == {"range": {"user": {"gt": "foo"}}}
+
+    @pytest.mark.parametrize('cursor', ['', 'notbase64!', 'bm90IGpzb24=', 'WzFd'])
+    def test_search_after_ignores_malformed_cursors(self, cursor):
+        builder = query.Builder()
+
+        q = builder.build({"search_after": cursor})
+
+        assert "post_filter" not in q
+
+    def test_search_after_cursor_is_none_without_sort_value(self):
+        assert query.search_after_cursor({"sort": [None, "annotation#abc"]}) is None
+
     def test_defaults_to_match_all(self):
         """If no query params are given a "match_all": {} query is returned."""
         builder = query.Builder()
@@ -191,6 +239,16 @@ class TestBuilder(object):
 
         assert q["query"] == {"match_all": {}}
 
+    def test_records_clauses_which_contributed_to_query(self):
+        builder = query.Builder()
+        builder.append_filter(query.DeletedFilter())
+        builder.append_filter(query.UserFilter())
+        builder.append_matcher(query.TagsMatcher())
+
+        builder.build({"tag": "foo"})
+
+        assert builder.clauses == ["DeletedFilter", "TagsMatcher"]
+
     def test_filters_query_by_filter_results(self):
         testfilter = mock.Mock()
         testfilter.return_value = {"term": {"giraffe": "nose"}}
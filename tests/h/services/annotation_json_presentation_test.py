@@ -81,7 +81,7 @@ class TestAnnotationJSONPresentationService(object):
             svc.session, ['id-1', 'id-2'], query_processor=mock.ANY)
 
     def test_present_all_initialises_annotation_resources(self, svc, storage, resources):
-        ann = mock.Mock()
+        ann = mock.Mock(id='ann-1')
         storage.fetch_ordered_annotations.return_value = [ann]
 
         svc.present_all(['ann-1'])
@@ -89,7 +89,7 @@ class TestAnnotationJSONPresentationService(object):
         resources.AnnotationResource.assert_called_once_with(ann, svc.group_svc, svc.links_svc)
 
     def test_present_all_presents_annotation_resources(self, svc, storage, resources, present):
-        storage.fetch_ordered_annotations.return_value = [mock.Mock()]
+        storage.fetch_ordered_annotations.return_value = [mock.Mock(id='ann-1')]
         resource = resources.AnnotationResource.return_value
 
         svc.present_all(['ann-1'])
@@ -104,11 +104,53 @@ class TestAnnotationJSONPresentationService(object):
         formatter.preload.assert_called_once_with(['ann-1', 'ann-2'])
 
     def test_returns_presented_annotations(self, svc, storage, present):
-        storage.fetch_ordered_annotations.return_value = [mock.Mock()]
+        storage.fetch_ordered_annotations.return_value = [mock.Mock(id='ann-1')]
 
         result = svc.present_all(['ann-1'])
         assert result == [present.return_value]
 
+    def test_present_all_renders_annotations_from_sources(self, svc, index, storage, resources):
+        sources = {'ann-1': {'text': 'foo'}}
+
+        svc.present_all(['ann-1'], sources)
+
+        index.annotation_from_source.assert_called_once_with('ann-1', {'text': 'foo'})
+        assert not storage.fetch_ordered_annotations.called
+        resources.AnnotationResource.assert_called_once_with(
+            index.annotation_from_source.return_value, svc.group_svc, svc.links_svc)
+
+    def test_present_all_loads_annotations_without_sources_from_db(self, svc, index, storage):
+        index.annotation_from_source.side_effect = lambda id_, _: mock.Mock(id=id_)
+
+        svc.present_all(['ann-1', 'ann-2'], {'ann-2': {}})
+
+        storage.fetch_ordered_annotations.assert_called_once_with(
+            svc.session, ['ann-1'], query_processor=mock.ANY)
+
+    def test_present_all_loads_annotations_with_outdated_sources_from_db(self, svc, index, storage):
+        index.annotation_from_source.return_value = None
+
+        svc.present_all(['ann-1'], {'ann-1': {}})
+
+        storage.fetch_ordered_annotations.assert_called_once_with(
+            svc.session, ['ann-1'], query_processor=mock.ANY)
+
+    def test_present_all_keeps_the_order_of_the_ids(self, svc, index, storage, resources):
+        index.annotation_from_source.side_effect = lambda id_, _: mock.Mock(id=id_)
+        storage.fetch_ordered_annotations.return_value = [mock.Mock(id='ann-1')]
+
+        svc.present_all(['ann-1', 'ann-2'], {'ann-2': {}})
+
+        ids = [c[0][0].id for c in resources.AnnotationResource.call_args_list]
+        assert ids == ['ann-1', 'ann-2']
+
+    def test_present_all_skips_annotations_which_cannot_be_found(self, svc, storage, present):
+        storage.fetch_ordered_annotations.return_value = [mock.Mock(id='ann-2')]
+
+        result = svc.present_all(['ann-1', 'ann-2'])
+
+        assert result == [present.return_value]
+
     @pytest.fixture
     def svc(self, services, render_user_info=True):
         return AnnotationJSONPresentationService(session=mock.sentinel.db_session,
@@ -138,6 +180,10 @@ class TestAnnotationJSONPresentationService(object):
     def resources(self, patch):
         return patch('h.services.annotation_json_presentation.resources')
 
+    @pytest.fixture
+    def index(self, patch):
+        return patch('h.services.annotation_json_presentation.index')
+
     @pytest.fixture
     def present(self, patch):
         return patch('h.services.annotation_json_presentation.AnnotationJSONPresentationService.present')
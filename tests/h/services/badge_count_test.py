@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import mock
+import pytest
+
+from h import models
+from h.services.badge_count import BadgeCountService
+from h.services.badge_count import badge_count_service_factory
+from h.util import uri
+
+
+class TestBadgeCountService(object):
+    def test_count_returns_zero_for_uncounted_uri(self, svc):
+        assert svc.count('http://example.com/') == 0
+
+    def test_count_returns_stored_count(self, svc, db_session):
+        db_session.add(models.BadgeCount(uri=uri.normalize('http://example.com/'),
+                                         count=3))
+
+        assert svc.count('http://example.com/') == 3
+
+    def test_counts_returns_count_for_each_uri(self, svc, db_session):
+        db_session.add(models.BadgeCount(uri=uri.normalize('http://example.com/'),
+                                         count=3))
+
+        counts = svc.counts(['http://example.com/', 'http://example.org/'])
+
+        assert counts == {'http://example.com/': 3, 'http://example.org/': 0}
+
+    def test_update_counts_public_annotations(self, svc, public):
+        public(target_uri='http://example.com/')
+        annotation = public(target_uri='http://example.com/')
+
+        svc.update([annotation])
+
+        assert svc.count('http://example.com/') == 2
+
+    def test_update_ignores_private_annotations(self, svc, public, factories):
+        annotation = public(target_uri='http://example.com/')
+        factories.Annotation(target_uri='http://example.com/',
+                             groupid=annotation.groupid,
+                             shared=False)
+
+        svc.update([annotation])
+
+        assert svc.count('http://example.com/') == 1
+
+    def test_update_ignores_annotations_in_private_groups(self, svc, public, factories):
+        annotation = public(target_uri='http://example.com/')
+        group = factories.Group()
+        factories.Annotation(target_uri='http://example.com/',
+                             groupid=group.pubid,
+                             shared=True)
+
+        svc.update([annotation])
+
+        assert svc.count('http://example.com/') == 1
+
+    def test_update_ignores_deleted_annotations(self, svc, public):
+        annotation = public(target_uri='http://example.com/')
+        public(target_uri='http://example.com/', deleted=True)
+
+        svc.update([annotation])
+
+        assert svc.count('http://example.com/') == 1
+
+    def test_update_ignores_nipsad_users_annotations(self, svc, public, factories):
+        annotation = public(target_uri='http://example.com/')
+        user = factories.User(nipsa=True)
+        public(target_uri='http://example.com/', userid=user.userid)
+
+        svc.update([annotation])
+
+        assert svc.count('http://example.com/') == 1
+
+    def test_update_counts_equivalent_uris(self, svc, public, factories, storage):
+        annotation = public(target_uri='http://example.com/')
+        factories.DocumentURI(document=annotation.document,
+                              claimant='http://example.com/',
+                              uri='http://example.org/')
+        public(target_uri='http://example.org/')
+        storage.expand_uri.side_effect = lambda _, u, cached: [
+            'http://example.com/', 'http://example.org/']
+
+        svc.update([annotation])
+
+        assert svc.count('http://example.com/') == 2
+        assert svc.count('http://example.org/') == 2
+
+    def test_update_removes_count_when_no_public_annotations_remain(self, svc, public):
+        annotation = public(target_uri='http://example.com/')
+        svc.update([annotation])
+
+        annotation.deleted = True
+        svc.update([annotation])
+
+        assert svc.count('http://example.com/') == 0
+
+    def test_update_replaces_stored_count(self, svc, public, db_session):
+        db_session.add(models.BadgeCount(uri=uri.normalize('http://example.com/'),
+                                         count=5))
+        annotation = public(target_uri='http://example.com/')
+
+        svc.update([annotation])
+
+        assert svc.count('http://example.com/') == 1
+
+    def test_refresh_counts_equivalent_pages_once(self, svc, public, storage):
+        annotation = public(target_uri='http://example.com/')
+        storage.expand_uri.side_effect = lambda _, u, cached: [
+            'http://example.com/', 'http://example.org/']
+
+        with mock.patch.object(svc, '_public_annotations',
+                               wraps=svc._public_annotations) as public_annotations:
+            svc.refresh([annotation.target_uri, 'http://example.org/'])
+
+        public_annotations.assert_called_once_with()
+        assert svc.count('http://example.org/') == 1
+
+    def test_refresh_locks_each_page(self, svc, db_session):
+        with mock.patch.object(svc, '_lock') as lock:
+            svc.refresh(['http://example.com/', 'http://example.org/'])
+
+        assert lock.call_args_list == [
+            mock.call(key) for key in sorted([uri.normalize('http://example.com/'),
+                                              uri.normalize('http://example.org/')])
+        ]
+
+    def test_rebuild_locks_the_table(self, db_session):
+        session = mock.Mock(wraps=db_session)
+        svc = BadgeCountService(session)
+
+        svc.rebuild()
+
+        session.execute.assert_any_call('LOCK TABLE badge_count IN EXCLUSIVE MODE')
+
+    def test_rebuild_replaces_stored_counts(self, svc, public, db_session):
+        db_session.add(models.BadgeCount(uri=uri.normalize('http://stale.example.com/'),
+                                         count=5))
+        public(target_uri='http://example.com/')
+        public(target_uri='http://example.com/')
+        public(target_uri='http://example.net/')
+
+        pages = svc.rebuild()
+
+        assert pages >= 2
+        assert svc.count('http://stale.example.com/') == 0
+        assert svc.count('http://example.com/') == 2
+        assert svc.count('http://example.net/') == 1
+
+    @pytest.fixture
+    def public(self, factories):
+        group = factories.PublisherGroup()
+
+        def public(**kwargs):
+            kwargs.setdefault('groupid', group.pubid)
+            return factories.Annotation(shared=True, **kwargs)
+        return public
+
+    @pytest.fixture
+    def svc(self, db_session):
+        return BadgeCountService(db_session)
+
+    @pytest.fixture
+    def storage(self, patch):
+        return patch('h.services.badge_count.storage')
+
+
+class TestBadgeCountServiceFactory(object):
+    def test_it_returns_badge_count_service(self, pyramid_request):
+        svc = badge_count_service_factory(None, pyramid_request)
+
+        assert isinstance(svc, BadgeCountService)
+
+    def test_it_provides_the_db_session(self, pyramid_request):
+        pyramid_request.db = mock.sentinel.db
+
+        svc = badge_count_service_factory(None, pyramid_request)
+
+        assert svc.session == mock.sentinel.db
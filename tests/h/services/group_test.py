@@ -4,9 +4,12 @@ from __future__ import unicode_literals
 
 import mock
 import pytest
+import transaction
 
 from h.models import Group
 from h.models.group import JoinableBy, ReadableBy, WriteableBy
+from h.services.group import CACHE_KEY
+from h.services.group import GroupidsCache
 from h.services.group import GroupService
 from h.services.group import groups_factory
 
@@ -228,6 +231,82 @@ class TestGroupService(object):
     def test_groupids_created_by_returns_empty_list_for_missing_user(self, service):
         assert service.groupids_created_by(None) == []
 
+    def test_groupids_readable_by_uses_the_cache(self, cached_service, db_session, factories):
+        user = factories.User()
+        db_session.flush()
+        cached_service.groupids_readable_by(user)
+
+        group = factories.Group(readable_by=ReadableBy.members)
+        group.members.append(user)
+        db_session.flush()
+
+        assert group.pubid not in cached_service.groupids_readable_by(user)
+
+    def test_groupids_created_by_uses_the_cache(self, cached_service, factories):
+        user = factories.User()
+        cached_service.groupids_created_by(user)
+
+        group = factories.Group(creator=user)
+
+        assert group.pubid not in cached_service.groupids_created_by(user)
+
+    def test_member_join_invalidates_cached_groupids(self, cached_service, db_session, users):
+        group = cached_service.create('Donkey Trust', 'foobar.com', 'cazimir')
+        cached_service.groupids_readable_by(users['theresa'])
+
+        cached_service.member_join(group, 'theresa')
+
+        assert group.pubid in cached_service.groupids_readable_by(users['theresa'])
+
+    def test_member_leave_invalidates_cached_groupids(self, cached_service, db_session, users):
+        group = cached_service.create('Donkey Trust', 'foobar.com', 'cazimir')
+        cached_service.member_join(group, 'theresa')
+        cached_service.groupids_readable_by(users['theresa'])
+
+        cached_service.member_leave(group, 'theresa')
+
+        assert group.pubid not in cached_service.groupids_readable_by(users['theresa'])
+
+    def test_create_invalidates_creators_cached_groupids(self, cached_service, users):
+        cached_service.groupids_created_by(users['cazimir'])
+
+        group = cached_service.create('Donkey Trust', 'foobar.com', 'cazimir')
+
+        assert group.pubid in cached_service.groupids_created_by(users['cazimir'])
+
+    def test_create_publisher_group_invalidates_all_cached_groupids(self, cached_service, users):
+        cached_service.groupids_readable_by(None)
+
+        group = cached_service.create('Donkey Trust', 'foobar.com', 'cazimir',
+                                      type_='publisher')
+
+        assert group.pubid in cached_service.groupids_readable_by(None)
+
+    def test_member_join_invalidates_cached_groupids_after_commit(self, cached_service, db_session, users):
+        group = cached_service.create('Donkey Trust', 'foobar.com', 'cazimir')
+        after_commit = cached_service.after_commit = mock.Mock()
+        cached_service.groupids_readable_by(users['theresa'])
+
+        cached_service.member_join(group, 'theresa')
+
+        assert group.pubid not in cached_service.groupids_readable_by(users['theresa'])
+        for call in after_commit.call_args_list:
+            call[0][0]()
+        assert group.pubid in cached_service.groupids_readable_by(users['theresa'])
+
+    def test_member_leave_publishes_before_commit(self, db_session, users):
+        publish = mock.Mock()
+        after_commit = mock.Mock()
+        svc = GroupService(db_session, users.get, publish=publish,
+                           cache=GroupidsCache(), after_commit=after_commit)
+        group = Group(name='Donkey Trust', authority='foobar.com',
+                      creator=users['cazimir'])
+        group.members.append(users['theresa'])
+
+        svc.member_leave(group, 'theresa')
+
+        publish.assert_called_once_with('group-leave', group.pubid, 'theresa')
+
     @pytest.fixture
     def group(self, users):
         return Group(name='Donkey Trust',
@@ -238,6 +317,150 @@ class TestGroupService(object):
     def service(self, db_session, users):
         return GroupService(db_session, users.get)
 
+    @pytest.fixture
+    def cached_service(self, db_session, users):
+        return GroupService(db_session, users.get, cache=GroupidsCache())
+
+
+class TestGroupidsCache(object):
+    def test_fetch_loads_missing_pubids(self, load):
+        cache = GroupidsCache()
+
+        assert cache.fetch('readable', 'acct:foo@example.com', load) == ['abc123']
+
+    def test_fetch_returns_cached_pubids(self, load):
+        cache = GroupidsCache()
+        cache.fetch('readable', 'acct:foo@example.com', load)
+
+        result = cache.fetch('readable', 'acct:foo@example.com', load)
+
+        assert result == ['abc123']
+        assert load.call_count == 1
+
+    def test_fetch_caches_each_kind_separately(self, load):
+        cache = GroupidsCache()
+        cache.fetch('readable', 'acct:foo@example.com', load)
+
+        cache.fetch('created', 'acct:foo@example.com', load)
+
+        assert load.call_count == 2
+
+    def test_fetch_reloads_expired_pubids(self, load):
+        clock = mock.Mock(return_value=0)
+        cache = GroupidsCache(ttl=30, clock=clock)
+        cache.fetch('readable', 'acct:foo@example.com', load)
+
+        clock.return_value = 30
+        cache.fetch('readable', 'acct:foo@example.com', load)
+
+        assert load.call_count == 2
+
+    def test_fetch_evicts_least_recently_used(self, load):
+        cache = GroupidsCache(maxsize=2)
+        cache.fetch('readable', 'a', load)
+        cache.fetch('readable', 'b', load)
+        cache.fetch('readable', 'a', load)
+        cache.fetch('readable', 'c', load)
+        load.reset_mock()
+
+        cache.fetch('readable', 'a', load)
+        cache.fetch('readable', 'b', load)
+
+        assert len(cache) == 2
+        assert load.call_count == 1
+
+    def test_fetch_doesnt_store_pubids_loaded_during_invalidation(self):
+        cache = GroupidsCache()
+
+        def load():
+            cache.invalidate('acct:foo@example.com')
+            return ['abc123']
+
+        result = cache.fetch('readable', 'acct:foo@example.com', load)
+
+        assert result == ['abc123']
+        assert len(cache) == 0
+
+    def test_fetch_doesnt_store_pubids_loaded_during_clear(self):
+        cache = GroupidsCache()
+
+        def load():
+            cache.clear()
+            return ['abc123']
+
+        cache.fetch('readable', 'acct:foo@example.com', load)
+
+        assert len(cache) == 0
+
+    def test_invalidate_drops_users_pubids(self, load):
+        cache = GroupidsCache()
+        cache.fetch('readable', 'acct:foo@example.com', load)
+        cache.fetch('created', 'acct:foo@example.com', load)
+        cache.fetch('readable', 'acct:bar@example.com', load)
+
+        cache.invalidate('acct:foo@example.com')
+
+        assert len(cache) == 1
+
+    @pytest.mark.parametrize('type_', ['group-join', 'group-leave'])
+    def test_handle_user_event_drops_members_pubids(self, load, type_):
+        cache = GroupidsCache()
+        cache.fetch('readable', 'acct:foo@example.com', load)
+        cache.fetch('readable', 'acct:bar@example.com', load)
+
+        cache.handle_user_event({'type': type_,
+                                 'userid': 'acct:foo@example.com',
+                                 'group': 'abc123'})
+
+        assert len(cache) == 1
+
+    def test_handle_user_event_ignores_other_events(self, load):
+        cache = GroupidsCache()
+        cache.fetch('readable', 'acct:foo@example.com', load)
+
+        cache.handle_user_event({'type': 'nipsa-change',
+                                 'userid': 'acct:foo@example.com',
+                                 'nipsa': True})
+
+        assert len(cache) == 1
+
+    def test_listen_consumes_events_once_per_process(self):
+        spawn = mock.Mock()
+        cache = GroupidsCache(spawn=spawn)
+
+        cache.listen({})
+        cache.listen({})
+
+        spawn.assert_called_once_with(cache._consume, {})
+
+    def test_listen_consumes_events_again_after_fork(self, patch):
+        getpid = patch('h.services.group.os.getpid')
+        spawn = mock.Mock()
+        cache = GroupidsCache(spawn=spawn)
+        getpid.return_value = 1
+        cache.listen({})
+
+        getpid.return_value = 2
+        cache.listen({})
+
+        assert spawn.call_count == 2
+
+    def test_consume_runs_user_topic_consumer(self, patch):
+        realtime = patch('h.services.group.realtime')
+        cache = GroupidsCache()
+
+        cache._consume({'broker_url': 'amqp://example.com'})
+
+        realtime.Consumer.assert_called_once_with(
+            connection=realtime.get_connection.return_value,
+            routing_key='user',
+            handler=cache.handle_user_event)
+        realtime.Consumer.return_value.run.assert_called_once_with()
+
+    @pytest.fixture
+    def load(self):
+        return mock.Mock(return_value=['abc123'])
+
 
 @pytest.mark.usefixtures('user_service')
 class TestGroupsFactory(object):
@@ -251,6 +474,65 @@ class TestGroupsFactory(object):
 
         assert svc.session == pyramid_request.db
 
+    def test_provides_no_cache_by_default(self, pyramid_request):
+        svc = groups_factory(None, pyramid_request)
+
+        assert svc.cache is None
+
+    def test_provides_no_after_commit_without_cache(self, pyramid_request):
+        svc = groups_factory(None, pyramid_request)
+
+        assert svc.after_commit is None
+
+    def test_provides_registry_cache_if_enabled(self, pyramid_request):
+        cache = mock.Mock(spec_set=['listen'])
+        pyramid_request.registry[CACHE_KEY] = cache
+
+        svc = groups_factory(None, pyramid_request)
+
+        assert svc.cache is cache
+
+    def test_doesnt_listen_for_events_by_default(self, pyramid_request):
+        cache = mock.Mock(spec_set=['listen'])
+        pyramid_request.registry[CACHE_KEY] = cache
+
+        groups_factory(None, pyramid_request)
+
+        assert not cache.listen.called
+
+    def test_listens_for_events_if_enabled(self, pyramid_request):
+        cache = mock.Mock(spec_set=['listen'])
+        pyramid_request.registry[CACHE_KEY] = cache
+        pyramid_request.registry.settings['h.groups.cache_listen'] = 'true'
+
+        groups_factory(None, pyramid_request)
+
+        cache.listen.assert_called_once_with(pyramid_request.registry.settings)
+
+    def test_after_commit_calls_callback_once_transaction_commits(self, pyramid_request):
+        pyramid_request.registry[CACHE_KEY] = mock.Mock(spec_set=['listen'])
+        pyramid_request.tm = transaction.TransactionManager()
+        callback = mock.Mock()
+        svc = groups_factory(None, pyramid_request)
+
+        svc.after_commit(callback)
+        assert not callback.called
+        pyramid_request.tm.commit()
+
+        callback.assert_called_once_with()
+
+    def test_after_commit_skips_callback_if_transaction_aborts(self, pyramid_request):
+        pyramid_request.registry[CACHE_KEY] = mock.Mock(spec_set=['listen'])
+        pyramid_request.tm = transaction.TransactionManager()
+        callback = mock.Mock()
+        svc = groups_factory(None, pyramid_request)
+
+        svc.after_commit(callback)
+        pyramid_request.tm.abort()
+        pyramid_request.tm.commit()
+
+        assert not callback.called
+
     def test_wraps_user_service_as_user_fetcher(self, pyramid_request, user_service):
         svc = groups_factory(None, pyramid_request)
 
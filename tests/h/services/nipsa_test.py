@@ -2,7 +2,9 @@
 
 from __future__ import unicode_literals
 
+import mock
 import pytest
+import transaction
 
 from h.services.nipsa import NipsaService
 from h.services.nipsa import nipsa_factory
@@ -42,6 +44,14 @@ class TestNipsaService(object):
 
         reindex_user_annotations.delay.assert_called_once_with('acct:dominic@example.com')
 
+    def test_flag_publishes_nipsa_change(self, db_session, users):
+        publish = mock.Mock(spec_set=[])
+        svc = NipsaService(db_session, publish=publish)
+
+        svc.flag(users['dominic'])
+
+        publish.assert_called_once_with('acct:dominic@example.com', True)
+
     def test_unflag_sets_nipsa_false(self, db_session, users):
         svc = NipsaService(db_session)
 
@@ -56,6 +66,14 @@ class TestNipsaService(object):
 
         reindex_user_annotations.delay.assert_called_once_with('acct:renata@example.com')
 
+    def test_unflag_publishes_nipsa_change(self, db_session, users):
+        publish = mock.Mock(spec_set=[])
+        svc = NipsaService(db_session, publish=publish)
+
+        svc.unflag(users['renata'])
+
+        publish.assert_called_once_with('acct:renata@example.com', False)
+
     def test_clear_resets_cache(self, db_session, users):
         svc = NipsaService(db_session)
 
@@ -77,6 +95,34 @@ def test_nipsa_factory(pyramid_request):
     assert svc.session == pyramid_request.db
 
 
+def test_nipsa_factory_provides_realtime_publisher_as_publish(pyramid_request):
+    pyramid_request.realtime = mock.Mock(spec_set=['publish_user'])
+    pyramid_request.tm = transaction.TransactionManager()
+    svc = nipsa_factory(None, pyramid_request)
+
+    svc.publish('acct:renata@example.com', True)
+    assert not pyramid_request.realtime.publish_user.called
+    pyramid_request.tm.commit()
+
+    pyramid_request.realtime.publish_user.assert_called_once_with({
+        'type': 'nipsa-change',
+        'userid': 'acct:renata@example.com',
+        'nipsa': True,
+    })
+
+
+def test_nipsa_factory_publish_skips_aborted_changes(pyramid_request):
+    pyramid_request.realtime = mock.Mock(spec_set=['publish_user'])
+    pyramid_request.tm = transaction.TransactionManager()
+    svc = nipsa_factory(None, pyramid_request)
+
+    svc.publish('acct:renata@example.com', True)
+    pyramid_request.tm.abort()
+    pyramid_request.tm.commit()
+
+    assert not pyramid_request.realtime.publish_user.called
+
+
 @pytest.fixture
 def reindex_user_annotations(patch):
     return patch('h.services.nipsa.reindex_user_annotations')
@@ -86,6 +86,28 @@ class TestExpandURI(object):
             'http://bar.com/'
         ]
 
+    def test_expand_uri_uses_cached_expansions(self, db_session, expanded_uris):
+        expanded_uris.set('http://example.com/', ['http://example.com/',
+                                                  'http://example.org/'])
+
+        assert storage.expand_uri(db_session, 'http://example.com/') == [
+            'http://example.com/',
+            'http://example.org/',
+        ]
+
+    def test_expand_uri_populates_the_cache(self, db_session, expanded_uris):
+        storage.expand_uri(db_session, 'http://example.com/')
+
+        assert expanded_uris.get('http://example.com/') == ['http://example.com/']
+
+    def test_expand_uri_can_skip_the_cache(self, db_session, expanded_uris):
+        expanded_uris.set('http://example.com/', ['http://example.com/',
+                                                  'http://example.org/'])
+
+        actual = storage.expand_uri(db_session, 'http://example.com/', cached=False)
+
+        assert actual == ['http://example.com/']
+
 
 @pytest.mark.usefixtures('models', 'group_service', 'update_document_metadata')
 class TestCreateAnnotation(object):
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+from jsonpointer import JsonPointer
+
+from h.streamer import filter
+
+
+class FakeSubscriber(object):
+    pass
+
+
+class TestFilterHandler(object):
+    @pytest.mark.parametrize('operator,value,field_value,expected', [
+        ('equals', 'foo', 'foo', True),
+        ('equals', 'foo', 'bar', False),
+        ('equals', 'FÖÖ', 'foo', True),
+        ('matches', 'oo', 'food', True),
+        ('matches', 'foo', ['foo', 'bar'], True),
+        ('matches', ['foo', 'bar'], 'foo', True),
+        ('one_of', ['a', 'b'], 'b', True),
+        ('one_of', ['a', 'b'], 'c', False),
+        ('one_of', ['A', 'b'], 'a', True),
+        ('one_of', 'abc', 'b', False),
+        ('first_of', 'a', ['a', 'b'], True),
+        ('first_of', 'b', ['a', 'b'], False),
+        ('match_of', ['x', 'b'], ['a', 'b'], True),
+        ('match_of', ['x', 'y'], ['a', 'b'], False),
+        ('lt', 5, 4, True),
+        ('ge', 5, 4, False),
+        ('lene', 2, ['a', 'b'], True),
+        ('lenl', 2, ['a', 'b'], False),
+    ])
+    def test_operators(self, operator, value, field_value, expected):
+        handler = filter.FilterHandler(make_filter([{'field': '/field',
+                                                     'operator': operator,
+                                                     'value': value}]))
+
+        assert handler.match({'field': field_value}) is expected
+
+    def test_missing_field_does_not_match(self):
+        handler = filter.FilterHandler(make_filter([{'field': '/missing',
+                                                     'operator': 'equals',
+                                                     'value': 'foo'}]))
+
+        assert not handler.match({'field': 'foo'})
+
+    def test_list_of_fields_matches_any(self):
+        handler = filter.FilterHandler(make_filter([{'field': ['/a', '/b'],
+                                                     'operator': 'equals',
+                                                     'value': 'foo'}]))
+
+        assert handler.match({'a': 'bar', 'b': 'foo'})
+        assert not handler.match({'a': 'bar', 'b': 'baz'})
+
+    @pytest.mark.parametrize('policy,expected', [
+        ('include_any', True),
+        ('include_all', False),
+        ('exclude_any', False),
+        ('exclude_all', True),
+    ])
+    def test_match_policies(self, policy, expected):
+        handler = filter.FilterHandler(make_filter([
+            {'field': '/a', 'operator': 'equals', 'value': 'foo'},
+            {'field': '/b', 'operator': 'equals', 'value': 'foo'},
+        ], policy=policy))
+
+        assert handler.match({'a': 'foo', 'b': 'bar'}) is expected
+
+    def test_match_with_no_clauses(self):
+        handler = filter.FilterHandler(make_filter([]))
+
+        assert handler.match({})
+
+    def test_match_checks_actions(self):
+        handler = filter.FilterHandler(make_filter([], actions={'create': True}))
+
+        assert handler.match({}, 'create')
+        assert not handler.match({}, 'delete')
+
+    def test_matches_filter_targets(self):
+        handler = filter.FilterHandler(make_filter([{'field': '/field',
+                                                     'operator': 'equals',
+                                                     'value': 'foo'}]))
+
+        assert handler.match(filter.FilterTarget({'field': 'Foo'}))
+
+    @pytest.mark.parametrize('clause', [
+        {'operator': 'equals', 'value': 'foo'},
+        {'field': 'no-leading-slash', 'operator': 'equals', 'value': 'foo'},
+        {'field': '/field', 'operator': 'bogus', 'value': 'foo'},
+        {'field': '/field', 'operator': 'equals'},
+    ])
+    def test_raises_for_invalid_clauses(self, clause):
+        with pytest.raises(ValueError):
+            filter.FilterHandler(make_filter([clause]))
+
+
+class TestFilterTarget(object):
+    def test_get_folds_values(self):
+        target = filter.FilterTarget({'tags': ['Café', 'FOO']})
+
+        assert target.get('/tags', JsonPointer('/tags')) == ['cafe', 'foo']
+
+    def test_get_returns_none_for_missing_fields(self):
+        target = filter.FilterTarget({})
+
+        assert target.get('/tags', JsonPointer('/tags')) is None
+
+    def test_get_caches_values(self):
+        document = {'uri': 'http://example.com'}
+        target = filter.FilterTarget(document)
+        target.get('/uri', JsonPointer('/uri'))
+
+        document['uri'] = 'http://example.org'
+
+        assert target.get('/uri', JsonPointer('/uri')) == 'http://example.com'
+
+
+class TestFilterIndex(object):
+    def test_lookup_returns_subscribers_for_uri(self, index):
+        sub = FakeSubscriber()
+        index.add(sub, uri_filter(['http://example.com', 'http://example.org']))
+
+        assert index.lookup('http://example.org') == {sub}
+
+    def test_lookup_excludes_subscribers_for_other_uris(self, index):
+        index.add(FakeSubscriber(), uri_filter(['http://example.com']))
+
+        assert index.lookup('http://example.org') == set()
+
+    def test_lookup_folds_uris(self, index):
+        sub = FakeSubscriber()
+        index.add(sub, uri_filter(['http://Example.com/Ünïcode']))
+
+        assert index.lookup('http://example.COM/unicode') == {sub}
+
+    def test_lookup_includes_fallback_subscribers(self, index):
+        sub = FakeSubscriber()
+        index.add(sub, {'match_policy': 'include_any',
+                        'clauses': [],
+                        'actions': {}})
+
+        assert index.lookup('http://example.org') == {sub}
+
+    def test_add_replaces_previous_filter(self, index):
+        sub = FakeSubscriber()
+        index.add(sub, uri_filter(['http://example.com']))
+        index.add(sub, uri_filter(['http://example.org']))
+
+        assert index.lookup('http://example.com') == set()
+        assert index.lookup('http://example.org') == {sub}
+
+    def test_remove(self, index):
+        sub = FakeSubscriber()
+        index.add(sub, uri_filter(['http://example.com']))
+
+        index.remove(sub)
+
+        assert sub not in index
+        assert index.lookup('http://example.com') == set()
+
+    def test_remove_unknown_subscriber_does_not_raise(self, index):
+        index.remove(FakeSubscriber())
+
+    def test_subscribers_are_weakly_referenced(self, index):
+        index.add(FakeSubscriber(), uri_filter(['http://example.com']))
+
+        assert len(index) == 0
+
+    @pytest.fixture
+    def index(self):
+        return filter.FilterIndex()
+
+
+class TestIndexableURIs(object):
+    def test_one_of_clause(self):
+        result = filter.indexable_uris(uri_filter(['http://a.com', 'http://b.com']))
+
+        assert result == {'http://a.com', 'http://b.com'}
+
+    def test_equals_clause(self):
+        result = filter.indexable_uris(uri_filter('http://a.com', operator='equals'))
+
+        assert result == {'http://a.com'}
+
+    def test_one_of_clause_with_scalar_value_is_not_indexable(self):
+        # "one_of" with a string value is a substring match
+        result = filter.indexable_uris(uri_filter('http://a.com'))
+
+        assert result is None
+
+    def test_include_all_with_other_clauses(self):
+        filter_ = uri_filter(['http://a.com'])
+        filter_['clauses'].append({'field': '/user',
+                                   'operator': 'equals',
+                                   'value': 'acct:foo@example.com'})
+
+        assert filter.indexable_uris(filter_) == {'http://a.com'}
+
+    def test_include_any_with_other_clauses_is_not_indexable(self):
+        filter_ = uri_filter(['http://a.com'], policy='include_any')
+        filter_['clauses'].append({'field': '/user',
+                                   'operator': 'equals',
+                                   'value': 'acct:foo@example.com'})
+
+        assert filter.indexable_uris(filter_) is None
+
+    @pytest.mark.parametrize('policy', ['exclude_any', 'exclude_all'])
+    def test_exclude_policies_are_not_indexable(self, policy):
+        assert filter.indexable_uris(uri_filter(['http://a.com'], policy=policy)) is None
+
+    def test_non_uri_field_is_not_indexable(self):
+        filter_ = uri_filter(['http://a.com'])
+        filter_['clauses'][0]['field'] = ['/uri', '/references']
+
+        assert filter.indexable_uris(filter_) is None
+
+
+def uri_filter(value, operator='one_of', policy='include_all'):
+    return {
+        'match_policy': policy,
+        'clauses': [{'field': '/uri', 'operator': operator, 'value': value}],
+        'actions': {},
+    }
+
+
+def make_filter(clauses, policy='include_all', actions=None):
+    if actions is None:
+        actions = {}
+    return {'match_policy': policy, 'clauses': clauses, 'actions': actions}
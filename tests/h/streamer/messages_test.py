@@ -1,11 +1,14 @@
 # -*- coding: utf-8 -*-
 
+import json
+
 import mock
 import pytest
 from gevent.queue import Queue
 from pyramid import security
 from pyramid import registry
 
+from h.streamer import filter
 from h.streamer import messages
 
 
@@ -26,10 +29,15 @@ class FakeSocket(object):
         self.registry.settings = {'h.app_url': 'http://streamer'}
 
         self.send_json_payloads = []
+        self.send_raw_payloads = []
 
     def send_json(self, payload):
         self.send_json_payloads.append(payload)
 
+    def send_raw(self, data):
+        self.send_raw_payloads.append(data)
+        self.send_json_payloads.append(json.loads(data))
+
 
 @pytest.mark.usefixtures('fake_sentry', 'fake_stats')
 class TestProcessMessages(object):
@@ -126,23 +134,23 @@ class TestProcessMessages(object):
 
 
 class TestHandleMessage(object):
-    def test_calls_handler_with_list_of_sockets(self, websocket):
+    def test_calls_handler_leaving_it_to_pick_sockets(self):
         handler = mock.Mock(return_value=None)
         session = mock.sentinel.db_session
         settings = mock.sentinel.settings
         message = messages.Message(topic='foo', payload={'foo': 'bar'})
-        websocket.instances = [FakeSocket('a'), FakeSocket('b')]
 
         messages.handle_message(message, settings, session, topic_handlers={'foo': handler})
 
-        handler.assert_called_once_with(message.payload, list(websocket.instances), settings, session)
-
-    @pytest.fixture
-    def websocket(self, patch):
-        return patch('h.streamer.websocket.WebSocket')
+        handler.assert_called_once_with(message.payload, None, settings, session)
 
 
-@pytest.mark.usefixtures('fetch_annotation', 'groupfinder_service', 'links_service', 'nipsa_service')
+@pytest.mark.usefixtures('event_log',
+                         'fetch_annotation',
+                         'groupfinder_service',
+                         'links_service',
+                         'nipsa_cache',
+                         'nipsa_service')
 class TestHandleAnnotationEvent(object):
     def test_it_fetches_the_annotation(self, fetch_annotation, presenter_asdict):
         message = {
@@ -180,11 +188,12 @@ class TestHandleAnnotationEvent(object):
 
         assert result is None
 
-    def test_it_initializes_groupfinder_service(self, groupfinder_service):
+    def test_it_initializes_groupfinder_service(self, groupfinder_service, presenter_asdict):
         message = {'action': '_', 'annotation_id': '_', 'src_client_id': '_'}
         session = mock.sentinel.db_session
         socket = FakeSocket('giraffe')
         settings = {'h.authority': 'example.org'}
+        presenter_asdict.return_value = self.serialized_annotation()
 
         messages.handle_annotation_event(message, [socket], settings, session)
 
@@ -214,6 +223,32 @@ class TestHandleAnnotationEvent(object):
             annotation_resource.return_value)
         assert presenters.AnnotationJSONPresenter.return_value.asdict.called
 
+    def test_it_serializes_the_annotation_once_for_all_sockets(self, presenters):
+        message = {'action': '_', 'annotation_id': '_', 'src_client_id': '_'}
+        sockets = [FakeSocket('giraffe'), FakeSocket('pigeon')]
+        sockets[1].registry = sockets[0].registry
+        session = mock.sentinel.db_session
+        settings = {'foo': 'bar'}
+        presenters.AnnotationJSONPresenter.return_value.asdict.return_value = (
+            self.serialized_annotation())
+
+        messages.handle_annotation_event(message, sockets, settings, session)
+
+        assert presenters.AnnotationJSONPresenter.return_value.asdict.call_count == 1
+
+    def test_it_sends_the_same_encoded_notification_to_all_sockets(self, presenter_asdict):
+        message = {'action': 'create', 'annotation_id': '_', 'src_client_id': '_'}
+        sockets = [FakeSocket('giraffe'), FakeSocket('pigeon')]
+        sockets[1].registry = sockets[0].registry
+        session = mock.sentinel.db_session
+        settings = {'foo': 'bar'}
+        presenter_asdict.return_value = self.serialized_annotation()
+
+        messages.handle_annotation_event(message, sockets, settings, session)
+
+        first, second = [s.send_raw_payloads[0] for s in sockets]
+        assert first is second
+
     def test_notification_format(self, presenter_asdict):
         """Check the format of the returned notification in the happy case."""
         message = {
@@ -232,6 +267,8 @@ class TestHandleAnnotationEvent(object):
             'payload': [self.serialized_annotation()],
             'type': 'annotation-notification',
             'options': {'action': 'update'},
+            'stream': 'stream-id',
+            'seq': 1,
         }
 
     def test_notification_format_delete(self, fetch_annotation, presenter_asdict):
@@ -253,6 +290,8 @@ class TestHandleAnnotationEvent(object):
             'payload': [{'id': annotation.id}],
             'type': 'annotation-notification',
             'options': {'action': 'delete'},
+            'stream': 'stream-id',
+            'seq': 1,
         }
 
     def test_no_send_for_sender_socket(self, presenter_asdict):
@@ -305,19 +344,31 @@ class TestHandleAnnotationEvent(object):
 
         assert socket.send_json_payloads == []
 
-    def test_no_send_if_annotation_nipsad(self, nipsa_service, presenter_asdict):
+    def test_no_send_if_annotation_nipsad(self, fetch_annotation, nipsa_service, presenter_asdict):
         """Should return None if the annotation is from a NIPSA'd user."""
         message = {'action': '_', 'src_client_id': '_', 'annotation_id': '_'}
         socket = FakeSocket('giraffe')
         session = mock.sentinel.db_session
         settings = {'foo': 'bar'}
         presenter_asdict.return_value = self.serialized_annotation()
-        nipsa_service.return_value.is_flagged.return_value = True
+        nipsa_service.return_value.flagged_userids = set([fetch_annotation.return_value.userid])
 
         messages.handle_annotation_event(message, [socket], settings, session)
 
         assert socket.send_json_payloads == []
 
+    def test_loads_nipsa_state_once(self, nipsa_service, presenter_asdict):
+        message = {'action': '_', 'src_client_id': '_', 'annotation_id': '_'}
+        socket = FakeSocket('giraffe')
+        session = mock.sentinel.db_session
+        settings = {'foo': 'bar'}
+        presenter_asdict.return_value = self.serialized_annotation()
+
+        messages.handle_annotation_event(message, [socket], settings, session)
+        messages.handle_annotation_event(message, [socket], settings, session)
+
+        nipsa_service.assert_called_once_with(session)
+
     def test_sends_nipsad_annotations_to_owners(self, fetch_annotation, nipsa_service, presenter_asdict):
         """NIPSA'd users should see their own annotations."""
         message = {'action': '_', 'src_client_id': '_', 'annotation_id': '_'}
@@ -327,7 +378,7 @@ class TestHandleAnnotationEvent(object):
         session = mock.sentinel.db_session
         settings = {'foo': 'bar'}
         presenter_asdict.return_value = self.serialized_annotation()
-        nipsa_service.return_value.is_flagged.return_value = True
+        nipsa_service.return_value.flagged_userids = set(['fred'])
 
         messages.handle_annotation_event(message, [socket], settings, session)
 
@@ -382,6 +433,134 @@ class TestHandleAnnotationEvent(object):
 
         assert len(socket.send_json_payloads) == 1
 
+    def test_only_considers_sockets_subscribed_to_annotation_uri(self,
+                                                                 fetch_annotation,
+                                                                 presenter_asdict,
+                                                                 subscriptions):
+        message = {'action': '_', 'src_client_id': '_', 'annotation_id': '_'}
+        fetch_annotation.return_value.target_uri = 'http://example.com'
+        subscribed = FakeSocket('giraffe')
+        unsubscribed = FakeSocket('pigeon')
+        subscriptions.add(subscribed, self.uri_filter('http://example.com'))
+        subscriptions.add(unsubscribed, self.uri_filter('http://example.org'))
+        session = mock.sentinel.db_session
+        settings = {'foo': 'bar'}
+        presenter_asdict.return_value = self.serialized_annotation()
+
+        messages.handle_annotation_event(message, None, settings, session)
+
+        assert len(subscribed.send_json_payloads) == 1
+        assert unsubscribed.send_json_payloads == []
+
+    def test_only_visits_subscribed_sockets(self, fetch_annotation, presenter_asdict,
+                                            subscriptions):
+        message = {'action': '_', 'src_client_id': '_', 'annotation_id': '_'}
+        fetch_annotation.return_value.target_uri = 'http://example.com'
+        subscribed = FakeSocket('giraffe')
+        subscriptions.add(subscribed, self.uri_filter('http://example.com'))
+        presenter_asdict.return_value = self.serialized_annotation()
+
+        with mock.patch('h.streamer.websocket.WebSocket.instances') as instances:
+            messages.handle_annotation_event(message, None, {}, mock.sentinel.db_session)
+
+        assert not instances.mock_calls
+        assert len(subscribed.send_json_payloads) == 1
+
+    def test_uses_embedded_snapshot_instead_of_database(self, fetch_annotation, presenters):
+        snapshot = self.serialized_annotation({'id': 'panda',
+                                               'user': 'acct:fred@example.com',
+                                               'uri': 'http://example.com'})
+        message = {'annotation_id': 'panda',
+                   'action': 'create',
+                   'src_client_id': 'pigeon',
+                   'annotation': snapshot}
+        socket = FakeSocket('giraffe')
+        session = mock.sentinel.db_session
+        settings = {'foo': 'bar'}
+
+        messages.handle_annotation_event(message, [socket], settings, session)
+
+        assert not fetch_annotation.called
+        assert not presenters.AnnotationJSONPresenter.called
+        assert socket.send_json_payloads[0]['payload'] == [snapshot]
+
+    def test_no_send_if_snapshot_user_nipsad(self, nipsa_service):
+        snapshot = self.serialized_annotation({'id': 'panda',
+                                               'user': 'acct:fred@example.com',
+                                               'uri': 'http://example.com'})
+        message = {'annotation_id': 'panda',
+                   'action': 'create',
+                   'src_client_id': 'pigeon',
+                   'annotation': snapshot}
+        socket = FakeSocket('giraffe')
+        session = mock.sentinel.db_session
+        nipsa_service.return_value.flagged_userids = set(['acct:fred@example.com'])
+
+        messages.handle_annotation_event(message, [socket], {}, session)
+
+        assert socket.send_json_payloads == []
+
+    def test_gives_each_event_a_new_seq(self, presenter_asdict):
+        message = {'action': 'create', 'annotation_id': '_', 'src_client_id': '_'}
+        socket = FakeSocket('giraffe')
+        presenter_asdict.return_value = self.serialized_annotation()
+
+        messages.handle_annotation_event(message, [socket], {}, mock.sentinel.db_session)
+        messages.handle_annotation_event(message, [socket], {}, mock.sentinel.db_session)
+
+        assert [p['seq'] for p in socket.send_json_payloads] == [1, 2]
+
+    def test_logs_event_with_rendered_annotation(self, event_log, presenter_asdict):
+        message = {'action': 'create', 'annotation_id': 'panda', 'src_client_id': '_'}
+        socket = FakeSocket('giraffe')
+        presenter_asdict.return_value = self.serialized_annotation()
+
+        messages.handle_annotation_event(message, [socket], {}, mock.sentinel.db_session)
+
+        assert event_log.since('stream-id', 0) == [
+            (1, dict(message, annotation=self.serialized_annotation())),
+        ]
+
+    def test_logs_event_without_annotation_if_not_rendered(self, event_log):
+        message = {'action': 'create', 'annotation_id': 'panda', 'src_client_id': '_'}
+
+        messages.handle_annotation_event(message, [], {}, mock.sentinel.db_session)
+
+        assert event_log.since('stream-id', 0) == [(1, message)]
+
+    @pytest.mark.parametrize('action,invalidated', [
+        ('create', True),
+        ('update', True),
+        ('delete', False),
+    ])
+    def test_invalidates_expanded_uris_on_save(self,
+                                               fetch_annotation,
+                                               expanded_uris,
+                                               presenter_asdict,
+                                               action,
+                                               invalidated):
+        message = {'action': action, 'annotation_id': '_', 'src_client_id': '_'}
+        fetch_annotation.return_value.target_uri = 'http://example.com'
+        presenter_asdict.return_value = self.serialized_annotation()
+        expanded_uris.set('http://example.com', ['http://example.com'])
+
+        messages.handle_annotation_event(message, [], {}, mock.sentinel.db_session)
+
+        assert (expanded_uris.get('http://example.com') is None) == invalidated
+
+    def test_does_not_log_read_events(self, event_log, presenter_asdict):
+        message = {'action': 'read', 'annotation_id': 'panda', 'src_client_id': '_'}
+
+        messages.handle_annotation_event(message, [FakeSocket('giraffe')], {},
+                                         mock.sentinel.db_session)
+
+        assert len(event_log) == 0
+
+    def uri_filter(self, uri):
+        return {'match_policy': 'include_all',
+                'clauses': [{'field': '/uri', 'operator': 'one_of', 'value': [uri]}],
+                'actions': {}}
+
     def serialized_annotation(self, data=None):
         if data is None:
             data = {}
@@ -418,13 +597,237 @@ class TestHandleAnnotationEvent(object):
     @pytest.fixture
     def nipsa_service(self, patch):
         service = patch('h.streamer.messages.NipsaService')
-        service.return_value.is_flagged.return_value = False
+        service.return_value.flagged_userids = set()
         return service
 
     @pytest.fixture
     def annotation_resource(self, patch):
         return patch('h.streamer.messages.AnnotationResource')
 
+    @pytest.yield_fixture
+    def nipsa_cache(self):
+        with mock.patch('h.streamer.messages.NIPSA_CACHE', messages.NipsaCache()) as cache:
+            yield cache
+
+    @pytest.yield_fixture
+    def subscriptions(self):
+        subscriptions = filter.FilterIndex()
+        with mock.patch('h.streamer.websocket.WebSocket.subscriptions', subscriptions):
+            yield subscriptions
+
+
+@pytest.mark.usefixtures('event_log', 'nipsa_cache', 'nipsa_service')
+class TestReplayAnnotationEvents(object):
+    def test_sends_missed_events(self, event_log):
+        socket = self.resuming_socket({'stream': 'stream-id', 'seq': 1})
+        for id_ in ['first', 'second', 'third']:
+            event_log.append(event_log.next_seq(), self.event(id_))
+
+        messages.replay_annotation_events(socket, {}, mock.sentinel.db_session)
+
+        assert [p['payload'][0]['id'] for p in socket.send_json_payloads] == [
+            'second', 'third']
+        assert [p['seq'] for p in socket.send_json_payloads] == [2, 3]
+
+    def test_only_sends_events_matching_filter(self, event_log):
+        socket = self.resuming_socket({'stream': 'stream-id', 'seq': 0})
+        socket.filter.match.return_value = False
+        event_log.append(event_log.next_seq(), self.event('first'))
+
+        messages.replay_annotation_events(socket, {}, mock.sentinel.db_session)
+
+        assert socket.send_json_payloads == []
+
+    def test_only_replays_once(self, event_log):
+        socket = self.resuming_socket({'stream': 'stream-id', 'seq': 0})
+        event_log.append(event_log.next_seq(), self.event('first'))
+
+        messages.replay_annotation_events(socket, {}, mock.sentinel.db_session)
+        messages.replay_annotation_events(socket, {}, mock.sentinel.db_session)
+
+        assert len(socket.send_json_payloads) == 1
+        assert socket.resume_from is None
+
+    def test_waits_for_a_filter(self, event_log):
+        socket = self.resuming_socket({'stream': 'stream-id', 'seq': 0})
+        socket.filter = None
+        event_log.append(event_log.next_seq(), self.event('first'))
+
+        messages.replay_annotation_events(socket, {}, mock.sentinel.db_session)
+
+        assert socket.send_json_payloads == []
+        assert socket.resume_from is not None
+
+    def test_does_nothing_if_not_resuming(self, event_log):
+        socket = FakeSocket('giraffe')
+        event_log.append(event_log.next_seq(), self.event('first'))
+
+        messages.replay_annotation_events(socket, {}, mock.sentinel.db_session)
+
+        assert socket.send_json_payloads == []
+
+    @pytest.mark.parametrize('resume_from', [
+        {'stream': 'other-stream', 'seq': 0},
+        {'stream': 'stream-id', 'seq': 5},
+        {'stream': 'stream-id'},
+        'stream-id',
+    ])
+    def test_sends_resume_failed_if_events_unavailable(self, event_log, resume_from):
+        socket = self.resuming_socket(resume_from)
+        event_log.append(event_log.next_seq(), self.event('first'))
+
+        messages.replay_annotation_events(socket, {}, mock.sentinel.db_session)
+
+        assert socket.send_json_payloads == [{'type': 'resume-failed'}]
+
+    def resuming_socket(self, resume_from):
+        socket = FakeSocket('giraffe')
+        socket.resume_from = resume_from
+        socket.filter.match.return_value = True
+        return socket
+
+    def event(self, id_):
+        return {'action': 'create',
+                'annotation_id': id_,
+                'src_client_id': 'pigeon',
+                'annotation': {'id': id_,
+                               'user': 'acct:fred@example.com',
+                               'uri': 'http://example.com',
+                               'permissions': {'read': ['group:__world__']}}}
+
+    @pytest.fixture
+    def nipsa_service(self, patch):
+        service = patch('h.streamer.messages.NipsaService')
+        service.return_value.flagged_userids = set()
+        return service
+
+    @pytest.yield_fixture
+    def nipsa_cache(self):
+        with mock.patch('h.streamer.messages.NIPSA_CACHE', messages.NipsaCache()) as cache:
+            yield cache
+
+
+class TestEventLog(object):
+    def test_next_seq_increases(self):
+        log = messages.EventLog()
+
+        assert [log.next_seq(), log.next_seq()] == [1, 2]
+
+    def test_has_random_stream_ids(self):
+        assert messages.EventLog().stream != messages.EventLog().stream
+
+    def test_since_returns_later_events(self):
+        log = messages.EventLog(stream='s')
+        for message in ['a', 'b', 'c']:
+            log.append(log.next_seq(), message)
+
+        assert log.since('s', 1) == [(2, 'b'), (3, 'c')]
+
+    def test_since_skips_missing_seqs(self):
+        log = messages.EventLog(stream='s')
+        log.append(log.next_seq(), 'a')
+        log.next_seq()
+        log.append(log.next_seq(), 'c')
+
+        assert log.since('s', 0) == [(1, 'a'), (3, 'c')]
+
+    def test_since_latest_seq_returns_nothing(self):
+        log = messages.EventLog(stream='s')
+        log.append(log.next_seq(), 'a')
+
+        assert log.since('s', 1) == []
+
+    def test_evicts_oldest_events(self):
+        log = messages.EventLog(maxlen=2, stream='s')
+        for message in ['a', 'b', 'c']:
+            log.append(log.next_seq(), message)
+
+        assert len(log) == 2
+        assert log.since('s', 1) == [(2, 'b'), (3, 'c')]
+
+    def test_since_returns_none_if_events_evicted(self):
+        log = messages.EventLog(maxlen=2, stream='s')
+        for message in ['a', 'b', 'c']:
+            log.append(log.next_seq(), message)
+
+        assert log.since('s', 0) is None
+
+    @pytest.mark.parametrize('stream,seq', [
+        ('other', 0),
+        ('s', 2),
+        ('s', '0'),
+        ('s', None),
+        ('s', True),
+    ])
+    def test_since_returns_none_for_unknown_positions(self, stream, seq):
+        log = messages.EventLog(stream='s')
+        log.append(log.next_seq(), 'a')
+
+        assert log.since(stream, seq) is None
+
+
+class TestNipsaCache(object):
+    def test_is_flagged_loads_flagged_userids(self, nipsa_service):
+        cache = messages.NipsaCache()
+        session = mock.sentinel.db_session
+
+        assert cache.is_flagged(session, 'acct:renata@example.com')
+        assert not cache.is_flagged(session, 'acct:dominic@example.com')
+        nipsa_service.assert_called_once_with(session)
+
+    def test_is_flagged_reloads_when_expired(self, nipsa_service):
+        now = [0]
+        cache = messages.NipsaCache(max_age=60, clock=lambda: now[0])
+        session = mock.sentinel.db_session
+        cache.is_flagged(session, 'acct:renata@example.com')
+
+        now[0] = 60
+        cache.is_flagged(session, 'acct:renata@example.com')
+
+        assert nipsa_service.call_count == 2
+
+    def test_update_flags_userid(self, nipsa_service):
+        cache = messages.NipsaCache()
+        session = mock.sentinel.db_session
+        cache.is_flagged(session, 'acct:renata@example.com')
+
+        cache.update('acct:dominic@example.com', True)
+
+        assert cache.is_flagged(session, 'acct:dominic@example.com')
+        assert nipsa_service.call_count == 1
+
+    def test_update_unflags_userid(self, nipsa_service):
+        cache = messages.NipsaCache()
+        session = mock.sentinel.db_session
+        cache.is_flagged(session, 'acct:renata@example.com')
+
+        cache.update('acct:renata@example.com', False)
+
+        assert not cache.is_flagged(session, 'acct:renata@example.com')
+
+    def test_update_before_load_is_ignored(self, nipsa_service):
+        cache = messages.NipsaCache()
+
+        cache.update('acct:dominic@example.com', True)
+
+        assert not cache.is_flagged(mock.sentinel.db_session, 'acct:dominic@example.com')
+
+    def test_clear_forces_reload(self, nipsa_service):
+        cache = messages.NipsaCache()
+        session = mock.sentinel.db_session
+        cache.is_flagged(session, 'acct:renata@example.com')
+
+        cache.clear()
+        cache.is_flagged(session, 'acct:renata@example.com')
+
+        assert nipsa_service.call_count == 2
+
+    @pytest.fixture
+    def nipsa_service(self, patch):
+        service = patch('h.streamer.messages.NipsaService')
+        service.return_value.flagged_userids = set(['acct:renata@example.com'])
+        return service
+
 
 class TestHandleUserEvent(object):
     def test_sends_session_change_when_joining_or_leaving_group(self):
@@ -459,3 +862,43 @@ class TestHandleUserEvent(object):
         messages.handle_user_event(message, [socket], None, None)
 
         assert socket.send_json_payloads == []
+
+    def test_sends_to_all_connected_sockets_by_default(self):
+        message = {
+            'type': 'group-join',
+            'userid': 'amy',
+            'group': 'groupid',
+            'session_model': mock.Mock(),
+        }
+        socket = FakeSocket('clientid')
+        socket.authenticated_userid = 'amy'
+
+        with mock.patch('h.streamer.websocket.WebSocket.instances', [socket]):
+            messages.handle_user_event(message, None, None, None)
+
+        assert len(socket.send_json_payloads) == 1
+
+    def test_nipsa_change_updates_nipsa_cache(self, nipsa_cache):
+        message = {
+            'type': 'nipsa-change',
+            'userid': 'amy',
+            'nipsa': True,
+        }
+        socket = FakeSocket('clientid')
+        socket.authenticated_userid = 'amy'
+
+        messages.handle_user_event(message, [socket], None, None)
+
+        nipsa_cache.update.assert_called_once_with('amy', True)
+        assert socket.send_json_payloads == []
+
+    @pytest.fixture
+    def nipsa_cache(self, patch):
+        return patch('h.streamer.messages.NIPSA_CACHE')
+
+
+@pytest.yield_fixture
+def event_log():
+    with mock.patch('h.streamer.messages.EVENT_LOG',
+                    messages.EventLog(stream='stream-id')) as log:
+        yield log
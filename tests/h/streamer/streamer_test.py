@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 
+import gevent
 import mock
+from gevent.queue import Queue
 from mock import call
 import pytest
 
@@ -51,6 +53,17 @@ def test_process_work_queue_sends_websocket_messages_to_websocket_handle_message
     websocket.handle_message.assert_called_once_with(message, session)
 
 
+def test_process_work_queue_replays_events_after_websocket_messages(session):
+    message = websocket.Message(socket=mock.sentinel.SOCKET, payload='bar')
+    settings = {'foo': 'bar'}
+
+    streamer.process_work_queue(settings, [message], session_factory=lambda _: session)
+
+    messages.replay_annotation_events.assert_called_once_with(mock.sentinel.SOCKET,
+                                                              settings,
+                                                              session)
+
+
 def test_process_work_queue_commits_after_each_message(session):
     message1 = websocket.Message(socket=mock.sentinel.SOCKET, payload='bar')
     message2 = messages.Message(topic='user', payload='bar')
@@ -109,6 +122,108 @@ def test_process_work_queue_calls_close_after_rollback(session):
     ]
 
 
+class TestProcessWorkQueueBatching(object):
+    def test_handles_batch_in_one_transaction(self, session, queue):
+        for payload in ['a', 'b', 'c']:
+            queue.put(messages.Message(topic='user', payload=payload))
+        queue.put(StopIteration)
+
+        streamer.process_work_queue(self.settings(), queue, session_factory=lambda _: session)
+
+        assert messages.handle_message.call_count == 3
+        assert session.execute.call_count == 1
+        assert session.commit.call_count == 1
+
+    def test_splits_messages_into_batches_of_batch_size(self, session, queue):
+        for payload in ['a', 'b', 'c']:
+            queue.put(messages.Message(topic='user', payload=payload))
+        queue.put(StopIteration)
+
+        streamer.process_work_queue(self.settings(batch_size=2),
+                                    queue,
+                                    session_factory=lambda _: session)
+
+        assert session.commit.call_count == 2
+
+    def test_prefetches_annotations_for_batch(self, session, queue, fetch_ordered_annotations):
+        queue.put(messages.Message(topic='annotation', payload={'annotation_id': 'a'}))
+        queue.put(messages.Message(topic='annotation', payload={'annotation_id': 'b'}))
+        queue.put(messages.Message(topic='user', payload={'userid': 'c'}))
+        queue.put(StopIteration)
+
+        streamer.process_work_queue(self.settings(), queue, session_factory=lambda _: session)
+
+        fetch_ordered_annotations.assert_called_once_with(session,
+                                                          mock.ANY,
+                                                          query_processor=mock.ANY)
+        ids = fetch_ordered_annotations.call_args[0][1]
+        assert sorted(ids) == ['a', 'b']
+
+    def test_does_not_prefetch_embedded_annotations(self, session, queue, fetch_ordered_annotations):
+        queue.put(messages.Message(topic='annotation', payload={'annotation_id': 'a'}))
+        queue.put(messages.Message(topic='annotation', payload={'annotation_id': 'b',
+                                                                'annotation': {}}))
+        queue.put(StopIteration)
+
+        streamer.process_work_queue(self.settings(), queue, session_factory=lambda _: session)
+
+        ids = fetch_ordered_annotations.call_args[0][1]
+        assert ids == ['a']
+
+    def test_continues_batch_after_handler_exception(self, session, queue):
+        for payload in ['a', 'b']:
+            queue.put(messages.Message(topic='user', payload=payload))
+        queue.put(StopIteration)
+        messages.handle_message.side_effect = [RuntimeError('explosion'), None]
+
+        streamer.process_work_queue(self.settings(), queue, session_factory=lambda _: session)
+
+        assert messages.handle_message.call_count == 2
+        assert session.method_calls[-4:] == [
+            call.rollback(),
+            call.execute(mock.ANY),
+            call.commit(),
+            call.close(),
+        ]
+
+    def test_handles_batch_when_prefetch_fails(self, session, queue, fetch_ordered_annotations):
+        for payload in ['a', 'b']:
+            queue.put(messages.Message(topic='user', payload=payload))
+        queue.put(StopIteration)
+        fetch_ordered_annotations.side_effect = RuntimeError('explosion')
+
+        streamer.process_work_queue(self.settings(), queue, session_factory=lambda _: session)
+
+        assert messages.handle_message.call_count == 2
+        assert session.commit.call_count == 1
+
+    def test_does_not_wait_longer_than_batch_latency(self, session, queue):
+        queue.put(messages.Message(topic='user', payload='a'))
+
+        def finish():
+            queue.put(messages.Message(topic='user', payload='b'))
+            queue.put(StopIteration)
+        gevent.spawn_later(0.05, finish)
+
+        streamer.process_work_queue(self.settings(batch_latency_ms=1),
+                                    queue,
+                                    session_factory=lambda _: session)
+
+        assert session.commit.call_count == 2
+
+    def settings(self, batch_size=10, batch_latency_ms=100):
+        return {'h.streamer.batch_size': batch_size,
+                'h.streamer.batch_latency_ms': batch_latency_ms}
+
+    @pytest.fixture
+    def queue(self):
+        return Queue()
+
+    @pytest.fixture
+    def fetch_ordered_annotations(self, patch):
+        return patch('h.streamer.streamer.storage.fetch_ordered_annotations')
+
+
 @pytest.fixture
 def session():
     return mock.Mock(spec_set=['close', 'commit', 'execute', 'rollback'])
@@ -122,3 +237,8 @@ def websocket_handle_message(patch):
 @pytest.fixture(autouse=True)
 def messages_handle_message(patch):
     return patch('h.streamer.messages.handle_message')
+
+
+@pytest.fixture(autouse=True)
+def messages_replay_annotation_events(patch):
+    return patch('h.streamer.messages.replay_annotation_events')
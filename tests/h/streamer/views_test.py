@@ -35,6 +35,20 @@ def test_websocket_view_adds_work_queue_to_environ(pyramid_request):
     assert env['h.ws.streamer_work_queue'] == streamer.WORK_QUEUE
 
 
+def test_websocket_view_adds_outbox_limits_to_environ(pyramid_request):
+    pyramid_request.get_response = lambda _: None
+    pyramid_request.registry.settings.update({
+        'h.streamer.outbox_max_bytes': 4096,
+        'h.streamer.outbox_overflow': 'drop_oldest',
+    })
+
+    views.websocket_view(pyramid_request)
+    env = pyramid_request.environ
+
+    assert env['h.ws.outbox_max_bytes'] == 4096
+    assert env['h.ws.outbox_overflow'] == 'drop_oldest'
+
+
 @pytest.fixture
 def pyramid_request(pyramid_request):
     return pyramid_request
@@ -2,8 +2,10 @@
 
 from collections import namedtuple
 
+import gevent
 import mock
 import pytest
+from gevent.event import Event
 from gevent.queue import Queue
 from jsonschema import ValidationError
 from pyramid import security
@@ -88,6 +90,15 @@ class TestWebSocket(object):
         # A second closure (however unusual) should not raise
         client1.closed(1000)
 
+    def test_removes_self_from_subscriptions_when_closed(self, client):
+        websocket.WebSocket.subscriptions.add(client, {'match_policy': 'include_all',
+                                                       'clauses': [],
+                                                       'actions': {}})
+
+        client.closed(1000)
+
+        assert client not in websocket.WebSocket.subscriptions
+
     def test_enqueues_incoming_messages(self, client, queue):
         """Valid messages are pushed onto the queue."""
         message = FakeMessage('{"foo":"bar"}')
@@ -146,9 +157,130 @@ class TestWebSocket(object):
         payload = {'foo': 'bar'}
 
         client.send_json(payload)
+        gevent.sleep(0)
+
+        fake_socket_send.assert_called_once_with(client, '{"foo": "bar"}')
+
+    def test_socket_send_raw(self, client, fake_socket_send):
+        client.send_raw('{"foo": "bar"}')
+        gevent.sleep(0)
 
         fake_socket_send.assert_called_once_with(client, '{"foo": "bar"}')
 
+    def test_socket_send_raw_does_not_block_on_send(self, client, fake_socket_send):
+        client.send_raw('{"foo": "bar"}')
+
+        assert not fake_socket_send.called
+        assert client.outbox_bytes == len('{"foo": "bar"}')
+
+    def test_socket_sends_queued_messages_in_order(self, client, fake_socket_send):
+        client.send_raw('1')
+        client.send_raw('2')
+        gevent.sleep(0)
+        client.send_raw('3')
+        gevent.sleep(0)
+
+        assert fake_socket_send.call_args_list == [mock.call(client, '1'),
+                                                   mock.call(client, '2'),
+                                                   mock.call(client, '3')]
+        assert client.outbox_bytes == 0
+
+    def test_socket_overflow_drops_oldest_messages(self, client, fake_socket_send):
+        client.outbox_max_bytes = 2
+        client.outbox_overflow = websocket.OVERFLOW_DROP_OLDEST
+        websocket.WebSocket.dropped_messages = 0
+
+        for data in ['1', '2', '3']:
+            client.send_raw(data)
+        gevent.sleep(0)
+
+        assert fake_socket_send.call_args_list == [mock.call(client, '2'),
+                                                   mock.call(client, '3')]
+        assert websocket.WebSocket.dropped_messages == 1
+
+    def test_socket_overflow_closes_connection(self, client, fake_socket_close, fake_socket_send):
+        client.outbox_max_bytes = 2
+        client.outbox_overflow = websocket.OVERFLOW_CLOSE
+        websocket.WebSocket.evictions = 0
+
+        for data in ['1', '2', '3']:
+            client.send_raw(data)
+        client.send_raw('4')
+
+        assert not fake_socket_close.called
+        assert websocket.WebSocket.evictions == 1
+        assert client.outbox_bytes == 0
+
+        gevent.sleep(0)
+
+        fake_socket_close.assert_called_once_with(client, code=1008, reason='client too slow')
+        assert not fake_socket_send.called
+
+    def test_socket_overflow_closes_connection_after_message_being_sent(self,
+                                                                        client,
+                                                                        fake_socket_close,
+                                                                        fake_socket_send):
+        client.outbox_max_bytes = 2
+        client.outbox_overflow = websocket.OVERFLOW_CLOSE
+        sending = Event()
+        sent = Event()
+        events = []
+
+        def send(_, data):
+            sending.set()
+            sent.wait()
+            events.append(('send', data))
+        fake_socket_send.side_effect = send
+        fake_socket_close.side_effect = lambda *args, **kwargs: events.append(('close',))
+
+        client.send_raw('1')
+        sending.wait()
+        for data in ['2', '3', '4']:
+            client.send_raw(data)
+        sent.set()
+        gevent.sleep(0)
+
+        assert events == [('send', '1'), ('close',)]
+
+    def test_socket_send_error_closes_connection(self, client, fake_socket_send):
+        fake_socket_send.side_effect = RuntimeError('broken pipe')
+
+        with mock.patch.object(websocket.WebSocket, 'close_connection') as close_connection:
+            client.send_raw('1')
+            client.send_raw('2')
+            gevent.sleep(0)
+
+        close_connection.assert_called_once_with()
+        assert fake_socket_send.call_count == 1
+
+    def test_socket_closed_clears_outbox(self, client, fake_socket_send):
+        client.send_raw('1')
+
+        client.closed(1000)
+        gevent.sleep(0)
+
+        assert not fake_socket_send.called
+        assert client.outbox_bytes == 0
+
+    def test_socket_outbox_limits_from_environ(self, fake_environ):
+        fake_environ['h.ws.outbox_max_bytes'] = 123
+        fake_environ['h.ws.outbox_overflow'] = 'drop_oldest'
+
+        client = websocket.WebSocket(mock.sentinel.sock, environ=fake_environ)
+
+        assert client.outbox_max_bytes == 123
+        assert client.outbox_overflow == 'drop_oldest'
+
+    def test_socket_send_raw_skips_when_terminated(self,
+                                                   client,
+                                                   fake_socket_send,
+                                                   fake_socket_terminated):
+        fake_socket_terminated.return_value = True
+
+        client.send_raw('{"foo": "bar"}')
+
+        assert not fake_socket_send.called
+
     def test_socket_send_json_skips_when_terminated(self,
                                                     client,
                                                     fake_socket_send,
@@ -159,10 +291,12 @@ class TestWebSocket(object):
 
         assert not fake_socket_send.called
 
-    @pytest.fixture
+    @pytest.yield_fixture
     def client(self, fake_environ):
         sock = mock.Mock(spec_set=['sendall'])
-        return websocket.WebSocket(sock, environ=fake_environ)
+        client = websocket.WebSocket(sock, environ=fake_environ)
+        yield client
+        client.closed(1000)
 
     @pytest.fixture
     def queue(self):
@@ -255,6 +389,17 @@ class TestHandleClientIDMessage(object):
 
         assert socket.client_id == 'abcd1234'
 
+    def test_sets_resume_from(self, socket):
+        message = websocket.Message(socket=socket, payload={
+            'messageType': 'client_id',
+            'value': 'abcd1234',
+            'resume_from': {'stream': 'abc', 'seq': 12},
+        })
+
+        websocket.handle_client_id_message(message)
+
+        assert socket.resume_from == {'stream': 'abc', 'seq': 12}
+
     def test_missing_value_error(self, matchers, socket):
         message = websocket.Message(socket=socket, payload={
             'messageType': 'client_id',
@@ -291,6 +436,37 @@ class TestHandleFilterMessage(object):
 
         assert socket.filter is not None
 
+    def test_indexes_socket_by_filter_uris(self, socket):
+        message = websocket.Message(socket=socket, payload={
+            'filter': {
+                'actions': {},
+                'match_policy': 'include_all',
+                'clauses': [{
+                    'field': '/uri',
+                    'operator': 'one_of',
+                    'value': ['http://example.com'],
+                }],
+            }
+        })
+
+        websocket.handle_filter_message(message)
+
+        assert websocket.WebSocket.subscriptions.lookup('http://example.com') == {socket}
+
+    def test_sets_resume_from(self, socket):
+        message = websocket.Message(socket=socket, payload={
+            'filter': {
+                'actions': {},
+                'match_policy': 'include_all',
+                'clauses': [],
+            },
+            'resume_from': {'stream': 'abc', 'seq': 12},
+        })
+
+        websocket.handle_filter_message(message)
+
+        assert socket.resume_from == {'stream': 'abc', 'seq': 12}
+
     @mock.patch('h.streamer.websocket.storage.expand_uri')
     def test_expands_uris_in_uri_filter_with_session(self, expand_uri, socket):
         expand_uri.return_value = ['http://example.com',
@@ -363,6 +539,27 @@ class TestHandleFilterMessage(object):
         mock_reply.assert_called_once_with(matchers.mapping_containing('error'),
                                            ok=False)
 
+    def test_invalid_filter_clause_error(self, matchers, socket):
+        message = websocket.Message(socket=socket, payload={
+            'type': 'filter',
+            'filter': {
+                'actions': {},
+                'match_policy': 'include_all',
+                'clauses': [{
+                    'field': 'not-a-json-pointer',
+                    'operator': 'equals',
+                    'value': 'foo',
+                }],
+            }
+        })
+
+        with mock.patch.object(websocket.Message, 'reply') as mock_reply:
+            websocket.handle_filter_message(message)
+
+        mock_reply.assert_called_once_with(matchers.mapping_containing('error'),
+                                           ok=False)
+        assert socket.filter is None
+
     @pytest.fixture
     def socket(self):
         socket = mock.Mock()
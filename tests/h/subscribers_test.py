@@ -84,14 +84,58 @@ class TestPublishAnnotationEvent:
             'src_client_id': 'client_id'
         })
 
+    def test_it_embeds_the_presented_annotation_when_enabled(self,
+                                                            event,
+                                                            fetch_annotation,
+                                                            presenters):
+        event.request.headers = {}
+        event.request.registry.settings['h.realtime.embed_annotations'] = True
+        presenters.AnnotationJSONPresenter.return_value.asdict.return_value = {'id': 'test_annotation_id'}
+
+        subscribers.publish_annotation_event(event)
+
+        fetch_annotation.assert_called_once_with(event.request.db, 'test_annotation_id')
+        data = event.request.realtime.publish_annotation.call_args[0][0]
+        assert data['annotation'] == {'id': 'test_annotation_id'}
+
+    def test_it_does_not_embed_missing_annotations(self, event, fetch_annotation):
+        event.request.headers = {}
+        event.request.registry.settings['h.realtime.embed_annotations'] = True
+        fetch_annotation.return_value = None
+
+        subscribers.publish_annotation_event(event)
+
+        data = event.request.realtime.publish_annotation.call_args[0][0]
+        assert 'annotation' not in data
+
+    def test_it_does_not_embed_the_annotation_by_default(self, event, fetch_annotation):
+        event.request.headers = {}
+
+        subscribers.publish_annotation_event(event)
+
+        assert not fetch_annotation.called
+        data = event.request.realtime.publish_annotation.call_args[0][0]
+        assert 'annotation' not in data
+
     @pytest.fixture
     def event(self, pyramid_request):
         pyramid_request.realtime = mock.Mock()
+        pyramid_request.tm = mock.MagicMock()
         event = AnnotationEvent(pyramid_request,
                                 'test_annotation_id',
                                 'create')
         return event
 
+    @pytest.fixture
+    def fetch_annotation(self, patch):
+        return patch('h.subscribers.storage.fetch_annotation')
+
+    @pytest.fixture
+    def presenters(self, patch, pyramid_config):
+        pyramid_config.register_service(mock.Mock(), name='links')
+        pyramid_config.register_service(mock.Mock(), iface='h.interfaces.IGroupService')
+        return patch('h.subscribers.presenters')
+
 
 @pytest.mark.usefixtures('fetch_annotation')
 class TestSendReplyNotifications(object):
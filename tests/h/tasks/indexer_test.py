@@ -20,7 +20,7 @@ class FakeSettingsService(object):
         self._data[key] = value
 
 
-@pytest.mark.usefixtures('celery', 'index', 'settings_service')
+@pytest.mark.usefixtures('celery', 'index', 'settings_service', 'badge_count_service')
 class TestAddAnnotation(object):
 
     def test_it_fetches_the_annotation(self, fetch_annotation, annotation, celery):
@@ -67,6 +67,21 @@ class TestAddAnnotation(object):
                               celery.request,
                               target_index='hypothesis-abcdef123')
 
+    @pytest.mark.usefixtures('use_badge_counts')
+    def test_it_updates_badge_counts(self, fetch_annotation, annotation, badge_count_service):
+        fetch_annotation.return_value = annotation
+
+        indexer.add_annotation('test-annotation-id')
+
+        badge_count_service.update.assert_called_once_with([annotation])
+
+    def test_it_skips_badge_counts_when_they_are_disabled(self, fetch_annotation, annotation, badge_count_service):
+        fetch_annotation.return_value = annotation
+
+        indexer.add_annotation('test-annotation-id')
+
+        assert not badge_count_service.update.called
+
     def test_it_indexes_thread_root(self, fetch_annotation, reply, delay):
         fetch_annotation.return_value = reply
 
@@ -97,7 +112,104 @@ class TestAddAnnotation(object):
         return patch('h.tasks.indexer.add_annotation.delay')
 
 
-@pytest.mark.usefixtures('celery', 'delete', 'settings_service')
+@pytest.mark.usefixtures('celery', 'settings_service', 'badge_count_service',
+                         'nipsa_service')
+class TestAddAnnotations(object):
+
+    def test_it_indexes_requested_annotations_once(self, batch_indexer, factories):
+        annotations = factories.Annotation.create_batch(2)
+
+        indexer.add_annotations([batch_request(annotations[0].id),
+                                 batch_request(annotations[1].id),
+                                 batch_request(annotations[0].id)])
+
+        batch_indexer.assert_called_once_with(mock.ANY, mock.ANY, mock.ANY,
+                                              target_index=None)
+        indexed = batch_indexer.return_value.index_annotations.call_args[0][0]
+        assert sorted(a.id for a in indexed) == sorted(a.id for a in annotations)
+
+    def test_it_indexes_thread_roots_of_replies(self, batch_indexer, factories):
+        root = factories.Annotation()
+        reply = factories.Annotation(references=[root.id])
+
+        indexer.add_annotations([batch_request(reply.id)])
+
+        indexed = batch_indexer.return_value.index_annotations.call_args[0][0]
+        assert set(indexed) == set([root, reply])
+
+    def test_during_reindex_adds_to_new_index(self, batch_indexer, factories, settings_service):
+        settings_service.put(SETTING_NEW_INDEX, 'hypothesis-abcdef123')
+        annotation = factories.Annotation()
+
+        indexer.add_annotations([batch_request(annotation.id)])
+
+        assert batch_indexer.call_args_list == [
+            mock.call(mock.ANY, mock.ANY, mock.ANY, target_index=None),
+            mock.call(mock.ANY, mock.ANY, mock.ANY, target_index='hypothesis-abcdef123'),
+        ]
+
+    def test_it_skips_indexing_when_annotations_cannot_be_loaded(self, batch_indexer):
+        indexer.add_annotations([batch_request('missing-id')])
+
+        assert not batch_indexer.called
+
+    @pytest.mark.usefixtures('use_badge_counts')
+    def test_it_updates_badge_counts(self, batch_indexer, badge_count_service, factories):
+        annotation = factories.Annotation()
+
+        indexer.add_annotations([batch_request(annotation.id)])
+
+        badge_count_service.update.assert_called_once_with([annotation])
+
+    def test_it_skips_badge_counts_when_they_are_disabled(self, batch_indexer, badge_count_service, factories):
+        annotation = factories.Annotation()
+
+        indexer.add_annotations([batch_request(annotation.id)])
+
+        assert not badge_count_service.update.called
+
+    def test_it_clears_the_nipsa_cache(self, batch_indexer, nipsa_service):
+        indexer.add_annotations([batch_request('missing-id')])
+
+        nipsa_service.clear.assert_called_once_with()
+
+    def test_it_commits_the_transaction(self, batch_indexer, factories, pyramid_request):
+        annotation = factories.Annotation()
+
+        indexer.add_annotations([batch_request(annotation.id)])
+
+        pyramid_request.tm.commit.assert_called_once_with()
+        assert not pyramid_request.tm.abort.called
+
+    def test_it_aborts_the_transaction_on_error(self, batch_indexer, factories, pyramid_request):
+        annotation = factories.Annotation()
+        batch_indexer.return_value.index_annotations.side_effect = RuntimeError('boom')
+
+        with pytest.raises(RuntimeError):
+            indexer.add_annotations([batch_request(annotation.id)])
+
+        pyramid_request.tm.abort.assert_called_once_with()
+        assert not pyramid_request.tm.commit.called
+
+    @pytest.fixture
+    def pyramid_request(self, pyramid_request):
+        pyramid_request.tm = mock.Mock(spec_set=['commit', 'abort'])
+        return pyramid_request
+
+    @pytest.fixture
+    def nipsa_service(self, pyramid_config):
+        service = mock.Mock(spec_set=['clear'])
+        pyramid_config.register_service(service, name='nipsa')
+        return service
+
+    @pytest.fixture
+    def batch_indexer(self, patch):
+        batch_indexer = patch('h.tasks.indexer.BatchIndexer')
+        batch_indexer.return_value.index_annotations.return_value = set()
+        return batch_indexer
+
+
+@pytest.mark.usefixtures('celery', 'delete', 'settings_service', 'badge_count_service')
 class TestDeleteAnnotation(object):
 
     def test_it_deletes_from_index(self, delete, celery):
@@ -123,12 +235,40 @@ class TestDeleteAnnotation(object):
                                'test-annotation-id',
                                target_index='hypothesis-abcdef123')
 
+    @pytest.mark.usefixtures('use_badge_counts')
+    def test_it_updates_badge_counts(self, fetch_annotation, badge_count_service):
+        annotation = mock.Mock()
+        fetch_annotation.return_value = annotation
+
+        indexer.delete_annotation('test-annotation-id')
+
+        badge_count_service.update.assert_called_once_with([annotation])
+
+    def test_it_skips_badge_counts_when_they_are_disabled(self, fetch_annotation, badge_count_service):
+        fetch_annotation.return_value = mock.Mock()
+
+        indexer.delete_annotation('test-annotation-id')
+
+        assert not badge_count_service.update.called
+
+    @pytest.mark.usefixtures('use_badge_counts')
+    def test_it_skips_badge_counts_when_annotation_cannot_be_loaded(self, fetch_annotation, badge_count_service):
+        fetch_annotation.return_value = None
+
+        indexer.delete_annotation('test-annotation-id')
+
+        assert not badge_count_service.update.called
+
     @pytest.fixture
     def delete(self, patch):
         return patch('h.tasks.indexer.delete')
 
+    @pytest.fixture
+    def fetch_annotation(self, patch):
+        return patch('h.tasks.indexer.storage.fetch_annotation')
+
 
-@pytest.mark.usefixtures('celery')
+@pytest.mark.usefixtures('celery', 'badge_count_service')
 class TestReindexUserAnnotations(object):
     def test_it_reindexes_users_annotations(self, batch_indexer, annotation_ids):
         userid = annotation_ids.keys()[0]
@@ -140,6 +280,17 @@ class TestReindexUserAnnotations(object):
         expected = annotation_ids[userid]
         assert sorted(expected) == sorted(actual)
 
+    @pytest.mark.usefixtures('use_badge_counts')
+    def test_it_updates_badge_counts(self, batch_indexer, annotation_ids, badge_count_service):
+        userid = annotation_ids.keys()[0]
+
+        indexer.reindex_user_annotations(userid)
+
+        args, _ = badge_count_service.update.call_args
+        actual = [a.id for a in args[0]]
+        expected = annotation_ids[userid]
+        assert sorted(expected) == sorted(actual)
+
     @pytest.fixture
     def batch_indexer(self, patch):
         return patch('h.tasks.indexer.BatchIndexer')
@@ -173,3 +324,19 @@ def settings_service(pyramid_config):
     service = FakeSettingsService()
     pyramid_config.register_service(service, name='settings')
     return service
+
+
+@pytest.fixture
+def badge_count_service(pyramid_config):
+    service = mock.Mock(spec_set=['update'])
+    pyramid_config.register_service(service, name='badge_count')
+    return service
+
+
+@pytest.fixture
+def use_badge_counts(pyramid_config, pyramid_request):
+    pyramid_request.registry.settings['h.badge.use_counts'] = 'true'
+
+
+def batch_request(id_):
+    return mock.Mock(spec_set=['args', 'kwargs'], args=(id_,), kwargs={})
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import mock
+
+from h.util.lru import LRUCache
+
+
+class TestLRUCache(object):
+    def test_get_returns_value(self):
+        cache = LRUCache(2)
+        cache['a'] = 1
+
+        assert cache.get('a') == 1
+
+    def test_get_returns_default_for_missing_key(self):
+        cache = LRUCache(2)
+
+        assert cache.get('a') is None
+        assert cache.get('a', 5) == 5
+
+    def test_setting_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        cache.get('a')
+
+        cache['c'] = 3
+
+        assert 'a' in cache
+        assert 'b' not in cache
+        assert 'c' in cache
+        assert len(cache) == 2
+
+    def test_setting_existing_key_marks_it_as_most_recently_used(self):
+        cache = LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        cache['a'] = 3
+
+        cache['c'] = 4
+
+        assert cache.get('a') == 3
+        assert 'b' not in cache
+
+    def test_calls_on_evict_with_evicted_items(self):
+        on_evict = mock.Mock()
+        cache = LRUCache(1, on_evict=on_evict)
+        cache['a'] = 1
+
+        cache['b'] = 2
+
+        on_evict.assert_called_once_with('a', 1)
+
+    def test_pop_removes_item_without_calling_on_evict(self):
+        on_evict = mock.Mock()
+        cache = LRUCache(2, on_evict=on_evict)
+        cache['a'] = 1
+
+        assert cache.pop('a') == 1
+        assert cache.pop('a') is None
+        assert not on_evict.called
+        assert len(cache) == 0
+
+    def test_items_can_be_popped_while_iterating(self):
+        cache = LRUCache(3)
+        cache['a'] = 1
+        cache['b'] = 2
+
+        for key in cache:
+            cache.pop(key)
+
+        assert len(cache) == 0
+
+    def test_clear_removes_all_items(self):
+        cache = LRUCache(2)
+        cache['a'] = 1
+
+        cache.clear()
+
+        assert len(cache) == 0
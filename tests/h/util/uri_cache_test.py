@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import mock
+
+from h.util.uri_cache import ExpandedURICache
+
+
+class TestExpandedURICache(object):
+    def test_get_returns_none_for_uncached_uri(self):
+        cache = ExpandedURICache()
+
+        assert cache.get('http://a.com') is None
+        assert (cache.hits, cache.misses) == (0, 1)
+
+    def test_get_returns_cached_expansion(self):
+        cache = ExpandedURICache()
+        cache.set('http://a.com', ['http://a.com', 'http://b.com'])
+
+        result = cache.get('http://a.com')
+
+        assert result == ['http://a.com', 'http://b.com']
+        assert (cache.hits, cache.misses) == (1, 0)
+
+    def test_get_returns_a_copy(self):
+        cache = ExpandedURICache()
+        cache.set('http://a.com', ['http://a.com'])
+
+        cache.get('http://a.com').append('http://c.com')
+
+        assert cache.get('http://a.com') == ['http://a.com']
+
+    def test_get_ignores_expired_entries(self):
+        clock = mock.Mock(return_value=0)
+        cache = ExpandedURICache(ttl=60, clock=clock)
+        cache.set('http://a.com', ['http://a.com'])
+
+        clock.return_value = 60
+
+        assert cache.get('http://a.com') is None
+        assert len(cache) == 0
+
+    def test_set_evicts_least_recently_used(self):
+        cache = ExpandedURICache(maxsize=2)
+        cache.set('http://a.com', ['http://a.com'])
+        cache.set('http://b.com', ['http://b.com'])
+        cache.get('http://a.com')
+
+        cache.set('http://c.com', ['http://c.com'])
+
+        assert len(cache) == 2
+        assert cache.get('http://a.com') == ['http://a.com']
+        assert cache.get('http://b.com') is None
+
+    def test_set_replaces_existing_entry(self):
+        cache = ExpandedURICache()
+        cache.set('http://a.com', ['http://a.com', 'http://b.com'])
+        cache.set('http://a.com', ['http://a.com'])
+
+        cache.invalidate('http://b.com')
+
+        assert cache.get('http://a.com') == ['http://a.com']
+
+    def test_invalidate_drops_entry(self):
+        cache = ExpandedURICache()
+        cache.set('http://a.com', ['http://a.com'])
+
+        cache.invalidate('http://a.com')
+
+        assert cache.get('http://a.com') is None
+
+    def test_invalidate_drops_entries_expanding_to_uri(self):
+        cache = ExpandedURICache()
+        cache.set('http://a.com', ['http://a.com', 'http://b.com'])
+
+        cache.invalidate('http://b.com')
+
+        assert len(cache) == 0
+
+    def test_invalidate_leaves_unrelated_entries(self):
+        cache = ExpandedURICache()
+        cache.set('http://a.com', ['http://a.com', 'http://b.com'])
+
+        cache.invalidate('http://c.com')
+
+        assert len(cache) == 1
+
+    def test_clear_drops_all_entries(self):
+        cache = ExpandedURICache()
+        cache.set('http://a.com', ['http://a.com'])
+
+        cache.clear()
+
+        assert len(cache) == 0
@@ -64,7 +64,20 @@ class TestSearchController(object):
 
         paginate.assert_called_once_with(pyramid_request,
                                          mock.ANY,
-                                         page_size=100)
+                                         page_size=100,
+                                         next_cursor=mock.ANY)
+
+    def test_search_passes_next_cursor_to_pagination(self,
+                                                     controller,
+                                                     pyramid_request,
+                                                     paginate,
+                                                     query):
+        controller.search()
+
+        paginate.assert_called_once_with(pyramid_request,
+                                         mock.ANY,
+                                         page_size=mock.ANY,
+                                         next_cursor=query.execute.return_value.next)
 
     def test_search_generates_tag_links(self, controller):
         result = controller.search()
@@ -315,7 +328,8 @@ class TestGroupSearchController(object):
         search.return_value = {
             'search_results': ActivityResults(total=200,
                                               aggregations={'users': users_aggregation},
-                                              timeframes=[]),
+                                              timeframes=[],
+                                              next=None),
         }
 
         result = controller.search()
@@ -963,7 +977,8 @@ def search(patch):
     search.return_value = {
         'search_results': ActivityResults(total=200,
                                           aggregations={},
-                                          timeframes=[]),
+                                          timeframes=[],
+                                          next=None),
         'zero_message': 'No annotations matched your search.',
     }
     return search
@@ -86,15 +86,37 @@ class TestSearch(object):
         search = search_lib.Search.return_value
         search_lib.Search.assert_called_with(pyramid_request,
                                              separate_replies=False,
-                                             stats=pyramid_request.stats)
+                                             stats=pyramid_request.stats,
+                                             include_sources=False)
         search.run.assert_called_once_with(pyramid_request.params)
 
+    def test_it_includes_sources_when_rendering_from_the_index(self,
+                                                               pyramid_request,
+                                                               search_lib):
+        pyramid_request.registry.settings['h.search.render_from_index'] = 'true'
+
+        views.search(pyramid_request)
+
+        _, kwargs = search_lib.Search.call_args
+        assert kwargs['include_sources'] is True
+
     def test_it_presents_search_results(self, pyramid_request, search_run, presentation_service):
         search_run.return_value = SearchResult(2, ['row-1', 'row-2'], [], {})
 
         views.search(pyramid_request)
 
-        presentation_service.present_all.assert_called_once_with(['row-1', 'row-2'])
+        presentation_service.present_all.assert_called_once_with(['row-1', 'row-2'], {})
+
+    def test_it_presents_search_results_from_sources(self,
+                                                     pyramid_request,
+                                                     search_run,
+                                                     presentation_service):
+        sources = {'row-1': {'text': 'foo'}}
+        search_run.return_value = SearchResult(1, ['row-1'], [], {}, sources=sources)
+
+        views.search(pyramid_request)
+
+        presentation_service.present_all.assert_called_once_with(['row-1'], sources)
 
     def test_it_returns_search_results(self, pyramid_request, search_run, presentation_service):
         search_run.return_value = SearchResult(2, ['row-1', 'row-2'], [], {})
@@ -106,13 +128,20 @@ class TestSearch(object):
 
         assert views.search(pyramid_request) == expected
 
+    def test_it_returns_next_cursor(self, pyramid_request, search_run, presentation_service):
+        search_run.return_value = SearchResult(3, ['row-1', 'row-2'], [], {}, 'cursor')
+
+        result = views.search(pyramid_request)
+
+        assert result['next'] == 'cursor'
+
     def test_it_presents_replies(self, pyramid_request, search_run, presentation_service):
         pyramid_request.params = {'_separate_replies': '1'}
         search_run.return_value = SearchResult(1, ['row-1'], ['reply-1', 'reply-2'], {})
 
         views.search(pyramid_request)
 
-        presentation_service.present_all.assert_called_with(['reply-1', 'reply-2'])
+        presentation_service.present_all.assert_called_with(['reply-1', 'reply-2'], {})
 
     def test_it_returns_replies(self, pyramid_request, search_run, presentation_service):
         pyramid_request.params = {'_separate_replies': '1'}
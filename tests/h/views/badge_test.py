@@ -7,7 +7,9 @@ import mock
 
 from pyramid import httpexceptions
 
+from h.views.badge import MAX_BADGE_URIS
 from h.views.badge import badge
+from h.views.badge import badges
 
 
 badge_fixtures = pytest.mark.usefixtures('models', 'search_lib')
@@ -37,12 +39,102 @@ def test_badge_returns_0_if_blocked(models, search_run):
     assert result == {'total': 0}
 
 
+@badge_fixtures
+def test_badge_returns_number_from_badge_counts_when_enabled(models,
+                                                             search_run,
+                                                             pyramid_request,
+                                                             badge_count_service):
+    pyramid_request.params['uri'] = 'test_uri'
+    pyramid_request.registry.settings['h.badge.use_counts'] = 'true'
+    models.Blocklist.is_blocked.return_value = False
+    badge_count_service.count.return_value = 29
+
+    result = badge(pyramid_request)
+
+    badge_count_service.count.assert_called_once_with('test_uri')
+    assert not search_run.called
+    assert result == {'total': 29}
+
+
+@badge_fixtures
+def test_badge_returns_0_if_blocked_when_badge_counts_enabled(models,
+                                                              pyramid_request,
+                                                              badge_count_service):
+    pyramid_request.params['uri'] = 'test_uri'
+    pyramid_request.registry.settings['h.badge.use_counts'] = 'true'
+    models.Blocklist.is_blocked.return_value = True
+
+    result = badge(pyramid_request)
+
+    assert not badge_count_service.count.called
+    assert result == {'total': 0}
+
+
 @badge_fixtures
 def test_badge_raises_if_no_uri():
     with pytest.raises(httpexceptions.HTTPBadRequest):
         badge(mock.Mock(params={}))
 
 
+@badge_fixtures
+class TestBadges(object):
+    def test_it_returns_numbers_from_one_multi_search(self, models, search_lib, pyramid_request):
+        pyramid_request.GET.add('uri', 'http://a.com/')
+        pyramid_request.GET.add('uri', 'http://b.com/')
+        models.Blocklist.blocked.return_value = set()
+        count_all = search_lib.Search.return_value.count_all
+        count_all.side_effect = lambda params_list: [len(p['uri']) for p in params_list]
+
+        result = badges(pyramid_request)
+
+        assert count_all.call_count == 1
+        assert result == {'totals': {'http://a.com/': 13, 'http://b.com/': 13}}
+
+    def test_it_returns_0_for_blocked_uris(self, models, search_lib, pyramid_request):
+        pyramid_request.GET.add('uri', 'http://a.com/')
+        pyramid_request.GET.add('uri', 'http://b.com/')
+        models.Blocklist.blocked.return_value = set(['http://a.com/'])
+        count_all = search_lib.Search.return_value.count_all
+        count_all.return_value = [29]
+
+        result = badges(pyramid_request)
+
+        count_all.assert_called_once_with([{'uri': 'http://b.com/'}])
+        assert result == {'totals': {'http://a.com/': 0, 'http://b.com/': 29}}
+
+    def test_it_returns_numbers_from_badge_counts_when_enabled(self,
+                                                               models,
+                                                               search_lib,
+                                                               pyramid_request,
+                                                               badge_count_service):
+        pyramid_request.GET.add('uri', 'http://a.com/')
+        pyramid_request.registry.settings['h.badge.use_counts'] = 'true'
+        models.Blocklist.blocked.return_value = set()
+        badge_count_service.counts.return_value = {'http://a.com/': 29}
+
+        result = badges(pyramid_request)
+
+        badge_count_service.counts.assert_called_once_with(['http://a.com/'])
+        assert not search_lib.Search.called
+        assert result == {'totals': {'http://a.com/': 29}}
+
+    def test_it_raises_if_no_uris(self, pyramid_request):
+        with pytest.raises(httpexceptions.HTTPBadRequest):
+            badges(pyramid_request)
+
+    def test_it_raises_if_too_many_uris(self, pyramid_request):
+        for i in range(MAX_BADGE_URIS + 1):
+            pyramid_request.GET.add('uri', 'http://example.com/%d' % i)
+
+        with pytest.raises(httpexceptions.HTTPBadRequest):
+            badges(pyramid_request)
+
+    @pytest.fixture
+    def pyramid_request(self, pyramid_request):
+        pyramid_request.stats = None
+        return pyramid_request
+
+
 @pytest.fixture
 def models(patch):
     return patch('h.views.badge.models')
@@ -56,3 +148,10 @@ def search_lib(patch):
 @pytest.fixture
 def search_run(search_lib):
     return search_lib.Search.return_value.run
+
+
+@pytest.fixture
+def badge_count_service(pyramid_config):
+    svc = mock.Mock(spec_set=['count', 'counts'])
+    pyramid_config.register_service(svc, name='badge_count')
+    return svc